@@ -3,6 +3,7 @@ from transformers import Trainer
 from transformers.utils import logging
 from transformers.file_utils import WEIGHTS_NAME, is_sagemaker_dp_enabled, is_apex_available, is_torch_tpu_available
 from torch.utils.data.dataloader import DataLoader
+from torch.utils.data import RandomSampler, Subset
 from transformers.optimization import get_scheduler
 from transformers.modeling_utils import PreTrainedModel
 from transformers.integrations import hp_params
@@ -37,7 +38,8 @@ import math
 import time
 import collections
 
-from ChildTuningOptimizer import ChildTuningAdamW
+from ChildTuningOptimizer import ChildTuningAdamW, FusedChildTuningAdamW
+from fisher import FisherAccumulator
 
 logger = logging.get_logger(__name__)
 
@@ -45,64 +47,68 @@ class ChildTuningDtrainer(Trainer):
     def __init__(self, **kwargs):
         self.reserve_p = kwargs.pop('reserve_p')
         self.mode = kwargs.pop('mode')
+        self.fused_optimizer = kwargs.pop('fused_optimizer', False)
+        self.fisher_subset = kwargs.pop('fisher_subset', 1.0)
         super().__init__(**kwargs)
     
     def calculate_fisher(self):
         '''
         Calculate Fisher Information for different parameters
         '''
-        gradient_mask = dict()
         model = self.model
         model.train()
-
-        for name, params in model.named_parameters():
-            if 'layer' in name:
-                gradient_mask[params] = params.new_zeros(params.size())
+        accumulator = FisherAccumulator(model.named_parameters(), max_grad_norm=self.args.max_grad_norm)
 
         # Now begin
+        train_dataset = self.train_dataset
+        if self.fisher_subset < 1.0:
+            # the same random subset on every process
+            generator = torch.Generator().manual_seed(self.args.seed)
+            num_examples = max(1, int(len(train_dataset) * self.fisher_subset))
+            indices = torch.randperm(len(train_dataset), generator=generator)[:num_examples].tolist()
+            train_dataset = Subset(train_dataset, indices)
+        if self.args.local_rank != -1:
+            sampler = DistributedSampler(train_dataset, seed=self.args.seed)
+        else:
+            sampler = RandomSampler(train_dataset)
         train_dataloader = DataLoader(
-            self.train_dataset,
+            train_dataset,
             batch_size=self.args.per_device_train_batch_size,
-            shuffle=True,
+            sampler=sampler,
             collate_fn=self.data_collator,
             drop_last=self.args.dataloader_drop_last,
             num_workers=self.args.dataloader_num_workers,
             pin_memory=self.args.dataloader_pin_memory,
         )
-        
+
+        # batches of all processes
         N = len(train_dataloader)
+        if self.args.local_rank != -1:
+            N = torch.tensor(N, device=self.args.device)
+            dist.all_reduce(N)
+            N = N.item()
 
+        start_time = time.time()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
         for inputs in tqdm(train_dataloader):
-            inputs.pop('idx')
+            inputs.pop('idx', None)
             inputs = self._prepare_inputs(inputs)
             outputs = model(**inputs)
             loss = outputs["loss"] if isinstance(outputs, dict) else outputs[0]
             loss.backward()
-
-            for name, params in model.named_parameters():
-                if 'layer' in name:
-                    torch.nn.utils.clip_grad_norm_(params, self.args.max_grad_norm)
-                    gradient_mask[params] += (params.grad ** 2) / N
+            accumulator.accumulate(1.0 / N)
             model.zero_grad()
-
+        accumulator.all_reduce()
 
         print('Calculate Fisher Information')
 
-        # Numpy
-        r = None
-        for k, v in gradient_mask.items():
-            v = v.view(-1).cpu().numpy()
-            if r is None:
-                r = v
-            else:
-                r = np.append(r, v)
-        polar = np.percentile(r, (1-self.reserve_p)*100)
-        for k in gradient_mask:
-            gradient_mask[k] = gradient_mask[k] >= polar
+        gradient_mask, polar = accumulator.masks(self.reserve_p)
         print('Polar => {}'.format(polar))
+        logger.info(f"  Fisher information of {N} batches in {time.time() - start_time:.1f}s")
+        if torch.cuda.is_available():
+            logger.info(f"  Peak GPU memory {torch.cuda.max_memory_allocated() / 2 ** 30:.2f}GB")
 
-        # TODO: pytorch: torch.kthvalue
-        
         return gradient_mask
 
     def create_optimizer_and_scheduler(self, num_training_steps: int):
@@ -124,7 +130,7 @@ class ChildTuningDtrainer(Trainer):
                     "weight_decay": 0.0,
                 },
             ]
-            optimizer_cls = ChildTuningAdamW
+            optimizer_cls = FusedChildTuningAdamW if self.fused_optimizer else ChildTuningAdamW
             optimizer_kwargs = {
                 "betas": (self.args.adam_beta1, self.args.adam_beta2),
                 "eps": self.args.adam_epsilon,
@@ -1,12 +1,13 @@
 
 from transformers import Trainer
 from transformers.optimization import get_scheduler
-from ChildTuningOptimizer import ChildTuningAdamW
+from ChildTuningOptimizer import ChildTuningAdamW, FusedChildTuningAdamW
 
 class ChildTuningFtrainer(Trainer):
     def __init__(self, **kwargs):
         self.reserve_p = kwargs.pop('reserve_p')
         self.mode = kwargs.pop('mode')
+        self.fused_optimizer = kwargs.pop('fused_optimizer', False)
         super().__init__(**kwargs)
 
     def create_optimizer_and_scheduler(self, num_training_steps: int):
@@ -28,7 +29,7 @@ class ChildTuningFtrainer(Trainer):
                     "weight_decay": 0.0,
                 },
             ]
-            optimizer_cls = ChildTuningAdamW
+            optimizer_cls = FusedChildTuningAdamW if self.fused_optimizer else ChildTuningAdamW
             optimizer_kwargs = {
                 "betas": (self.args.adam_beta1, self.args.adam_beta2),
                 "eps": self.args.adam_epsilon,
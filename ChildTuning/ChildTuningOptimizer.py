@@ -4,6 +4,8 @@ from typing import Callable, Iterable, Tuple
 from torch.distributions.bernoulli import Bernoulli
 import math
 
+from fisher import PackedMask
+
 class ChildTuningAdamW(Optimizer):
     def __init__(
         self,
@@ -56,7 +58,8 @@ class ChildTuningAdamW(Optimizer):
                 if self.mode is not None:
                     if self.mode == 'ChildTuning-D':
                         if p in self.gradient_mask:
-                            grad *= self.gradient_mask[p]
+                            mask = self.gradient_mask[p]
+                            grad *= mask.unpack() if isinstance(mask, PackedMask) else mask
                     else: 
                         # ChildTuning-F
                         grad_mask = Bernoulli(grad.new_full(size=grad.size(), fill_value=self.reserve_p))
@@ -102,4 +105,140 @@ class ChildTuningAdamW(Optimizer):
                 # Add weight decay at the end (fixed version)
                 p.data.add_(p.data, alpha=-group["lr"] * group["weight_decay"])
 
-        return loss
\ No newline at end of file
+        return loss
+
+class FusedChildTuningAdamW(ChildTuningAdamW):
+    '''
+    ChildTuningAdamW with multi-tensor (foreach) updates of all parameters of a group.
+
+    ChildTuning-F draws the Bernoulli masks of a group from one flat boolean buffer that is
+    reused every step. ChildTuning-D keeps the Adam moments of a masked parameter only for its
+    reserved coordinates (when less than half are reserved): the other coordinates never get a
+    gradient, so their moments stay zero and they only get weight decay. The updates are the
+    same as ChildTuningAdamW.
+
+    The flat indices of the reserved coordinates are rebuilt from the gradient mask instead of
+    being kept in the optimizer state, load_state_dict would cast them to the parameter dtype.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._bernoulli_buffer = None
+        self._indices = {}
+
+    def set_gradient_mask(self, gradient_mask):
+        super().set_gradient_mask(gradient_mask)
+        self._indices = {}
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        for state in self.state.values():
+            # written by earlier versions, the reloaded copy is no longer an integer tensor
+            state.pop("index", None)
+
+    def _bernoulli_masks(self, grads):
+        numel = [g.numel() for g in grads]
+        if self._bernoulli_buffer is None or self._bernoulli_buffer.numel() < sum(numel) \
+                or self._bernoulli_buffer.device != grads[0].device:
+            self._bernoulli_buffer = torch.empty(sum(numel), dtype=torch.bool, device=grads[0].device)
+        buffer = self._bernoulli_buffer[:sum(numel)].bernoulli_(self.reserve_p)
+        return [m.view_as(g) for m, g in zip(buffer.split(numel), grads)]
+
+    def _mask(self, p):
+        if self.mode != 'ChildTuning-D' or p not in self.gradient_mask:
+            return None
+        mask = self.gradient_mask[p]
+        return mask.unpack() if isinstance(mask, PackedMask) else mask.bool()
+
+    def _index(self, p):
+        '''Flat indices of the reserved coordinates of `p`.'''
+        if p not in self._indices:
+            self._indices[p] = self._mask(p).reshape(-1).nonzero().view(-1)
+        return self._indices[p]
+
+    def _init_state(self, p, state):
+        state["step"] = 0
+        mask = self._mask(p)
+        if mask is not None and 2 * int(mask.sum()) < mask.numel():
+            index = self._index(p)
+            state["exp_avg"] = p.new_zeros(index.numel())
+            state["exp_avg_sq"] = p.new_zeros(index.numel())
+        else:
+            state["exp_avg"] = torch.zeros_like(p.data)
+            state["exp_avg_sq"] = torch.zeros_like(p.data)
+
+    @torch.no_grad()
+    def step(self, closure: Callable = None):
+        """
+        Performs a single optimization step.
+
+        Arguments:
+            closure (:obj:`Callable`, `optional`): A closure that reevaluates the model and returns the loss.
+        """
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            params, grads, updated, exp_avgs, exp_avg_sqs, step_sizes = [], [], [], [], [], []
+            sparse = []
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+                if p.grad.is_sparse:
+                    raise RuntimeError("Adam does not support sparse gradients, please consider SparseAdam instead")
+                state = self.state[p]
+                if len(state) == 0:
+                    self._init_state(p, state)
+                state["step"] += 1
+
+                step_size = group["lr"]
+                if group["correct_bias"]:  # No bias correction for Bert
+                    beta1, beta2 = group["betas"]
+                    bias_correction1 = 1.0 - beta1 ** state["step"]
+                    bias_correction2 = 1.0 - beta2 ** state["step"]
+                    step_size = step_size * math.sqrt(bias_correction2) / bias_correction1
+
+                params.append(p)
+                if state["exp_avg"].shape != p.shape:
+                    # update the reserved coordinates only
+                    index = self._index(p)
+                    if index.numel() != state["exp_avg"].numel():
+                        raise RuntimeError("gradient mask reserves {} coordinates, the optimizer state {}".format(
+                            index.numel(), state["exp_avg"].numel()))
+                    sparse.append((p, index, len(updated)))
+                    grads.append(p.grad.reshape(-1).index_select(0, index))
+                    updated.append(p.data.view(-1).index_select(0, index))
+                else:
+                    mask = self._mask(p)
+                    if mask is not None:
+                        p.grad.mul_(mask)
+                    grads.append(p.grad)
+                    updated.append(p.data)
+                exp_avgs.append(state["exp_avg"])
+                exp_avg_sqs.append(state["exp_avg_sq"])
+                step_sizes.append(-step_size)
+            if not params:
+                continue
+
+            if self.mode is not None and self.mode != 'ChildTuning-D':
+                # ChildTuning-F
+                torch._foreach_mul_(grads, self._bernoulli_masks(grads))
+                torch._foreach_mul_(grads, 1.0 / self.reserve_p)
+
+            beta1, beta2 = group["betas"]
+            torch._foreach_mul_(exp_avgs, beta1)
+            torch._foreach_add_(exp_avgs, grads, alpha=1.0 - beta1)
+            torch._foreach_mul_(exp_avg_sqs, beta2)
+            torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1.0 - beta2)
+            denoms = torch._foreach_sqrt(exp_avg_sqs)
+            torch._foreach_add_(denoms, group["eps"])
+            torch._foreach_addcdiv_(updated, exp_avgs, denoms, step_sizes)
+            for p, index, i in sparse:
+                p.data.view(-1).index_copy_(0, index, updated[i])
+
+            # Add weight decay at the end (fixed version), see ChildTuningAdamW
+            if group["weight_decay"] > 0.0:
+                params = [p.data for p in params]
+                torch._foreach_add_(params, params, alpha=-group["lr"] * group["weight_decay"])
+
+        return loss
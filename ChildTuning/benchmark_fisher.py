@@ -0,0 +1,156 @@
+'''
+Time and peak memory of the ChildTuning-D Fisher information and masks, the previous
+per-parameter loops with np.append / np.percentile versus FisherAccumulator.
+
+Gradients are random, the forward and backward passes are the same for both and are not run.
+
+    python benchmark_fisher.py --hidden_size 1024 --num_hidden_layers 24 --steps 20 --reserve_p 0.3
+'''
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+from transformers import BertConfig, BertModel
+
+from fisher import FisherAccumulator
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--hidden_size', type=int, default=1024)
+parser.add_argument('--num_hidden_layers', type=int, default=24)
+parser.add_argument('--steps', type=int, default=20)
+parser.add_argument('--reserve_p', type=float, default=0.3)
+parser.add_argument('--max_grad_norm', type=float, default=1.0)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('--seed', type=int, default=42)
+
+
+class PeakMemory:
+    '''Peak memory above the current usage: allocated GPU memory, or sampled resident memory on CPU.'''
+    def __init__(self, device):
+        self.device = device
+
+    def _rss(self):
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    def _sample(self):
+        while not self.done:
+            self.peak = max(self.peak, self._rss())
+            time.sleep(0.001)
+
+    def __enter__(self):
+        if self.device == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            self.base = torch.cuda.memory_allocated()
+        else:
+            self.base = self.peak = self._rss()
+            self.done = False
+            self.thread = threading.Thread(target=self._sample, daemon=True)
+            self.thread.start()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device == 'cuda':
+            torch.cuda.synchronize()
+            self.peak = torch.cuda.max_memory_allocated()
+        else:
+            self.done = True
+            self.thread.join()
+        if not hasattr(self, 'seconds'):
+            self.seconds = time.time() - self.start
+        self.gb = (self.peak - self.base) / 2 ** 30
+
+
+def synchronized_time(start):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.time() - start
+
+
+def set_random_grads(params, generator):
+    for p in params:
+        p.grad = torch.randn(p.shape, generator=generator, device='cpu').mul_(1e-3).to(p.device)
+
+
+def previous_fisher(model, steps, reserve_p, max_grad_norm, grads):
+    gradient_mask = dict()
+    for name, params in model.named_parameters():
+        if 'layer' in name:
+            gradient_mask[params] = params.new_zeros(params.size())
+    with PeakMemory(args.device) as accumulate:
+        accumulate.seconds = 0.0
+        for step in range(steps):
+            grads(step)
+            start = time.time()
+            for name, params in model.named_parameters():
+                if 'layer' in name:
+                    torch.nn.utils.clip_grad_norm_(params, max_grad_norm)
+                    gradient_mask[params] += (params.grad ** 2) / steps
+            accumulate.seconds += synchronized_time(start)
+    with PeakMemory(args.device) as threshold:
+        r = None
+        for k, v in gradient_mask.items():
+            v = v.view(-1).cpu().numpy()
+            if r is None:
+                r = v
+            else:
+                r = np.append(r, v)
+        polar = np.percentile(r, (1 - reserve_p) * 100)
+        del r
+        for k in gradient_mask:
+            gradient_mask[k] = gradient_mask[k] >= polar
+    return gradient_mask, polar, accumulate, threshold
+
+
+def streaming_fisher(model, steps, reserve_p, max_grad_norm, grads):
+    accumulator = FisherAccumulator(model.named_parameters(), max_grad_norm=max_grad_norm)
+    with PeakMemory(args.device) as accumulate:
+        accumulate.seconds = 0.0
+        for step in range(steps):
+            grads(step)
+            start = time.time()
+            accumulator.accumulate(1.0 / steps)
+            accumulate.seconds += synchronized_time(start)
+    with PeakMemory(args.device) as threshold:
+        gradient_mask, polar = accumulator.masks(reserve_p)
+    # the same percentile as np.percentile over all Fisher values
+    expected = np.percentile(torch.cat([f.view(-1) for f in accumulator.fisher]).cpu().numpy(), (1 - reserve_p) * 100)
+    return gradient_mask, polar, expected, accumulate, threshold
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    config = BertConfig(hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers,
+                        num_attention_heads=args.hidden_size // 64, intermediate_size=4 * args.hidden_size)
+    model = BertModel(config).to(args.device)
+    params = [p for n, p in model.named_parameters() if 'layer' in n]
+    num_values = sum(p.numel() for p in params)
+
+    def grads(step):
+        set_random_grads(params, torch.Generator().manual_seed(args.seed + step))
+
+    new_mask, new_polar, expected, new_accumulate, new_threshold = streaming_fisher(
+        model, args.steps, args.reserve_p, args.max_grad_norm, grads)
+    kept = sum(m.sum() for m in new_mask.values())
+    packed_bytes = sum(m.bits.numel() for m in new_mask.values())
+    old_mask, old_polar, old_accumulate, old_threshold = previous_fisher(
+        model, args.steps, args.reserve_p, args.max_grad_norm, grads)
+    mismatch = sum(int((new_mask[p].unpack() != old_mask[p]).sum()) for p in params)
+
+    print('{:.1f}M Fisher values ({} layers of {}), {} steps, reserve_p {}, {}'.format(
+        num_values / 1e6, args.num_hidden_layers, args.hidden_size, args.steps, args.reserve_p, args.device))
+    print('{:>20} {:>14} {:>12} {:>14} {:>12} {:>10}'.format(
+        '', 'accumulate ms', 'peak GB', 'threshold s', 'peak GB', 'masks MB'))
+    print('{:>20} {:14.1f} {:12.2f} {:14.2f} {:12.2f} {:10.1f}'.format(
+        'previous', 1000 * old_accumulate.seconds / args.steps, old_accumulate.gb, old_threshold.seconds,
+        old_threshold.gb, num_values / 2 ** 20))
+    print('{:>20} {:14.1f} {:12.2f} {:14.2f} {:12.2f} {:10.1f}'.format(
+        'FisherAccumulator', 1000 * new_accumulate.seconds / args.steps, new_accumulate.gb, new_threshold.seconds,
+        new_threshold.gb, packed_bytes / 2 ** 20))
+    print('polar {:.6e} (np.percentile {:.6e}, previous {:.6e}), kept {:.4f}, {} of {} mask entries differ'.format(
+        new_polar, expected, old_polar, kept / num_values, mismatch, num_values))
@@ -0,0 +1,89 @@
+'''
+Step time and optimizer state memory of ChildTuningAdamW versus FusedChildTuningAdamW.
+
+Gradients are random and ChildTuning-D uses random masks keeping `reserve_p` of the
+coordinates of the 'layer' parameters. ChildTuning-D parameters must end up identical,
+ChildTuning-F draws different masks with the same keep rate.
+
+    python benchmark_optimizer.py --hidden_size 1024 --num_hidden_layers 24 --steps 10 --reserve_p 0.3
+'''
+import argparse
+import time
+
+import torch
+from transformers import BertConfig, BertModel
+
+from ChildTuningOptimizer import ChildTuningAdamW, FusedChildTuningAdamW
+from fisher import PackedMask
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--hidden_size', type=int, default=1024)
+parser.add_argument('--num_hidden_layers', type=int, default=24)
+parser.add_argument('--steps', type=int, default=10)
+parser.add_argument('--reserve_p', type=float, default=0.3)
+parser.add_argument('--modes', nargs='+', default=['ChildTuning-F', 'ChildTuning-D'])
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('--seed', type=int, default=42)
+
+
+def synchronized_time(start):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.time() - start
+
+
+def state_bytes(optimizer):
+    total = sum(t.numel() * t.element_size() for state in optimizer.state.values() for t in state.values()
+                if torch.is_tensor(t))
+    total += sum(t.numel() * t.element_size() for t in getattr(optimizer, '_indices', {}).values())
+    buffer = getattr(optimizer, '_bernoulli_buffer', None)
+    return total + (buffer.numel() * buffer.element_size() if buffer is not None else 0)
+
+
+def run(optimizer_cls, model, mode, gradient_mask):
+    '''Returns (ms per step after the first, state bytes, final parameters).'''
+    torch.manual_seed(args.seed)
+    params = [p.detach().clone().requires_grad_() for p in model.parameters()]
+    names = [n for n, p in model.named_parameters()]
+    no_decay = ["bias", "LayerNorm.weight"]
+    optimizer = optimizer_cls([
+        {"params": [p for n, p in zip(names, params) if not any(nd in n for nd in no_decay)], "weight_decay": 0.01},
+        {"params": [p for n, p in zip(names, params) if any(nd in n for nd in no_decay)], "weight_decay": 0.0},
+    ], lr=4e-5, reserve_p=args.reserve_p, mode=mode)
+    if mode == 'ChildTuning-D':
+        optimizer.set_gradient_mask({params[names.index(n)]: m for n, m in gradient_mask.items()})
+
+    seconds = 0.0
+    for step in range(args.steps + 1):
+        generator = torch.Generator().manual_seed(args.seed + step)
+        for p in params:
+            p.grad = torch.randn(p.shape, generator=generator).mul_(1e-3).to(p.device)
+        start = time.time()
+        optimizer.step()
+        if step > 0:
+            seconds += synchronized_time(start)
+    return 1000 * seconds / args.steps, state_bytes(optimizer), params
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    config = BertConfig(hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers,
+                        num_attention_heads=args.hidden_size // 64, intermediate_size=4 * args.hidden_size)
+    model = BertModel(config).to(args.device)
+    generator = torch.Generator().manual_seed(args.seed)
+    gradient_mask = {n: PackedMask((torch.rand(p.shape, generator=generator) < args.reserve_p).to(p.device))
+                     for n, p in model.named_parameters() if 'layer' in n}
+    num_params = sum(p.numel() for p in model.parameters())
+
+    print('{:.1f}M parameters ({} layers of {}), reserve_p {}, {}'.format(
+        num_params / 1e6, args.num_hidden_layers, args.hidden_size, args.reserve_p, args.device))
+    print('{:>14} {:>22} {:>10} {:>10} {:>10}'.format('mode', '', 'step ms', 'state MB', 'same'))
+    for mode in args.modes:
+        before = run(ChildTuningAdamW, model, mode, gradient_mask)
+        after = run(FusedChildTuningAdamW, model, mode, gradient_mask)
+        if mode == 'ChildTuning-D':
+            same = str(all(torch.equal(p, q) for p, q in zip(before[2], after[2])))
+        else:
+            same = '-'
+        for name, (ms, nbytes, _) in (('ChildTuningAdamW', before), ('FusedChildTuningAdamW', after)):
+            print('{:>14} {:>22} {:10.1f} {:10.1f} {:>10}'.format(mode, name, ms, nbytes / 2 ** 20, same))
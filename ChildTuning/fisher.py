@@ -0,0 +1,109 @@
+import math
+
+import torch
+import torch.distributed as dist
+
+
+def kth_smallest(tensors, k):
+    '''
+    Exact k-th smallest (0-based) value of non-negative float32 tensors, without concatenating them.
+
+    The bit patterns of non-negative floats are ordered like the floats, so a histogram of the
+    high 16 bits finds the bucket holding the k-th value and a histogram of the low 16 bits of
+    that bucket finds the value itself. Only one tensor's worth of temporaries is alive at a time.
+    '''
+    device = tensors[0].device
+    high_hist = torch.zeros(1 << 16, dtype=torch.long, device=device)
+    for t in tensors:
+        bits = t.reshape(-1).view(torch.int32)
+        high_hist += torch.bincount((bits >> 16).long(), minlength=1 << 16)
+    cumsum = high_hist.cumsum(0)
+    high = int(torch.searchsorted(cumsum, torch.tensor([k], device=device), right=True))
+    k -= int(cumsum[high - 1]) if high > 0 else 0
+
+    low_hist = torch.zeros(1 << 16, dtype=torch.long, device=device)
+    for t in tensors:
+        bits = t.reshape(-1).view(torch.int32)
+        bits = bits[(bits >> 16) == high]
+        low_hist += torch.bincount((bits & 0xFFFF).long(), minlength=1 << 16)
+    low = int(torch.searchsorted(low_hist.cumsum(0), torch.tensor([k], device=device), right=True))
+    return torch.tensor([(high << 16) | low], dtype=torch.int32).view(torch.float32).item()
+
+
+class PackedMask:
+    '''
+    Boolean gradient mask stored as a bitset, 8 entries per byte.
+    '''
+    def __init__(self, mask):
+        self.shape = mask.shape
+        self.numel = mask.numel()
+        bits = mask.reshape(-1).to(torch.uint8)
+        bits = torch.cat([bits, bits.new_zeros(-self.numel % 8)]).view(-1, 8)
+        weights = 1 << torch.arange(8, dtype=torch.uint8, device=mask.device)
+        self.bits = (bits * weights).sum(-1, dtype=torch.uint8)
+
+    def unpack(self):
+        shifts = torch.arange(8, dtype=torch.uint8, device=self.bits.device)
+        mask = (self.bits.unsqueeze(-1) >> shifts) & 1
+        return mask.view(-1)[:self.numel].view(self.shape).bool()
+
+    def sum(self):
+        '''Number of set entries.'''
+        return sum(int(((self.bits >> i) & 1).sum()) for i in range(8))
+
+
+class FisherAccumulator:
+    '''
+    Accumulates the empirical Fisher information (mean squared gradient) of a fixed list of parameters.
+
+    Every gradient is clipped to `max_grad_norm` on its own, as ChildTuning-D does, with
+    multi-tensor (foreach) kernels over the whole parameter list.
+    '''
+    def __init__(self, named_parameters, max_grad_norm=None, filter_fn=lambda name: 'layer' in name):
+        self.params = [p for n, p in named_parameters if filter_fn(n) and p.requires_grad]
+        self.fisher = [torch.zeros_like(p, dtype=torch.float32) for p in self.params]
+        self.max_grad_norm = max_grad_norm
+        self.num_batches = 0
+
+    def accumulate(self, scale=1.0):
+        '''Adds the squared gradients of the current batch, times `scale`.'''
+        grads = [p.grad.float() if p.grad is not None else torch.zeros_like(f)
+                 for p, f in zip(self.params, self.fisher)]
+        if self.max_grad_norm is not None and self.max_grad_norm > 0:
+            if hasattr(torch, '_foreach_norm'):
+                norms = torch._foreach_norm(grads)
+            else:
+                norms = [g.norm() for g in grads]
+            coefs = torch.clamp(self.max_grad_norm / (torch.stack(norms) + 1e-6), max=1.0)
+            torch._foreach_mul_(grads, list(coefs.unbind()))
+        torch._foreach_addcmul_(self.fisher, grads, grads, value=scale)
+        self.num_batches += 1
+
+    def all_reduce(self):
+        '''Sums the Fisher information of all processes.'''
+        if dist.is_available() and dist.is_initialized():
+            for f in self.fisher:
+                dist.all_reduce(f)
+
+    def threshold(self, reserve_p):
+        '''
+        Polar of the masks keeping the top `reserve_p` of the Fisher information.
+
+        Returns (threshold, polar): the entries >= threshold are exactly the entries >= polar,
+        the (1 - reserve_p) percentile np.percentile would interpolate over all values.
+        '''
+        n = sum(f.numel() for f in self.fisher)
+        index = (n - 1) * (1 - reserve_p)
+        lower, upper = math.floor(index), math.ceil(index)
+        upper_value = kth_smallest(self.fisher, upper)
+        lower_value = kth_smallest(self.fisher, lower) if lower != upper else upper_value
+        return upper_value, lower_value + (upper_value - lower_value) * (index - lower)
+
+    def masks(self, reserve_p, packed=True):
+        '''Gradient masks keyed by parameter, as `PackedMask` bitsets or boolean tensors.'''
+        threshold, polar = self.threshold(reserve_p)
+        gradient_mask = dict()
+        for p, f in zip(self.params, self.fisher):
+            mask = f >= threshold
+            gradient_mask[p] = PackedMask(mask) if packed else mask
+        return gradient_mask, polar
@@ -156,6 +156,12 @@ class ModelArguments:
     mode: str = field(
         default=None
     )
+    fused_optimizer: bool = field(
+        default=False, metadata={"help": "Use the multi-tensor ChildTuningAdamW (FusedChildTuningAdamW)."}
+    )
+    fisher_subset: float = field(
+        default=1.0, metadata={"help": "Fraction of the training data the ChildTuning-D Fisher information is computed on."}
+    )
 
 def main():
     # See all possible arguments in src/transformers/training_args.py
@@ -407,10 +413,12 @@ def main():
             data_collator=data_collator,
         )
     else:
+        trainer_kwargs = dict(fused_optimizer=model_args.fused_optimizer)
         if model_args.mode == 'ChildTuning-F':
             trainer_cls = ChildTuningFtrainer
         elif model_args.mode == 'ChildTuning-D':
             trainer_cls = ChildTuningDtrainer
+            trainer_kwargs['fisher_subset'] = model_args.fisher_subset
         trainer = trainer_cls(
             model=model,
             args=training_args,
@@ -420,7 +428,8 @@ def main():
             tokenizer=tokenizer,
             data_collator=data_collator,
             reserve_p=model_args.reserve_p,
-            mode=model_args.mode
+            mode=model_args.mode,
+            **trainer_kwargs
         )
 
     # Training
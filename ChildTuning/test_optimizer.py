@@ -0,0 +1,77 @@
+'''
+Checks of FusedChildTuningAdamW against ChildTuningAdamW.
+
+    python test_optimizer.py
+'''
+import io
+
+import torch
+
+from ChildTuningOptimizer import ChildTuningAdamW, FusedChildTuningAdamW
+from fisher import PackedMask
+
+
+def make_params(seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    shapes = [(16, 8), (8,), (32, 16), (16,), (4, 4)]
+    return [torch.randn(shape, generator=generator).requires_grad_() for shape in shapes]
+
+
+def make_gradient_mask(params, reserve_p=0.3, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    # the last parameter has no mask and the second one reserves most coordinates (dense state)
+    keep = [reserve_p, 0.8, reserve_p, reserve_p]
+    return {p: PackedMask(torch.rand(p.shape, generator=generator) < k) for p, k in zip(params, keep)}
+
+
+def make_optimizer(optimizer_cls, params, gradient_mask):
+    optimizer = optimizer_cls([
+        {'params': params[:3], 'weight_decay': 0.01},
+        {'params': params[3:], 'weight_decay': 0.0},
+    ], lr=1e-2, reserve_p=0.3, mode='ChildTuning-D')
+    optimizer.set_gradient_mask(gradient_mask)
+    return optimizer
+
+
+def run_steps(optimizer, params, steps, start=0):
+    for step in range(start, start + steps):
+        generator = torch.Generator().manual_seed(100 + step)
+        for p in params:
+            p.grad = torch.randn(p.shape, generator=generator)
+        optimizer.step()
+
+
+def test_same_updates_as_childtuning_adamw():
+    reference, fused = make_params(), make_params()
+    run_steps(make_optimizer(ChildTuningAdamW, reference, make_gradient_mask(reference)), reference, 5)
+    run_steps(make_optimizer(FusedChildTuningAdamW, fused, make_gradient_mask(fused)), fused, 5)
+    for p, q in zip(reference, fused):
+        assert torch.allclose(p, q, atol=1e-6), (p - q).abs().max()
+
+
+def test_state_dict_round_trip():
+    # uninterrupted
+    reference = make_params()
+    run_steps(make_optimizer(FusedChildTuningAdamW, reference, make_gradient_mask(reference)), reference, 6)
+
+    # saved after 3 steps, reloaded into a new optimizer with the same masks, 3 more steps
+    params = make_params()
+    optimizer = make_optimizer(FusedChildTuningAdamW, params, make_gradient_mask(params))
+    run_steps(optimizer, params, 3)
+    buffer = io.BytesIO()
+    torch.save({'params': [p.detach() for p in params], 'optimizer': optimizer.state_dict()}, buffer)
+    buffer.seek(0)
+    checkpoint = torch.load(buffer)
+
+    resumed = [p.clone().requires_grad_() for p in checkpoint['params']]
+    optimizer = make_optimizer(FusedChildTuningAdamW, resumed, make_gradient_mask(resumed))
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    run_steps(optimizer, resumed, 3, start=3)
+    for p, q in zip(reference, resumed):
+        assert torch.equal(p, q), (p - q).abs().max()
+
+
+if __name__ == '__main__':
+    test_same_updates_as_childtuning_adamw()
+    test_state_dict_round_trip()
+    print('passed')
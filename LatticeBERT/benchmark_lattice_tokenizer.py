@@ -0,0 +1,155 @@
+# coding=utf-8
+# Copyright 2021 The Alibaba DAMO NLP Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark `LatticeTokenizer.tokenize` against the string-trie / igraph lattice.
+
+Generates a character vocabulary, a random lexicon (1M entries by default)
+and sentences made of lexicon words and filler characters, then tokenizes
+them with `LatticeTokenizer` and with the previous implementation (joined
+token strings looked up in a `pygtrie.StringTrie`, boundaries found by
+deleting every vertex from an igraph graph), and checks that both produce
+the same `LatticeEncoding`.
+
+  python benchmark_lattice_tokenizer.py --lexicon_size 1000000 --num_sentences 2000
+"""
+import argparse
+import bisect
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import igraph
+from pygtrie import StringTrie
+
+import tokenization_labert
+from tokenization_labert import LatticeEncoding
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--vocab_size', type=int, default=6000)
+parser.add_argument('--lexicon_size', type=int, default=1000000)
+parser.add_argument('--num_sentences', type=int, default=2000)
+parser.add_argument('--sentence_length', type=int, default=128, help='characters per sentence')
+parser.add_argument('--seed', type=int, default=12345)
+
+
+def reference_lexicon(tokenizer, lexicon_file):
+  lexicon = StringTrie(separator=tokenizer.kDelimiter)
+  with open(lexicon_file, 'r') as reader:
+    for line in reader:
+      output = tokenizer.bert_tokenizer.encode(line, add_special_tokens=False)
+      lexicon[tokenizer.kDelimiter.join(output.tokens)] = (line.strip(), len(output.tokens))
+  return lexicon
+
+
+def reference_tokenize(tokenizer, lexicon, text, add_candidate_indices):
+  output = tokenizer.bert_tokenizer.encode(text, add_special_tokens=False)
+  payload = [(token, index, 1) for index, token in enumerate(output.tokens)]
+
+  for i in range(len(output.tokens)):
+    for key, (name, length) in lexicon.prefixes(tokenizer.kDelimiter.join(output.tokens[i:])):
+      payload.append((name, i, length))
+
+  tokens = []
+  positions = []
+  lengths = []
+  for token, position, length in sorted(payload, key=lambda x: (x[1] + x[2], x[2])):
+    tokens.append(token)
+    positions.append(position)
+    lengths.append(length)
+
+  if add_candidate_indices:
+    n_vertices = len(output.tokens)
+    graph = igraph.Graph(n=n_vertices + 1,
+                         edges=[(position, position + length) for (position, length) in zip(positions, lengths)],
+                         directed=True)
+    boundaries = []
+    s, t = 0, n_vertices
+    for n in range(1, n_vertices):
+      edges = []
+      edges.extend([(neighbor, n) for neighbor in graph.predecessors(n)])
+      edges.extend([(n, neighbor) for neighbor in graph.successors(n)])
+      graph.delete_edges(edges)
+      if graph.distances(s, t)[0][0] == float("inf"):
+        boundaries.append(n)
+      graph.add_edges(edges)
+
+    boundaries.sort()
+    boundaries = boundaries + [len(tokens)]
+    cand_indices = [[] for _ in boundaries]
+    for index, (position, length) in enumerate(zip(positions, lengths)):
+      right_index = bisect.bisect_left(boundaries, position + length)
+      cand_indices[right_index].append(index)
+  else:
+    cand_indices = None
+
+  return LatticeEncoding(tokens=tokens, lengths=lengths,
+                         positions=positions, cand_indices=cand_indices)
+
+
+def write_data(work_dir, args, rng):
+  chars = [chr(0x4e00 + i) for i in range(args.vocab_size)]
+  vocab_file = os.path.join(work_dir, 'vocab.txt')
+  with open(vocab_file, 'w', encoding='utf-8') as writer:
+    writer.write(''.join(x + '\n' for x in ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + chars))
+
+  # frequent characters appear in more words, like in a real lexicon
+  weights = [1.0 / (rank + 1) for rank in range(len(chars))]
+  words = set()
+  while len(words) < args.lexicon_size:
+    length = rng.choice((2, 2, 2, 3, 3, 4, 5, 6))
+    words.add(''.join(rng.choices(chars, weights, k=length)))
+  words = sorted(words)
+  lexicon_file = os.path.join(work_dir, 'lexicon.txt')
+  with open(lexicon_file, 'w', encoding='utf-8') as writer:
+    writer.write(''.join(word + '\n' for word in words))
+
+  sentences = []
+  for _ in range(args.num_sentences):
+    pieces, length = [], 0
+    while length < args.sentence_length:
+      piece = rng.choice(words) if rng.random() < 0.7 else ''.join(rng.choices(chars, weights, k=2))
+      pieces.append(piece)
+      length += len(piece)
+    sentences.append(''.join(pieces)[:args.sentence_length])
+  return vocab_file, lexicon_file, sentences
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  rng = random.Random(args.seed)
+  work_dir = tempfile.mkdtemp()
+  vocab_file, lexicon_file, sentences = write_data(work_dir, args, rng)
+
+  start = time.time()
+  tokenizer = tokenization_labert.LatticeTokenizer(vocab_file, lexicon_file, do_lower_case=True)
+  print('LatticeTokenizer with {} lexicon entries built in {:.1f}s'.format(len(tokenizer.lexicon), time.time() - start))
+  start = time.time()
+  lexicon = reference_lexicon(tokenizer, lexicon_file)
+  print('reference StringTrie built in {:.1f}s'.format(time.time() - start))
+
+  for add_candidate_indices in (False, True):
+    start = time.time()
+    encodings = [tokenizer.tokenize(text, add_candidate_indices) for text in sentences]
+    fast = time.time() - start
+    start = time.time()
+    references = [reference_tokenize(tokenizer, lexicon, text, add_candidate_indices) for text in sentences]
+    slow = time.time() - start
+    num_tokens = sum(len(encoding.tokens) for encoding in encodings)
+    print('add_candidate_indices={}: {:.1f} lattice tokens/sentence, reference {:.1f} sents/s, '
+          'LatticeTokenizer {:.1f} sents/s ({:.1f}x), identical: {}'.format(
+            add_candidate_indices, num_tokens / len(sentences), len(sentences) / slow,
+            len(sentences) / fast, slow / fast, encodings == references))
+  shutil.rmtree(work_dir)
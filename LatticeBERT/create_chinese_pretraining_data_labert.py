@@ -17,6 +17,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import multiprocessing
 import random
 import tokenization
 import tokenization_labert
@@ -80,6 +82,17 @@ flags.DEFINE_float(
 
 flags.DEFINE_integer("max_position", 2040, "max_value of position")
 
+flags.DEFINE_integer(
+  "num_workers", 0,
+  "If > 0, build the data in this many processes and write it to the shards "
+  "`{output_file}-{index:05d}`. Shards that exist already are skipped, so an "
+  "interrupted run can be resumed with the same flags.")
+
+flags.DEFINE_integer(
+  "docs_per_shard", 10000,
+  "Number of input documents per output shard when num_workers > 0. Random "
+  "next sentences are drawn from the documents of the same shard.")
+
 
 def create_training_instances(input_files, tokenizer, max_seq_length,
                               dupe_factor, short_seq_prob, masked_lm_prob,
@@ -106,11 +119,7 @@ def create_training_instances(input_files, tokenizer, max_seq_length,
         if not line:
           all_documents.append([])
 
-        lattice_encoding = tokenization_labert.LatticeEncoding()
-        for span in line.split():
-          new_lattice_encoding = tokenizer.tokenize(span, add_candidate_indices=True)
-          lattice_encoding.extend(new_lattice_encoding)
-
+        lattice_encoding = tokenize_line(line, tokenizer)
         if len(lattice_encoding.tokens) > 0:
           all_documents[-1].append(lattice_encoding)
 
@@ -120,7 +129,27 @@ def create_training_instances(input_files, tokenizer, max_seq_length,
 
   tf.compat.v1.logging.info(f'Finished load {len(all_documents)} documents.')
 
-  vocab_words = list(tokenizer.vocab.keys())
+  for instance in create_instances_from_documents(all_documents, tokenizer, max_seq_length,
+                                                  dupe_factor, short_seq_prob, masked_lm_prob,
+                                                  max_predictions_per_seq, next_sentence_type, rng):
+    yield instance
+
+
+def tokenize_line(line, tokenizer):
+  """Lattice of a stripped input line, its whitespace separated spans are tokenized one by one."""
+  lattice_encoding = tokenization_labert.LatticeEncoding()
+  for span in line.split():
+    new_lattice_encoding = tokenizer.tokenize(span, add_candidate_indices=True)
+    lattice_encoding.extend(new_lattice_encoding)
+  return lattice_encoding
+
+
+def create_instances_from_documents(all_documents, tokenizer, max_seq_length,
+                                    dupe_factor, short_seq_prob, masked_lm_prob,
+                                    max_predictions_per_seq, next_sentence_type, rng):
+  """Create `TrainingInstance`s from tokenized documents."""
+  # `get_vocab()` of the wordpiece tokenizer has no stable order across processes
+  vocab_words = [word for word, _ in sorted(tokenizer.vocab.items(), key=lambda x: (x[1], x[0]))]
   for _ in range(dupe_factor):
     for document_index in range(len(all_documents)):
       for instance in create_instances_from_document(all_documents, document_index,
@@ -351,19 +380,144 @@ def truncate_seq_pair(encoding_a: LatticeEncoding,
   encoding_b.finalize_lazy_pop_back()
 
 
+def iter_documents(input_files):
+  """Stream the documents of the input files as lists of stripped lines."""
+  for input_file in input_files:
+    document = []
+    with tf.io.gfile.GFile(input_file, "r") as reader:
+      while True:
+        line = tokenization.convert_to_unicode(reader.readline())
+        if not line:
+          break
+        line = line.strip()
+
+        # Empty lines are used as document delimiters
+        if not line:
+          if document:
+            yield document
+          document = []
+        else:
+          document.append(line)
+    if document:
+      yield document
+
+
+def iter_shards(input_files, docs_per_shard):
+  """Group the streamed documents into shards of `docs_per_shard` documents."""
+  documents = []
+  for document in iter_documents(input_files):
+    documents.append(document)
+    if len(documents) == docs_per_shard:
+      yield documents
+      documents = []
+  if documents:
+    yield documents
+
+
+def shard_file_name(output_file, shard_index):
+  return "{}-{:05d}".format(output_file, shard_index)
+
+
+def build_tokenizer(use_named_lexicon, vocab_file, lexicon_file, do_lower_case):
+  if use_named_lexicon:
+    return tokenization_labert.LatticeTokenizerWithMapping(
+      vocab_file=vocab_file,
+      lexicon_file=lexicon_file,
+      do_lower_case=do_lower_case)
+  return tokenization_labert.LatticeTokenizer(
+    vocab_file=vocab_file,
+    lexicon_file=lexicon_file,
+    do_lower_case=do_lower_case)
+
+
+_shard_tokenizer = None
+
+
+def _init_shard_worker(tokenizer_args):
+  global _shard_tokenizer
+  _shard_tokenizer = build_tokenizer(*tokenizer_args)
+
+
+def build_shard(shard_index, documents, output_file, random_seed, max_seq_length,
+                dupe_factor, short_seq_prob, masked_lm_prob,
+                max_predictions_per_seq, next_sentence_type):
+  """
+  Tokenize the documents of one shard, create its instances and write them
+  to `shard_file_name(output_file, shard_index)`. The shard is seeded by
+  `random_seed` and its index only, so it does not depend on the number of
+  workers or on which of them builds it. It is written under a temporary
+  name and renamed once complete.
+  """
+  tokenizer = _shard_tokenizer
+  seed = random_seed + shard_index
+  np.random.seed(seed)
+  rng = random.Random(seed)
+
+  all_documents = []
+  for lines in documents:
+    document = []
+    for line in lines:
+      lattice_encoding = tokenize_line(line, tokenizer)
+      if len(lattice_encoding.tokens) > 0:
+        document.append(lattice_encoding)
+    if document:
+      all_documents.append(document)
+  rng.shuffle(all_documents)
+
+  shard_file = shard_file_name(output_file, shard_index)
+  total_written = 0
+  writer = tf.io.TFRecordWriter(shard_file + ".tmp")
+  for inst_index, instance in enumerate(
+      create_instances_from_documents(
+        all_documents, tokenizer, max_seq_length, dupe_factor,
+        short_seq_prob, masked_lm_prob, max_predictions_per_seq,
+        next_sentence_type, rng)):
+    write_lattice_instance_to_example_file(
+      instance, tokenizer, writer,
+      max_seq_length, max_predictions_per_seq,
+      position_embedding_names=('start', 'end'),
+      do_dump_example=shard_index == 0 and inst_index < 20)
+    total_written += 1
+  writer.close()
+  tf.io.gfile.rename(shard_file + ".tmp", shard_file, overwrite=True)
+  return total_written
+
+
+def create_sharded_training_data(input_files, output_file, tokenizer_args, num_workers,
+                                 docs_per_shard, random_seed, *instance_args):
+  """
+  Build the shards of `output_file` in a pool of `num_workers` processes,
+  each holding one tokenizer. Input documents are streamed and at most
+  2 * num_workers shards are in flight, so memory does not grow with the
+  corpus. Shards found on disk are skipped.
+  """
+  pool = multiprocessing.Pool(num_workers, initializer=_init_shard_worker, initargs=(tokenizer_args,))
+  pending = collections.deque()
+  total_written = 0
+  num_shards = num_skipped = 0
+  for shard_index, documents in enumerate(iter_shards(input_files, docs_per_shard)):
+    num_shards += 1
+    if tf.io.gfile.exists(shard_file_name(output_file, shard_index)):
+      num_skipped += 1
+      continue
+    pending.append(pool.apply_async(
+      build_shard, (shard_index, documents, output_file, random_seed) + tuple(instance_args)))
+    while len(pending) >= 2 * num_workers:
+      total_written += pending.popleft().get()
+  while pending:
+    total_written += pending.popleft().get()
+  pool.close()
+  pool.join()
+
+  tf.compat.v1.logging.info("Wrote %d total instances to %d shards, %d shards existed already",
+                            total_written, num_shards - num_skipped, num_skipped)
+
+
 def main_func(_):
   tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.INFO)
 
-  if FLAGS.use_named_lexicon:
-    tokenizer = tokenization_labert.LatticeTokenizerWithMapping(
-      vocab_file=FLAGS.vocab_file,
-      lexicon_file=FLAGS.lexicon_file,
-      do_lower_case=FLAGS.do_lower_case)
-  else:
-    tokenizer = tokenization_labert.LatticeTokenizer(
-      vocab_file=FLAGS.vocab_file,
-      lexicon_file=FLAGS.lexicon_file,
-      do_lower_case=FLAGS.do_lower_case)
+  tokenizer_args = (FLAGS.use_named_lexicon, FLAGS.vocab_file,
+                    FLAGS.lexicon_file, FLAGS.do_lower_case)
 
   input_files = []
   for input_pattern in FLAGS.input_file.split(","):
@@ -373,6 +527,17 @@ def main_func(_):
   for input_file in input_files:
     tf.compat.v1.logging.info("  %s", input_file)
 
+  if FLAGS.num_workers > 0:
+    tf.compat.v1.logging.info(f"*** Writing to output shards {FLAGS.output_file}-* ***")
+    create_sharded_training_data(
+      input_files, FLAGS.output_file, tokenizer_args, FLAGS.num_workers,
+      FLAGS.docs_per_shard, FLAGS.random_seed, FLAGS.max_seq_length,
+      FLAGS.dupe_factor, FLAGS.short_seq_prob, FLAGS.masked_lm_prob,
+      FLAGS.max_predictions_per_seq, FLAGS.next_sentence_type)
+    return
+
+  tokenizer = build_tokenizer(*tokenizer_args)
+
   np.random.seed(FLAGS.random_seed)
   rng = random.Random(FLAGS.random_seed)
 
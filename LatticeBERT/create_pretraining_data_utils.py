@@ -82,7 +82,7 @@ def write_lattice_instance_to_example_file(
 
   tf_example = tf.train.Example(features=tf.train.Features(feature=features))
 
-  writer.write(tf_example.SerializeToString())
+  writer.write(tf_example.SerializeToString(deterministic=True))
 
   if do_dump_example:
     tf.compat.v1.logging.info("*** Example ***")
@@ -17,10 +17,8 @@
 from typing import List
 from dataclasses import dataclass, field
 from tokenizers import BertWordPieceTokenizer
-from pygtrie import StringTrie
 from tokenization import convert_by_vocab
 import copy
-import igraph
 import tensorflow as tf
 import bisect
 
@@ -164,6 +162,63 @@ class LatticeEncoding(object):
     return retval
 
 
+class LexiconTrie(object):
+  """
+  Trie over wordpiece ids. Node `child` of `node` through id `i` is stored
+  under the integer key `node * stride + i` of a single dict, which keeps a
+  lexicon of millions of entries cheap in memory.
+  """
+
+  def __init__(self, stride):
+    self.stride = stride
+    self.children = {}
+    self.values = {}
+    self.num_nodes = 1
+
+  def __len__(self):
+    return len(self.values)
+
+  def __setitem__(self, ids, value):
+    node = 0
+    for i in ids:
+      key = node * self.stride + i
+      child = self.children.get(key)
+      if child is None:
+        child = self.children[key] = self.num_nodes
+        self.num_nodes += 1
+      node = child
+    self.values[node] = value
+
+  def prefixes(self, ids, start):
+    """Values of the non-empty entries that are prefixes of ids[start:], shortest first."""
+    children, values, stride = self.children, self.values, self.stride
+    node = 0
+    for i in range(start, len(ids)):
+      node = children.get(node * stride + ids[i])
+      if node is None:
+        return
+      if node in values:
+        yield values[node]
+
+
+def find_boundaries(n_vertices, positions, lengths):
+  """
+  Interior vertices of the lattice that every path from 0 to n_vertices goes
+  through, i.e. that no edge (position, position + length) jumps over.
+  """
+  furthest = [0] * (n_vertices + 1)
+  for position, length in zip(positions, lengths):
+    furthest[position] = max(furthest[position], position + length)
+
+  boundaries = []
+  reach = furthest[0]
+  for n in range(1, n_vertices):
+    if reach <= n:
+      boundaries.append(n)
+    reach = max(reach, furthest[n])
+  return boundaries
+
+
 class LatticeTokenizer(object):
   kDelimiter = '\u0001'
 
@@ -172,20 +227,19 @@ class LatticeTokenizer(object):
                lexicon_file,
                do_lower_case):
     self.bert_tokenizer = BertWordPieceTokenizer(vocab_file, lowercase=do_lower_case)
-    self.lexicon = StringTrie(separator=self.kDelimiter)
+    self.lexicon = LexiconTrie(self.bert_tokenizer.get_vocab_size())
 
     self.vocab = copy.copy(self.bert_tokenizer.get_vocab())
     # absent -> ab #sent
-    # key = ab\u0001#sent
+    # key = ids of [ab, #sent]
     # zzz -> z #z #z
     # lexicon = {zzz}
     # vocab = {z, #z}
     with open(lexicon_file, 'r') as reader:
       for lid, line in enumerate(reader):
         output = self.bert_tokenizer.encode(line, add_special_tokens=False)
-        key = self.kDelimiter.join(output.tokens)
         name = line.strip()
-        self.lexicon[key] = (name, len(output.tokens))
+        self.lexicon[output.ids] = (name, len(output.tokens))
         self.vocab[name] = len(self.vocab)
 
     tf.compat.v1.logging.info(f"number of lexicon entries: {len(self.lexicon)}")
@@ -214,8 +268,8 @@ class LatticeTokenizer(object):
     output = self.bert_tokenizer.encode(text, add_special_tokens=False)
     payload = [(token, index, 1) for index, token in enumerate(output.tokens)]
 
-    for i in range(len(output.tokens)):
-      for key, (name, length) in self.lexicon.prefixes(self.kDelimiter.join(output.tokens[i:])):
+    for i in range(len(output.ids)):
+      for name, length in self.lexicon.prefixes(output.ids, i):
         payload.append((name, i, length))
 
     tokens = []
@@ -227,26 +281,7 @@ class LatticeTokenizer(object):
       lengths.append(length)
 
     if add_candidate_indices:
-      n_vertices = len(output.tokens)
-
-      graph = igraph.Graph(n=n_vertices + 1,
-                           edges=[(position, position + length) for (position, length) in zip(positions, lengths)],
-                           directed=True)
-      boundaries = []
-      s, t = 0, n_vertices
-      for n in range(1, n_vertices):
-        edges = []
-        edges.extend(
-          [(neighbor, n) for neighbor in graph.predecessors(n)])
-        edges.extend(
-          [(n, neighbor) for neighbor in graph.successors(n)])
-        graph.delete_edges(edges)
-        path_length = graph.shortest_paths(s, t)[0][0]
-        if path_length == float("inf"):
-          boundaries.append(n)
-        graph.add_edges(edges)
-
-      boundaries.sort()
+      boundaries = find_boundaries(len(output.tokens), positions, lengths)
       boundaries = boundaries + [len(tokens)]
       cand_indices = [[] for _ in boundaries]
       for index, (position, length) in enumerate(zip(positions, lengths)):
@@ -283,12 +318,12 @@ class LatticeTokenizerWithMapping(object):
                lexicon_file,
                do_lower_case):
     self.bert_tokenizer = BertWordPieceTokenizer(vocab_file, lowercase=do_lower_case)
-    self.lexicon = StringTrie(separator=self.kDelimiter)
+    self.lexicon = LexiconTrie(self.bert_tokenizer.get_vocab_size())
 
     offset = self.bert_tokenizer.get_vocab_size()
     self.vocab = copy.copy(self.bert_tokenizer.get_vocab())
     # absent -> ab #sent
-    # key = ab\u0001#sent
+    # key = ids of [ab, #sent]
     # zzz -> z #z #z
     # lexicon = {zzz}
     # vocab = {z, #z}
@@ -305,8 +340,7 @@ class LatticeTokenizerWithMapping(object):
       for line in reader:
         fields = line.strip().split('\t')
         output = self.bert_tokenizer.encode(fields[0], add_special_tokens=False)
-        key = self.kDelimiter.join(output.tokens)
-        self.lexicon[key] = fields[-1], len(output.tokens)
+        self.lexicon[output.ids] = fields[-1], len(output.tokens)
         self.vocab[fields[-1]] = unique_lexicon_entry_to_ids[fields[-1]] + offset
 
     # inverse is impossible.
@@ -334,8 +368,8 @@ class LatticeTokenizerWithMapping(object):
     output = self.bert_tokenizer.encode(text, add_special_tokens=False)
     payload = [(token, index, 1) for index, token in enumerate(output.tokens)]
 
-    for i in range(len(output.tokens)):
-      for key, (name, length) in self.lexicon.prefixes(self.kDelimiter.join(output.tokens[i:])):
+    for i in range(len(output.ids)):
+      for name, length in self.lexicon.prefixes(output.ids, i):
         payload.append((name, i, length))
 
     tokens = []
@@ -347,26 +381,7 @@ class LatticeTokenizerWithMapping(object):
       lengths.append(length)
 
     if add_candidate_indices:
-      n_vertices = len(output.tokens)
-
-      graph = igraph.Graph(n=n_vertices + 1,
-                           edges=[(position, position + length) for (position, length) in zip(positions, lengths)],
-                           directed=True)
-      boundaries = []
-      s, t = 0, n_vertices
-      for n in range(1, n_vertices):
-        edges = []
-        edges.extend(
-          [(neighbor, n) for neighbor in graph.predecessors(n)])
-        edges.extend(
-          [(n, neighbor) for neighbor in graph.successors(n)])
-        graph.delete_edges(edges)
-        path_length = graph.shortest_paths(s, t)[0][0]
-        if path_length == float("inf"):
-          boundaries.append(n)
-        graph.add_edges(edges)
-
-      boundaries.sort()
+      boundaries = find_boundaries(len(output.tokens), positions, lengths)
       boundaries = boundaries + [len(tokens)]
       cand_indices = [[] for _ in boundaries]
       for index, (position, length) in enumerate(zip(positions, lengths)):
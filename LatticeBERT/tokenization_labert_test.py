@@ -68,6 +68,13 @@ class TokenizationLaBertTest(tf.test.TestCase):
     #self.assertAllEqual(
     #    tokenizer.convert_tokens_to_ids(tokens), [7, 4, 5, 10, 8, 9])
 
+  def test_find_boundaries(self):
+    # 0 -a- 1 -b- 2 -c- 3 -d- 4, and the word "bc" jumps over vertex 2
+    positions = [0, 1, 1, 2, 3]
+    lengths = [1, 1, 2, 1, 1]
+    self.assertAllEqual(tokenization_labert.find_boundaries(4, positions, lengths), [1, 3])
+    self.assertAllEqual(tokenization_labert.find_boundaries(4, [0, 0], [4, 1]), [])
+
   def test_full_tokenizer2(self):
 
     tokenizer = tokenization_labert.LatticeTokenizer(
@@ -0,0 +1,77 @@
+"""Microbenchmark for HDF5Dataset loading throughput.
+
+Writes a synthetic pretraining file in the `pretrain_data_pth` layout (one
+`str(index)` entry per example holding the source and target ids) and
+reports samples/sec for reopening the file per sample, a persistent
+per-worker handle, and block prefetching, as `num_workers` varies.
+
+    python benchmark_hdf5_dataset.py -num_examples 20000 -num_workers 0 1 2 4 8
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+from torch.utils.data import DataLoader, RandomSampler
+
+from models.trainer import HDF5Dataset, HDF5BlockSampler, convert_instance_to_feature_hdf5
+
+
+class ReopenHDF5Dataset(HDF5Dataset):
+    """Previous behaviour: open and close the file for every sample."""
+
+    def __getitem__(self, index):
+        with h5py.File(self.input_file, 'r') as all_examples:
+            example_feature = all_examples[str(index)]
+            feature = convert_instance_to_feature_hdf5(example_feature)
+        return feature
+
+
+def write_examples(path, num_examples, src_len, tgt_len):
+    rng = np.random.RandomState(0)
+    with h5py.File(path, 'w') as examples:
+        for index in range(num_examples):
+            example = np.zeros((2, max(src_len, tgt_len)), dtype=np.int32)
+            example[0, :src_len] = rng.randint(1000, 21128, src_len)
+            example[1, :tgt_len] = rng.randint(1000, 21128, tgt_len)
+            examples.create_dataset(str(index), data=example)
+
+
+def collate(batch):
+    # Batch moves tensors to cuda; only build the padded tensors here.
+    return len(batch)
+
+
+def measure(dataset, sampler, batch_size, num_workers):
+    loader = DataLoader(dataset, sampler=sampler, batch_size=batch_size,
+                        num_workers=num_workers, collate_fn=collate)
+    start = time.time()
+    num_samples = sum(loader)
+    return num_samples / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-num_examples", default=20000, type=int)
+    parser.add_argument("-src_len", default=512, type=int)
+    parser.add_argument("-tgt_len", default=128, type=int)
+    parser.add_argument("-batch_size", default=32, type=int)
+    parser.add_argument("-num_workers", default=[0, 1, 2, 4, 8], type=int, nargs='+')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'examples.hdf5')
+    write_examples(path, args.num_examples, args.src_len, args.tgt_len)
+
+    print('num_workers  reopen  persistent  prefetch(samples/sec)')
+    for num_workers in args.num_workers:
+        reopen = ReopenHDF5Dataset(path, args.num_examples)
+        persistent = HDF5Dataset(path, args.num_examples)
+        prefetch = HDF5Dataset(path, args.num_examples, prefetch_size=args.batch_size)
+        print('{:11d}  {:6.0f}  {:10.0f}  {:8.0f}'.format(
+            num_workers,
+            measure(reopen, RandomSampler(reopen), args.batch_size, num_workers),
+            measure(persistent, RandomSampler(persistent), args.batch_size, num_workers),
+            measure(prefetch, HDF5BlockSampler(prefetch, args.batch_size), args.batch_size, num_workers)))
+    os.remove(path)
@@ -0,0 +1,96 @@
+"""Decode latency of trigram blocking versus output length.
+
+Runs the `_fast_translate_batch` beam search loop (without finished-batch
+bookkeeping) on a small random GRU decoder over a wordpiece-like vocabulary,
+once with the per-hypothesis Python check and once with `TrigramBlocker`,
+and checks that both produce the same hypotheses.
+
+    python benchmark_trigram_blocking.py -lengths 32 64 128 256
+"""
+import argparse
+import collections
+import time
+
+import torch
+import torch.nn as nn
+
+from translate.ngram_blocking import TrigramBlocker, trigram_blocked_reference, wordpiece_starts_word
+
+
+class RandomDecoder(nn.Module):
+    def __init__(self, vocab_size, hidden_size):
+        super(RandomDecoder, self).__init__()
+        self.embeddings = nn.Embedding(vocab_size, hidden_size)
+        self.cell = nn.GRUCell(hidden_size, hidden_size)
+        self.generator = nn.Linear(hidden_size, vocab_size)
+
+    def forward(self, tokens, state):
+        state = self.cell(self.embeddings(tokens), state)
+        return torch.log_softmax(self.generator(state), dim=-1), state
+
+
+def beam_search(decoder, vocab, batch_size, beam_size, max_length, hidden_size, tensorized):
+    rows = batch_size * beam_size
+    state = torch.zeros(rows, hidden_size)
+    alive_seq = torch.full([rows, 1], 1, dtype=torch.long)
+    topk_log_probs = torch.tensor([0.0] + [float("-inf")] * (beam_size - 1)).repeat(batch_size)
+    beam_offset = torch.arange(0, rows, step=beam_size, dtype=torch.long)
+    blocker = TrigramBlocker(wordpiece_starts_word(vocab.ids_to_tokens), alive_seq) if tensorized else None
+    for step in range(max_length):
+        log_probs, state = decoder(alive_seq[:, -1], state)
+        vocab_size = log_probs.size(-1)
+        log_probs += topk_log_probs.view(-1).unsqueeze(1)
+        length_penalty = ((5.0 + (step + 1)) / 6.0) ** 0.6
+        curr_scores = log_probs / length_penalty
+        if alive_seq.size(1) > 3:
+            if tensorized:
+                blocked = blocker.blocked()
+            else:
+                blocked = trigram_blocked_reference(alive_seq, vocab, 'bert')
+            curr_scores[blocked] = -10e20
+        curr_scores = curr_scores.reshape(-1, beam_size * vocab_size)
+        topk_scores, topk_ids = curr_scores.topk(beam_size, dim=-1)
+        topk_log_probs = topk_scores * length_penalty
+        topk_beam_index = topk_ids // vocab_size
+        topk_ids = topk_ids.fmod(vocab_size)
+        select_indices = (topk_beam_index + beam_offset.unsqueeze(1)).view(-1)
+        alive_seq = torch.cat([alive_seq.index_select(0, select_indices), topk_ids.view(-1, 1)], -1)
+        state = state.index_select(0, select_indices)
+        if tensorized:
+            blocker.advance(select_indices, topk_ids.view(-1))
+    return alive_seq
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-vocab_size", default=2000, type=int)
+    parser.add_argument("-hidden_size", default=64, type=int)
+    parser.add_argument("-batch_size", default=8, type=int)
+    parser.add_argument("-beam_size", default=5, type=int)
+    parser.add_argument("-lengths", default=[16, 32, 64, 128, 256], type=int, nargs='+')
+    parser.add_argument("-seed", default=666, type=int)
+    args = parser.parse_args()
+
+    # a third of the vocabulary are continuation wordpieces
+    tokens = ['[PAD]', '[CLS]'] + ['w{}'.format(i) for i in range(2, args.vocab_size)]
+    for i in range(2, args.vocab_size, 3):
+        tokens[i] = '##' + tokens[i]
+
+    class Vocab(object):
+        ids_to_tokens = collections.OrderedDict(enumerate(tokens))
+
+    torch.manual_seed(args.seed)
+    decoder = RandomDecoder(args.vocab_size, args.hidden_size).eval()
+
+    print('length  python(s)  tensorized(s)  speedup  identical')
+    with torch.no_grad():
+        for max_length in args.lengths:
+            timings, outputs = [], []
+            for tensorized in (False, True):
+                start = time.time()
+                outputs.append(beam_search(decoder, Vocab, args.batch_size, args.beam_size,
+                                           max_length, args.hidden_size, tensorized))
+                timings.append(time.time() - start)
+            print('{:6d}  {:9.3f}  {:13.3f}  {:7.1f}x  {}'.format(
+                max_length, timings[0], timings[1], timings[0] / timings[1],
+                torch.equal(outputs[0], outputs[1])))
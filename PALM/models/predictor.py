@@ -15,6 +15,7 @@ from tensorboardX import SummaryWriter
 
 from others.utils import rouge_results_to_str, test_rouge, tile
 from translate.beam import GNMTGlobalScorer
+from translate.ngram_blocking import TrigramBlocker, trigram_blocked_reference, wordpiece_starts_word
 
 
 def build_predictor(args, tokenizer, symbols, model, logger=None):
@@ -85,6 +86,11 @@ class Translator(object):
                 "scores": [],
                 "log_probs": []}
 
+    def _starts_word(self):
+        if not hasattr(self, '_starts_word_table'):
+            self._starts_word_table = wordpiece_starts_word(self.vocab.ids_to_tokens)
+        return self._starts_word_table
+
     def _build_target_tokens(self, pred):
         # vocab = self.fields["tgt"].vocab
         tokens = []
@@ -326,6 +332,11 @@ class Translator(object):
         results["gold_score"] = [0] * batch_size
         results["batch"] = batch
 
+        # Roberta words come from BPE decoding, so they keep the per-hypothesis check.
+        trigram_blocker = None
+        if self.args.block_trigram and self.args.encoder != "roberta":
+            trigram_blocker = TrigramBlocker(self._starts_word(), alive_seq)
+
         for step in range(max_length):
             decoder_input = alive_seq[:, -1].view(1, -1)
 
@@ -350,6 +361,14 @@ class Translator(object):
 
             alpha = self.global_scorer.alpha
             length_penalty = ((5.0 + (step + 1)) / 6.0) ** alpha
+
+            # Hypotheses whose last word trigram is a repeat are dropped.
+            blocked = None
+            if self.args.block_trigram and alive_seq.size(1) > 3:
+                if trigram_blocker is not None:
+                    blocked = trigram_blocker.blocked()
+                else:
+                    blocked = trigram_blocked_reference(alive_seq, self.vocab, self.args.encoder)
             #'''
             if self.args.sample_topk:
                 temperature = self.args.temperature
@@ -364,6 +383,8 @@ class Translator(object):
                 
                 _scores += topk_log_probs.view(-1).unsqueeze(1)
                 _scores = _scores / length_penalty
+                if blocked is not None:
+                    _scores[blocked] = -10e20
                 topk_scores = torch.gather(_scores, -1, topk_ids)  # (batch_size * num_beams, 2)
                 #log_probs +=   # (batch_size * num_beams, 2)
                 # Match shape of greedy beam search
@@ -372,29 +393,11 @@ class Translator(object):
             #'''
             else:
                 curr_scores = log_probs / length_penalty
+                if blocked is not None:
+                    curr_scores[blocked] = -10e20
 
                 curr_scores = curr_scores.reshape(-1, beam_size * vocab_size)
                 topk_scores, topk_ids = curr_scores.topk(beam_size, dim=-1)
-            if(self.args.block_trigram):
-                cur_len = alive_seq.size(1)
-                if(cur_len>3):
-                    for i in range(alive_seq.size(0)):
-                        fail = False
-                        words = [int(w) for w in alive_seq[i]]
-                        if self.args.encoder == "roberta":
-                            #words = [self.vocab.convert_ids_to_tokens[w] for w in words]
-                            words = self.vocab.decode(words).strip().split()
-                        else:
-                            words = [self.vocab.ids_to_tokens[w] for w in words]
-                            words = ' '.join(words).replace(' ##','').split()
-                        if(len(words)<=3):
-                            continue
-                        trigrams = [(words[i-1],words[i],words[i+1]) for i in range(1,len(words)-1)]
-                        trigram = tuple(trigrams[-1])
-                        if trigram in trigrams[:-1]:
-                            fail = True
-                        if fail:
-                            curr_scores[i] = -10e20
             # Recover log probs.
             topk_log_probs = topk_scores * length_penalty
 
@@ -412,6 +415,8 @@ class Translator(object):
             alive_seq = torch.cat(
                 [alive_seq.index_select(0, select_indices),
                  topk_ids.view(-1, 1)], -1)
+            if trigram_blocker is not None:
+                trigram_blocker.advance(select_indices, topk_ids.view(-1))
 
             is_finished = topk_ids.eq(self.end_token)
             if step + 1 == max_length:
@@ -454,6 +459,10 @@ class Translator(object):
                 batch_offset = batch_offset.index_select(0, non_finished)
                 alive_seq = predictions.index_select(0, non_finished) \
                     .view(-1, alive_seq.size(-1))
+                if trigram_blocker is not None:
+                    trigram_blocker.index_select(
+                        (non_finished.unsqueeze(1) * beam_size
+                         + torch.arange(beam_size, device=device)).view(-1))
             # Reorder states.
             select_indices = batch_index.view(-1)
             src_features = src_features.index_select(0, select_indices)
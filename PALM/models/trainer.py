@@ -7,7 +7,7 @@ import h5py
 
 import distributed
 from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
-                              TensorDataset, Dataset)
+                              TensorDataset, Dataset, Sampler)
 from models.reporter import ReportMgr, Statistics
 from others.logging import logger
 from others.utils import test_rouge, rouge_results_to_str
@@ -32,20 +32,78 @@ def convert_instance_to_feature_hdf5(example):
     feature['eos_index'] = [102, 0]
     return feature
 class HDF5Dataset(Dataset):
-    """HDF5 dataset"""
+    """HDF5 dataset
 
-    def __init__(self, input_file, total_example_num):
+    The file is opened lazily once per DataLoader worker and the handle is
+    reused for every sample. With `prefetch_size` > 0, a miss reads the whole
+    block of `prefetch_size` consecutive examples containing `index` into an
+    in-worker buffer; use it with `HDF5BlockSampler` so that each block is
+    consumed before moving on.
+    """
+
+    def __init__(self, input_file, total_example_num, prefetch_size=0):
         self.input_file = input_file
         self.total_example_num = total_example_num
+        self.prefetch_size = prefetch_size
+        self._examples = None
+        self._pid = None
+        self._block_id = None
+        self._block = None
 
     def __len__(self):
         return self.total_example_num
 
+    def __getstate__(self):
+        # h5py handles can not be pickled into DataLoader workers.
+        state = self.__dict__.copy()
+        state.update(_examples=None, _pid=None, _block_id=None, _block=None)
+        return state
+
+    @property
+    def examples(self):
+        if self._examples is None or self._pid != os.getpid():
+            self._examples = h5py.File(self.input_file, 'r')
+            self._pid = os.getpid()
+        return self._examples
+
+    def _read(self, index):
+        return self.examples[str(index)][()]
+
     def __getitem__(self, index):
-        with h5py.File(self.input_file, 'r') as all_examples:
-            example_feature = all_examples[str(index)]
-            feature = convert_instance_to_feature_hdf5(example_feature)
-        return feature
+        if self.prefetch_size > 0:
+            block_id = index // self.prefetch_size
+            if block_id != self._block_id:
+                start = block_id * self.prefetch_size
+                end = min(start + self.prefetch_size, self.total_example_num)
+                self._block = [self._read(i) for i in range(start, end)]
+                self._block_id = block_id
+            example_feature = self._block[index - block_id * self.prefetch_size]
+        else:
+            example_feature = self._read(index)
+        return convert_instance_to_feature_hdf5(example_feature)
+
+
+class HDF5BlockSampler(Sampler):
+    """Random order over blocks of `block_size` consecutive examples, shuffled
+    within each block, so `HDF5Dataset` prefetching reads every block once.
+    Use a `block_size` that is a multiple of the batch size so each DataLoader
+    worker owns whole blocks."""
+
+    def __init__(self, data_source, block_size):
+        self.data_source = data_source
+        self.block_size = block_size
+
+    def __len__(self):
+        return len(self.data_source)
+
+    def __iter__(self):
+        num_examples = len(self.data_source)
+        num_blocks = (num_examples + self.block_size - 1) // self.block_size
+        for block_id in torch.randperm(num_blocks).tolist():
+            start = block_id * self.block_size
+            end = min(start + self.block_size, num_examples)
+            for offset in torch.randperm(end - start).tolist():
+                yield start + offset
 class Batch(object):
     def __init__(self, src, tgt, mask_src, mask_tgt):
         self.src = src.to("cuda")
@@ -170,8 +228,12 @@ class Trainer(object):
         normalization = 0
         with h5py.File(hdf5_save_path, 'r') as examples:
             total_example_num = len(examples)
-        train_data = HDF5Dataset(hdf5_save_path, total_example_num=total_example_num)
-        train_sampler = RandomSampler(train_data)
+        train_data = HDF5Dataset(hdf5_save_path, total_example_num=total_example_num,
+                                 prefetch_size=self.args.hdf5_prefetch_size)
+        if self.args.hdf5_prefetch_size > 0:
+            train_sampler = HDF5BlockSampler(train_data, self.args.hdf5_prefetch_size)
+        else:
+            train_sampler = RandomSampler(train_data)
         train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=self.args.batch_size, num_workers=0,
                                       collate_fn=batchify, drop_last=len(train_data) % self.args.batch_size == 1)
         train_steps = len(train_dataloader) / self.args.batch_size / self.grad_accum_count * self.args.num_epoch
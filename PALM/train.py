@@ -34,6 +34,7 @@ if __name__ == '__main__':
     parser.add_argument("-pretrain", type=str2bool, default=False)
     parser.add_argument("-data_path", default='../bert_data_new/cnndm')
     parser.add_argument("-pretrain_data_pth", default='*.hdf5')
+    parser.add_argument("-hdf5_prefetch_size", default=0, type=int)
     parser.add_argument("-model_path", default='../models/')
     parser.add_argument("-result_path", default='results')
     parser.add_argument("-temp_dir", default='./log')
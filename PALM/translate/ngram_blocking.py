@@ -0,0 +1,104 @@
+""" Word-level trigram blocking for batched beam search """
+import torch
+
+# Words are hashed with two independent polynomial hashes modulo a 31-bit
+# prime and packed into one int64 key, so the incremental update never
+# overflows and collisions are negligible.
+_MODULUS = 2147483647
+_BASES = (1000003, 19260817)
+
+
+def wordpiece_starts_word(ids_to_tokens):
+    """Bool tensor telling for every id whether its wordpiece begins a new word."""
+    starts_word = torch.ones(max(ids_to_tokens) + 1, dtype=torch.bool)
+    for idx, token in ids_to_tokens.items():
+        starts_word[idx] = not token.startswith('##')
+    return starts_word
+
+
+def trigram_blocked_reference(alive_seq, vocab, encoder):
+    """Per-hypothesis Python check: is the last word trigram a repeat?
+
+    Words are rebuilt from the ids (wordpieces merged, or the roberta
+    decoding split on whitespace) and every trigram is rescanned.
+    """
+    blocked = []
+    for i in range(alive_seq.size(0)):
+        words = [int(w) for w in alive_seq[i]]
+        if encoder == "roberta":
+            words = vocab.decode(words).strip().split()
+        else:
+            words = [vocab.ids_to_tokens[w] for w in words]
+            words = ' '.join(words).replace(' ##', '').split()
+        if len(words) <= 3:
+            blocked.append(False)
+            continue
+        trigrams = [(words[j - 1], words[j], words[j + 1]) for j in range(1, len(words) - 1)]
+        blocked.append(tuple(trigrams[-1]) in trigrams[:-1])
+    return torch.tensor(blocked, dtype=torch.bool, device=alive_seq.device)
+
+
+class TrigramBlocker(object):
+    """
+    Incremental, tensorized equivalent of `trigram_blocked_reference` for
+    wordpiece vocabularies.
+
+    For every hypothesis it keeps the keys of its last three words (the last
+    one possibly still growing), and the history of all trigrams made of
+    complete words. Each decoding step appends one token to every row with
+    a few tensor ops and `blocked` compares the current trigram against the
+    whole history at once. Rows follow the beam through `index_select`.
+
+    Args:
+       starts_word (torch.BoolTensor): `[vocab]`, see `wordpiece_starts_word`
+       alive_seq (torch.LongTensor): `[batch * beam, len]` initial hypotheses
+    """
+
+    def __init__(self, starts_word, alive_seq):
+        device = alive_seq.device
+        rows = alive_seq.size(0)
+        self.starts_word = starts_word.to(device)
+        self.hashes = torch.zeros(rows, len(_BASES), dtype=torch.long, device=device)
+        self.bases = torch.tensor(_BASES, dtype=torch.long, device=device)
+        self.words = torch.full((rows, 3), -1, dtype=torch.long, device=device)
+        self.num_words = torch.zeros(rows, dtype=torch.long, device=device)
+        self.history = torch.empty(rows, 0, 3, dtype=torch.long, device=device)
+        self.history_mask = torch.empty(rows, 0, dtype=torch.bool, device=device)
+        for step in range(alive_seq.size(1)):
+            self.append(alive_seq[:, step])
+
+    def append(self, tokens):
+        """Extend every hypothesis by one token, `tokens` is `[rows]`."""
+        in_vocab = tokens < self.starts_word.size(0)
+        new_word = ~in_vocab | (self.num_words == 0)
+        new_word |= self.starts_word[tokens.clamp(max=self.starts_word.size(0) - 1)] & in_vocab
+
+        # The trigram ending in the previous word is complete once a new word starts.
+        complete = new_word & (self.num_words >= 3)
+        self.history = torch.cat([self.history, self.words.unsqueeze(1)], 1)
+        self.history_mask = torch.cat([self.history_mask, complete.unsqueeze(1)], 1)
+
+        shifted = torch.cat([self.words[:, 1:], self.words[:, -1:]], 1)
+        self.words = torch.where(new_word.unsqueeze(1), shifted, self.words)
+        self.hashes = self.hashes.masked_fill(new_word.unsqueeze(1), 0)
+        self.hashes = (self.hashes * self.bases + tokens.unsqueeze(1) + 1) % _MODULUS
+        self.words[:, -1] = self.hashes[:, 0] * _MODULUS + self.hashes[:, 1]
+        self.num_words += new_word.long()
+
+    def index_select(self, index):
+        """Keep and reorder hypotheses like `alive_seq.index_select(0, index)`."""
+        self.hashes = self.hashes.index_select(0, index)
+        self.words = self.words.index_select(0, index)
+        self.num_words = self.num_words.index_select(0, index)
+        self.history = self.history.index_select(0, index)
+        self.history_mask = self.history_mask.index_select(0, index)
+
+    def advance(self, select_indices, tokens):
+        """Follow one beam search step: reorder to the chosen beams, then append."""
+        self.index_select(select_indices)
+        self.append(tokens)
+
+    def blocked(self):
+        """`[rows]` bool, True where the last word trigram already occurred."""
+        repeated = (self.history == self.words.unsqueeze(1)).all(-1) & self.history_mask
+        return repeated.any(1) & (self.num_words > 3)
@@ -0,0 +1,108 @@
+# coding=utf-8
+# Copyright (c) 2019, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark PLUG decoding with and without the decoder key/value cache.
+
+Runs a tiny random-weight PLUG on CPU (single process, model parallel
+size 1) and reports tokens/sec for greedy decoding that re-runs the whole
+prefix at every step versus feeding only the new token.
+
+    python benchmark_generate.py --gen-length 512
+"""
+
+import argparse
+import os
+import time
+
+import torch
+
+import mpu
+from model.modeling import BertConfig
+from model.modeling import PalmForPreTraining
+
+
+def initialize_single_process():
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29511')
+    torch.distributed.init_process_group(backend='gloo', world_size=1, rank=0)
+    mpu.initialize_model_parallel(1)
+
+
+def decode(model, input_ids, attention_mask, gen_length, use_cache):
+    """Greedy decode `gen_length` tokens, mirroring `generate_samples`."""
+    decoder = model.decoder
+    with torch.no_grad():
+        sequence_output, _ = model.bert(input_ids, None, attention_mask,
+                                        output_all_encoded_layers=False)
+        dec_input_ids = torch.full([input_ids.size(0), 1], 101, dtype=torch.long)
+        past_key_values = None
+        for _ in range(gen_length):
+            if use_cache:
+                decode_output, past_key_values = decoder(
+                    model.bert.embeddings, sequence_output, dec_input_ids[:, -1:],
+                    enc_attn_mask=attention_mask, is_infer=True,
+                    past_key_values=past_key_values, use_cache=True)
+            else:
+                decode_output = decoder(
+                    model.bert.embeddings, sequence_output, dec_input_ids,
+                    enc_attn_mask=attention_mask, is_infer=True)
+            logits = torch.nn.functional.linear(
+                decode_output[:, -1], model.bert.embeddings.word_embeddings.weight)
+            prev = logits.argmax(dim=-1, keepdim=True)
+            dec_input_ids = torch.cat([dec_input_ids, prev], dim=1)
+    return dec_input_ids
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hidden-size', type=int, default=256)
+    parser.add_argument('--num-attention-heads', type=int, default=8)
+    parser.add_argument('--num-layers', type=int, default=2)
+    parser.add_argument('--dec-layers', type=int, default=6)
+    parser.add_argument('--vocab-size', type=int, default=21128)
+    parser.add_argument('--input-length', type=int, default=512)
+    parser.add_argument('--gen-length', type=int, default=512)
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args()
+
+    initialize_single_process()
+    torch.manual_seed(args.seed)
+    config = BertConfig(args.vocab_size,
+                        hidden_size=args.hidden_size,
+                        num_hidden_layers=args.num_layers,
+                        num_attention_heads=args.num_attention_heads,
+                        intermediate_size=4 * args.hidden_size,
+                        max_position_embeddings=2048,
+                        type_vocab_size=3,
+                        dec_hidden_layers=args.dec_layers)
+    model = PalmForPreTraining(config)
+    model.eval()
+
+    input_ids = torch.randint(1000, args.vocab_size, (1, args.input_length))
+    attention_mask = torch.ones_like(input_ids)
+
+    outputs = {}
+    for use_cache in (False, True):
+        start = time.time()
+        outputs[use_cache] = decode(model, input_ids, attention_mask,
+                                    args.gen_length, use_cache)
+        elapsed = time.time() - start
+        print('use_cache={:<5} {:4d} tokens in {:7.2f}s: {:8.2f} tokens/sec'.format(
+            str(use_cache), args.gen_length, elapsed, args.gen_length / elapsed))
+    print('outputs identical: {}'.format(torch.equal(outputs[False], outputs[True])))
+
+
+if __name__ == '__main__':
+    main()
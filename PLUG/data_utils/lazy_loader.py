@@ -17,10 +17,17 @@ import os
 import mmap
 import pickle as pkl
 import time
-from itertools import accumulate
 
+import numpy as np
 import torch
-from torch.multiprocessing import Lock
+
+# Byte offsets are stored as a flat little-endian int64 array of length
+# num_entries + 1 (starting at 0), so they can be appended while streaming
+# and memory mapped without parsing.
+OFFSETS_DTYPE = np.dtype('<i8')
+OFFSETS_SUFFIX = '.idx'
+LEGACY_LENS_SUFFIX = '.len.pkl'
+_WRITE_CHUNK = 1 << 16
 
 def get_lazy_path(path):
     """
@@ -31,40 +38,89 @@ def get_lazy_path(path):
 def exists_lazy(path, data_type='data'):
     """
     Check if we've already made a lazy version of this file for the `data_type` field.
+    Both the offsets index and the legacy `.len.pkl` lengths file are accepted.
     """
     if not os.path.exists(get_lazy_path(path)):
         return False
     contents = os.listdir(get_lazy_path(path))
     if data_type not in contents:
         return False
-    if data_type+'.len.pkl' not in contents:
+    if data_type+OFFSETS_SUFFIX not in contents and data_type+LEGACY_LENS_SUFFIX not in contents:
         return False
     return True
 
+def _tmp_path(path):
+    return '{}.tmp{}'.format(path, os.getpid())
+
+def _stream_offsets(f, lens):
+    """
+    Stream byte lengths `lens` as offsets into the open file `f`.
+    """
+    end = 0
+    chunk = [0]
+    for str_len in lens:
+        end += str_len
+        chunk.append(end)
+        if len(chunk) >= _WRITE_CHUNK:
+            np.asarray(chunk, dtype=OFFSETS_DTYPE).tofile(f)
+            chunk = []
+    np.asarray(chunk, dtype=OFFSETS_DTYPE).tofile(f)
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+def _write_offsets(offsets_path, lens):
+    """
+    Stream byte lengths `lens` into an offsets index at `offsets_path`. The file is
+    written under a temporary name and renamed so readers never see a partial index.
+    """
+    tmp_path = _tmp_path(offsets_path)
+    with open(tmp_path, 'wb') as f:
+        _stream_offsets(f, lens)
+        _sync(f)
+    os.replace(tmp_path, offsets_path)
+
+def convert_lazy(path, data_type='data'):
+    """
+    Convert the legacy pickled `.len.pkl` lengths of `data_type` into the offsets index.
+    """
+    lazypath = get_lazy_path(path)
+    lenpath = os.path.join(lazypath, data_type+LEGACY_LENS_SUFFIX)
+    offsets_path = os.path.join(lazypath, data_type+OFFSETS_SUFFIX)
+    with open(lenpath, 'rb') as f:
+        lens = pkl.load(f)
+    _write_offsets(offsets_path, lens)
+    return offsets_path
+
 def make_lazy(path, strs, data_type='data'):
     """
     Make lazy version of `data_type` field of the file. Byte offsets
-    corresponding to data indices are stored in a `.len.pkl` data file.
+    corresponding to data indices are streamed into a `.idx` offsets file.
     """
     lazypath = get_lazy_path(path)
     if not os.path.exists(lazypath):
         os.makedirs(lazypath)
     datapath = os.path.join(lazypath, data_type)
-    lenpath = os.path.join(lazypath, data_type+'.len.pkl')
+    offsets_path = os.path.join(lazypath, data_type+OFFSETS_SUFFIX)
     if not torch.distributed.is_initialized() or torch.distributed.get_rank() == 0:
-        with open(datapath, 'wb') as f:
-            str_lens = []
-            str_cnt = 0
-            for s in strs:
-                if isinstance(s, dict):
-                    s = s['text']
-                encoded = s.encode('utf-8')
-                f.write(encoded)
-                str_cnt = len(encoded)
-                str_lens.append(str_cnt)
-        pkl.dump(str_lens, open(lenpath, 'wb'))
+        data_tmp, offsets_tmp = _tmp_path(datapath), _tmp_path(offsets_path)
+        with open(data_tmp, 'wb') as f, open(offsets_tmp, 'wb') as offsets_f:
+            def encoded_lens():
+                for s in strs:
+                    if isinstance(s, dict):
+                        s = s['text']
+                    encoded = s.encode('utf-8')
+                    f.write(encoded)
+                    yield len(encoded)
+            _stream_offsets(offsets_f, encoded_lens())
+            _sync(f)
+            _sync(offsets_f)
+        # the other ranks wait for the index, so the complete data file is renamed into place first
+        os.replace(data_tmp, datapath)
+        os.replace(offsets_tmp, offsets_path)
     else:
-        while not os.path.exists(lenpath):
+        while not os.path.exists(offsets_path):
             time.sleep(1)
 
 def split_strings(strings, start, chr_lens):
@@ -93,39 +149,63 @@ class lazy_array_loader(object):
     """
     Arguments:
         path: path to directory where array entries are concatenated into one big string file
-            and the .len file are located
+            and the .idx file are located
         data_type (str): Some datsets have multiple fields that are stored in different paths.
             `data_type` specifies which of these fields to load in this class
-        mem_map  (boolean): Specifies whether to memory map file `path`
+        mem_map  (boolean): Kept for compatibility. The data file is always memory mapped
+            read-only, so reads are stateless slices that need no lock or seek and
+            scale with the number of DataLoader workers.
         map_fn (callable): Fetched strings are passed through map_fn before being returned.
 
     Example of lazy loader directory structure:
     file.json
     file.lazy/
         data_type1
-        data_type1.len.pkl
+        data_type1.idx
         data_type2
-        data_type2.len.pkl
+        data_type2.idx
+
+    Directories written in the legacy `.len.pkl` format are converted on first load.
     """
     def __init__(self, path, data_type='data', mem_map=False, map_fn=None):
         lazypath = get_lazy_path(path)
-        datapath = os.path.join(lazypath, data_type)
-        #get file where array entries are concatenated into one big string
-        self._file = open(datapath, 'rb')
-        self.file = self._file
-        #memory map file if necessary
+        self.datapath = os.path.join(lazypath, data_type)
+        self.offsets_path = os.path.join(lazypath, data_type+OFFSETS_SUFFIX)
+        if not os.path.exists(self.offsets_path):
+            convert_lazy(path, data_type)
         self.mem_map = mem_map
-        if self.mem_map:
-            self.file = mmap.mmap(self.file.fileno(), 0, prot=mmap.PROT_READ)
-        lenpath = os.path.join(lazypath, data_type+'.len.pkl')
-        self.lens = pkl.load(open(lenpath, 'rb'))
-        self.ends = list(accumulate(self.lens))
-        self.dumb_ends = list(self.ends)
-        self.read_lock = Lock()
+        self._open()
         self.process_fn = map_fn
         self.map_fn = map_fn
         self._tokenizer = None
 
+    def _open(self):
+        self.offsets = np.memmap(self.offsets_path, dtype=OFFSETS_DTYPE, mode='r')
+        #get file where array entries are concatenated into one big string
+        with open(self.datapath, 'rb') as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                self.file = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+            else:
+                self.file = b''
+
+    def __getstate__(self):
+        # mmaps are reopened rather than pickled when sent to worker processes
+        state = self.__dict__.copy()
+        del state['offsets'], state['file']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    @property
+    def ends(self):
+        return self.offsets[1:]
+
+    @property
+    def lens(self):
+        return np.diff(self.offsets)
+
     def SetTokenizer(self, tokenizer):
         """
         logic to set and remove (set to None) tokenizer.
@@ -143,53 +223,46 @@ class lazy_array_loader(object):
 
     def __getitem__(self, index):
         """
-        read file and splice strings based on string ending array `self.ends`
+        read file and splice strings based on the byte offsets array `self.offsets`
         """
         if not isinstance(index, slice):
-            if index == 0:
-                start = 0
-            else:
-                start = self.ends[index-1]
-            end = self.ends[index]
+            if index < 0:
+                index += len(self)
+            start = int(self.offsets[index])
+            end = int(self.offsets[index+1])
             rtn = self.file_read(start, end)
             if self.map_fn is not None:
                 return self.map_fn(rtn)
         else:
-            # if slice, fetch strings with 1 diskread and then splice in memory
-            chr_lens = self.ends[index]
-            if index.start == 0 or index.start is None:
-                start = 0
-            else:
-                start = self.ends[index.start-1]
-            stop = chr_lens[-1]
-            strings = self.file_read(start, stop)
-            rtn = split_strings(strings, start, chr_lens)
+            # if slice, fetch strings with 1 read and then splice in memory
+            indices = range(*index.indices(len(self)))
+            first = min(indices) if indices else 0
+            last = max(indices) if indices else -1
+            bounds = self.offsets[first:last+2].tolist()
+            # split the raw bytes before decoding, offsets are byte positions
+            chunk = self.file[bounds[0]:bounds[-1]]
+            strings = [s.decode('utf-8', 'ignore') for s in split_strings(chunk, bounds[0], bounds[1:])]
+            rtn = [strings[i-first] for i in indices]
             if self.map_fn is not None:
                 return self.map_fn([s for s in rtn])
         return rtn
 
     def __len__(self):
-        return len(self.ends)
+        return len(self.offsets) - 1
 
     def file_read(self, start=0, end=None):
         """read specified portion of file"""
-
-        # atomic reads to avoid race conditions with multiprocess dataloader
-        self.read_lock.acquire()
-        # seek to start of file read
-        self.file.seek(start)
-        # read to end of file if no end point provided
+        # slicing the read-only mmap does not move any shared file position,
+        # so concurrent readers need no lock
         if end is None:
-            rtn = self.file.read()
-        #else read amount needed to reach end point
-        else:
-            rtn = self.file.read(end-start)
-        self.read_lock.release()
-        #TODO: @raulp figure out mem map byte string bug
-        #if mem map'd need to decode byte string to string
-        rtn = rtn.decode('utf-8', 'ignore')
-        # rtn = str(rtn)
-        if self.mem_map:
-            rtn = rtn.decode('unicode_escape')
-        return rtn
+            end = len(self.file)
+        return self.file[start:end].decode('utf-8', 'ignore')
 
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert lazy loader `.len.pkl` lengths into `.idx` offsets.')
+    parser.add_argument('path', help='original data file whose `.lazy` directory should be converted')
+    parser.add_argument('--data-types', nargs='+', default=['data'])
+    args = parser.parse_args()
+    for data_type in args.data_types:
+        print('wrote {}'.format(convert_lazy(args.path, data_type)))
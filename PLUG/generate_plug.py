@@ -165,9 +165,8 @@ def top_k_logits(logits, top_k=0, top_p=0.0, filter_value=-float('Inf')):
         logits[indices_to_remove] = filter_value
         
     if top_p > 0.0:
-        #convert to 1D
-        logits=logits.view(logits.size()[1]).contiguous()
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        # works row-wise on [batch_size, vocab_size] logits
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
         cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
 
         # Remove tokens with cumulative probability above the threshold
@@ -175,14 +174,23 @@ def top_k_logits(logits, top_k=0, top_p=0.0, filter_value=-float('Inf')):
         # Shift the indices to the right to keep also the first token above the threshold
         sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
         sorted_indices_to_remove[..., 0] = 0
-        indices_to_remove = sorted_indices[sorted_indices_to_remove]
+        # map the sorted mask back to vocabulary order
+        indices_to_remove = sorted_indices_to_remove.scatter(-1, sorted_indices, sorted_indices_to_remove)
         logits[indices_to_remove] = filter_value
-        #going back to 2D
-        logits=logits.view(1, -1).contiguous()
 	
     return logits
 
-def generate_samples(model, tokenizer, args, device, length, passage):
+def detokenize(tokenizer, generate_tokens):
+    """Convert generated ids to text, collapsing runs of [UNK]."""
+    generate_context = []
+    for token in generate_tokens:
+        if generate_context and generate_context[-1] == 100 and token == 100:
+            continue
+        else:
+            generate_context.append(token)
+    return "".join(tokenizer.convert_ids_to_tokens(generate_context)).replace('[UNK]', '“').replace('##','')
+
+def generate_samples(model, tokenizer, args, device, length, passage, use_cache=True):
 
     context_count=0
     model.eval()
@@ -245,10 +253,16 @@ def generate_samples(model, tokenizer, args, device, length, passage):
                     tokens, attention_mask, types, dec_input_ids = get_batch(context_tokens_tensor, device, args)
                     generate_tokens = []
                     sequence_output = None
+                    past_key_values = None
 
                 # sequence_output, _ = model.module.module.module.model.bert(tokens, types, attention_mask) 
                 position_ids = torch.full([args.batch_size, 1], len(generate_tokens), dtype=torch.long, device=device)
-                _, logits, sequence_output = model(tokens, types, attention_mask, dec_input_ids, attention_mask, position_ids, is_infer=True, sequence_output=sequence_output, parallel_output=False)
+                if use_cache:
+                    # past_key_values always covers dec_input_ids[:, :-1], so only the last
+                    # token is fed; it is advanced only when a token is actually appended.
+                    _, logits, sequence_output, presents = model(tokens, types, attention_mask, dec_input_ids[:, -1:], attention_mask, position_ids, is_infer=True, sequence_output=sequence_output, parallel_output=False, past_key_values=past_key_values, use_cache=True)
+                else:
+                    _, logits, sequence_output = model(tokens, types, attention_mask, dec_input_ids, attention_mask, position_ids, is_infer=True, sequence_output=sequence_output, parallel_output=False)
 
                 partition_vocab_size = logits.size()[-1]
 
@@ -270,18 +284,13 @@ def generate_samples(model, tokenizer, args, device, length, passage):
                 #    counter += 1
                 #    continue
                 dec_input_ids = torch.cat([dec_input_ids, prev], dim=1)
+                if use_cache:
+                    past_key_values = presents
                 generate_tokens.append(prev_token)
                 all_generate_tokens.append(prev_token)
                 counter += 1
 
-            generate_context = []
-            for token in all_generate_tokens:
-                if generate_context and generate_context[-1] == 100 and token == 100:
-                    continue
-                else:
-                    generate_context.append(token)
-            generate_context = "".join(tokenizer.convert_ids_to_tokens(generate_context)).replace('[UNK]', '“').replace('##','')
-            return generate_context
+            return detokenize(tokenizer, all_generate_tokens)
             raw_text = None
 
             torch.distributed.barrier(group=mpu.get_model_parallel_group())
@@ -55,10 +55,12 @@ class PalmModel(torch.nn.Module):
             self.model = PalmForPreTraining(self.config)
 
     def forward(self, input_tokens, token_type_ids=None,
-                attention_mask=None, target_tokens=None, position_ids=None, decode_attention_mask=None, checkpoint_activations=False, is_infer=False, sequence_output=None, parallel_output=True):
+                attention_mask=None, target_tokens=None, position_ids=None, decode_attention_mask=None, checkpoint_activations=False, is_infer=False, sequence_output=None, parallel_output=True,
+                past_key_values=None, use_cache=False):
         return self.model(
             input_tokens, token_type_ids, attention_mask, target_tokens, position_ids, 
-            decode_attention_mask, checkpoint_activations=checkpoint_activations, is_infer=is_infer, sequence_output=sequence_output, parallel_output=parallel_output)
+            decode_attention_mask, checkpoint_activations=checkpoint_activations, is_infer=is_infer, sequence_output=sequence_output, parallel_output=parallel_output,
+            past_key_values=past_key_values, use_cache=use_cache)
 
     def state_dict(self, destination=None, prefix='', keep_vars=False):
         return self.model.state_dict(destination=destination, prefix=prefix,
@@ -1180,13 +1180,18 @@ class DecodeLayer(nn.Module):
         
 
     #def forward(self, hidden_states, enc_attn_mask, dec_attn_mask):
-    def forward(self, hidden_states, enc_hidden_states, enc_attn_mask, dec_attn_mask, is_infer=False):
+    def forward(self, hidden_states, enc_hidden_states, enc_attn_mask, dec_attn_mask, is_infer=False, layer_past=None, use_cache=False):
+        # layer_past: optional (self_attn_past, cross_attn_past) from the previous decoding step.
+        self_attn_past, cross_attn_past = layer_past if layer_past is not None else (None, None)
         residual = hidden_states
         previous_type = hidden_states.type()
         hidden_states = self.input_layernorm(self.type_converter(hidden_states))
         if self.fp32_layernorm:
             hidden_states = hidden_states.type(previous_type)
-        hidden_states = self.attention(hidden_states, dec_attn_mask, is_infer=is_infer)
+        hidden_states = self.attention(hidden_states, dec_attn_mask, is_infer=is_infer,
+                                       layer_past=self_attn_past, use_cache=use_cache)
+        if use_cache:
+            hidden_states, self_attn_present = hidden_states
         # add dropout?
         # hidden_states = self.dropout(hidden_states)
         hidden_states = residual + hidden_states
@@ -1196,7 +1201,10 @@ class DecodeLayer(nn.Module):
         if self.fp32_layernorm:
             # same to the output of BertAttention
             hidden_states = hidden_states.type(previous_type)
-        hidden_states = self.cross_attention(hidden_states, enc_hidden_states, enc_attn_mask)
+        hidden_states = self.cross_attention(hidden_states, enc_hidden_states, enc_attn_mask,
+                                             layer_past=cross_attn_past, use_cache=use_cache)
+        if use_cache:
+            hidden_states, cross_attn_present = hidden_states
         # hidden_states = self.dropout(hidden_states)
         hidden_states = residual + hidden_states
         residual = hidden_states
@@ -1210,7 +1218,9 @@ class DecodeLayer(nn.Module):
         hidden_states = self.output(hidden_states)
         hidden_states = self.dropout(hidden_states)
         hidden_states = residual + hidden_states
-        
+
+        if use_cache:
+            return hidden_states, (self_attn_present, cross_attn_present)
         return hidden_states
 
 class BertDecoder(nn.Module):
@@ -1232,8 +1242,9 @@ class BertDecoder(nn.Module):
     #     if not output_all_encoded_layers:
     #         all_encoder_layers.append(hidden_states)
     #     return all_encoder_layers
-    def forward(self, hidden_states, enc_hidden_states, enc_attn_mask, dec_attn_mask, checkpoint_activations=False, output_all_encoded_layers=False, is_infer=False):
+    def forward(self, hidden_states, enc_hidden_states, enc_attn_mask, dec_attn_mask, checkpoint_activations=False, output_all_encoded_layers=False, is_infer=False, past_key_values=None, use_cache=False):
         all_encoder_layers = []
+        presents = [] if use_cache else None
         def custom(start, end):
             def custom_forward(*inputs):
                 layers = self.layer[start:end]
@@ -1247,7 +1258,7 @@ class BertDecoder(nn.Module):
         #pre_enc_hidden = copy.deepcopy(enc_hidden_states)
         pre_enc_hidden= enc_hidden_states.data
         #pre_enc_hidden= enc_hidden_states.clone()
-        if checkpoint_activations:
+        if checkpoint_activations and not use_cache:
             l = 0
             num_layers = len(self.layer)
             chunk_length = 1 #math.ceil(math.sqrt(num_layers))
@@ -1261,7 +1272,12 @@ class BertDecoder(nn.Module):
             # decoder layers
         else:
             for i,layer_module in enumerate(self.layer):
-                hidden_states = layer_module(hidden_states, enc_hidden_states, enc_attn_mask, dec_attn_mask, is_infer=is_infer)
+                layer_past = past_key_values[i] if past_key_values is not None else None
+                hidden_states = layer_module(hidden_states, enc_hidden_states, enc_attn_mask, dec_attn_mask, is_infer=is_infer,
+                                             layer_past=layer_past, use_cache=use_cache)
+                if use_cache:
+                    hidden_states, present = hidden_states
+                    presents.append(present)
 
         
         previous_type = hidden_states.type()
@@ -1270,7 +1286,9 @@ class BertDecoder(nn.Module):
         hidden_states = self.final_layernorm(hidden_states)
         if self.fp32_layernorm:
             hidden_states = hidden_states.type(previous_type)
-        
+
+        if use_cache:
+            return [hidden_states], presents
         return [hidden_states]
 
 class DecodeModel(PreTrainedBertModel):
@@ -1323,19 +1341,32 @@ class DecodeModel(PreTrainedBertModel):
         self.decoder = BertDecoder(config)
         self.apply(self.init_bert_weights)
 
-    def forward(self, embeddings, sequence_output, decode_input_ids, position_ids=None, enc_attn_mask=None, dec_attn_mask=None, checkpoint_activations=False, is_infer=False):
+    def forward(self, embeddings, sequence_output, decode_input_ids, position_ids=None, enc_attn_mask=None, dec_attn_mask=None, checkpoint_activations=False, is_infer=False, past_key_values=None, use_cache=False):
 
         extended_attention_mask = enc_attn_mask.unsqueeze(1).unsqueeze(2)
         extended_attention_mask = extended_attention_mask.to(dtype=next(self.decoder.parameters()).dtype) # fp16 compatibility
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
 
-        embedding_output = embeddings(decode_input_ids)
+        if past_key_values is not None:
+            # Only the new tokens are fed, so offset their positions by the cached prefix length.
+            past_length = past_key_values[0][0][0].size(-2)
+            dec_position_ids = torch.arange(past_length, past_length + decode_input_ids.size(1),
+                                            dtype=torch.long, device=decode_input_ids.device)
+            dec_position_ids = dec_position_ids.unsqueeze(0).expand_as(decode_input_ids)
+            embedding_output = embeddings(decode_input_ids, position_ids=dec_position_ids)
+        else:
+            embedding_output = embeddings(decode_input_ids)
         sequence_output = self.decoder(embedding_output,
                                       sequence_output,
                                       extended_attention_mask,
                                       dec_attn_mask,
                                       checkpoint_activations=checkpoint_activations,
-                                      is_infer=is_infer)
+                                      is_infer=is_infer,
+                                      past_key_values=past_key_values,
+                                      use_cache=use_cache)
+        if use_cache:
+            sequence_output, presents = sequence_output
+            return sequence_output[-1], presents
         return sequence_output[-1]
 
 class PalmForPreTraining(PreTrainedBertModel):
@@ -1395,7 +1426,7 @@ class PalmForPreTraining(PreTrainedBertModel):
         self.decoder = DecodeModel(config)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, decode_input_ids=None, position_ids=None, decode_attention_mask=None, lm_labels=None, checkpoint_activations=False, is_infer=False, sequence_output=None, parallel_output=True):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, decode_input_ids=None, position_ids=None, decode_attention_mask=None, lm_labels=None, checkpoint_activations=False, is_infer=False, sequence_output=None, parallel_output=True, past_key_values=None, use_cache=False):
         if sequence_output is None:
             sequence_output, pooled_output = self.bert(input_ids, token_type_ids, attention_mask,
                                                    output_all_encoded_layers=False, checkpoint_activations=checkpoint_activations)
@@ -1406,7 +1437,9 @@ class PalmForPreTraining(PreTrainedBertModel):
             sequence_output = sequence_output.half()
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
-        decode_output = self.decoder(self.bert.embeddings, sequence_output, decode_input_ids, position_ids, attention_mask, decode_attention_mask, checkpoint_activations=checkpoint_activations, is_infer=is_infer)
+        decode_output = self.decoder(self.bert.embeddings, sequence_output, decode_input_ids, position_ids, attention_mask, decode_attention_mask, checkpoint_activations=checkpoint_activations, is_infer=is_infer, past_key_values=past_key_values, use_cache=use_cache)
+        if use_cache:
+            decode_output, presents = decode_output
 
         #prediction_scores = self.cls(decode_output)
         
@@ -1419,6 +1452,8 @@ class PalmForPreTraining(PreTrainedBertModel):
         if parallel_output:
             return prediction_scores, logits_parallel
         if is_infer:
+            if use_cache:
+                return prediction_scores, mpu.gather_from_model_parallel_region(logits_parallel), sequence_output, presents
             return prediction_scores, mpu.gather_from_model_parallel_region(logits_parallel), sequence_output
         return prediction_scores, mpu.gather_from_model_parallel_region(logits_parallel)
 
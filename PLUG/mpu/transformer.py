@@ -109,9 +109,12 @@ class GPT2ParallelSelfAttention(torch.nn.Module):
         tensor = tensor.view(*new_tensor_shape)
         return tensor.permute(0, 2, 1, 3)
 
-    def forward(self, hidden_states, ltor_mask, is_infer=False):
+    def forward(self, hidden_states, ltor_mask, is_infer=False,
+                layer_past=None, use_cache=False):
         # hidden_states: [b, s, h]
         # ltor_mask: [1, 1, s, s]
+        # layer_past: optional (key, value) of the already decoded prefix,
+        #             each [b, np, s_past, hn] on this partition.
 
         # Attention heads. [b, s, hp]
         tgt_len = hidden_states.size(1)
@@ -124,9 +127,16 @@ class GPT2ParallelSelfAttention(torch.nn.Module):
         query_layer = self._transpose_for_scores(mixed_query_layer)
         key_layer = self._transpose_for_scores(mixed_key_layer)
         value_layer = self._transpose_for_scores(mixed_value_layer)
-        
+
         previous_type = value_layer.type()
 
+        # Prepend the cached prefix. [b, np, s_past + s, hn]
+        if layer_past is not None:
+            past_key, past_value = layer_past
+            key_layer = torch.cat((past_key.type(previous_type), key_layer), dim=-2)
+            value_layer = torch.cat((past_value.type(previous_type), value_layer), dim=-2)
+        present = (key_layer, value_layer) if use_cache else None
+
         # Raw attention scores. [b, np, s, s]
         attention_scores = torch.matmul(query_layer,
                                         key_layer.transpose(-1, -2))
@@ -134,9 +144,11 @@ class GPT2ParallelSelfAttention(torch.nn.Module):
             self.hidden_size_per_attention_head)
         # Apply the left to right attention mask.
         if is_infer:
+            # Queries are the last tgt_len positions of the src_len keys.
             src_len = key_layer.size(2)
             ltor_mask = torch.tril(torch.ones(
-                        (1, tgt_len, src_len), device=hidden_states.device)).view(1, 1, tgt_len, src_len).type(previous_type)
+                        (1, tgt_len, src_len), device=hidden_states.device),
+                        diagonal=src_len - tgt_len).view(1, 1, tgt_len, src_len).type(previous_type)
         attention_scores = torch.mul(attention_scores, ltor_mask) - \
                            10000.0 * (1.0 - ltor_mask)
 
@@ -144,8 +156,11 @@ class GPT2ParallelSelfAttention(torch.nn.Module):
         attention_probs = torch.nn.Softmax(dim=-1)(attention_scores)
         # This is actually dropping out entire tokens to attend to, which might
         # seem a bit unusual, but is taken from the original Transformer paper.
-        with get_cuda_rng_tracker().fork():
-            attention_probs = self.attention_dropout(attention_probs)
+        # Dropout is the identity in eval mode, so skip the rng fork (it
+        # also lets inference run without CUDA).
+        if self.training:
+            with get_cuda_rng_tracker().fork():
+                attention_probs = self.attention_dropout(attention_probs)
 
         # Context layer.
         # [b, np, s, hn]
@@ -161,6 +176,8 @@ class GPT2ParallelSelfAttention(torch.nn.Module):
         output = self.dense(context_layer)
         output = self.output_dropout(output)
 
+        if use_cache:
+            return output, present
         return output
 
 
@@ -521,8 +538,11 @@ class BertParallelSelfAttention(torch.nn.Module):
         attention_probs = torch.nn.Softmax(dim=-1)(attention_scores)
         # This is actually dropping out entire tokens to attend to, which might
         # seem a bit unusual, but is taken from the original Transformer paper.
-        with get_cuda_rng_tracker().fork():
-            attention_probs = self.dropout(attention_probs)
+        # Dropout is the identity in eval mode, so skip the rng fork (it
+        # also lets inference run without CUDA).
+        if self.training:
+            with get_cuda_rng_tracker().fork():
+                attention_probs = self.dropout(attention_probs)
 
         # Context layer.
         # [b, np, s, hn]
@@ -849,21 +869,32 @@ class PalmParallelCrossAttention(torch.nn.Module):
         tensor = tensor.view(*new_tensor_shape)
         return tensor.permute(0, 2, 1, 3)
 
-    def forward(self, query, enc_hidden_states, enc_attn_mask):
+    def forward(self, query, enc_hidden_states, enc_attn_mask,
+                layer_past=None, use_cache=False):
         # hidden_states: [b, s, h]
         # ltor_mask: [1, 1, s, s]
+        # layer_past: optional projected encoder (key, value), each
+        #             [b, np, s_enc, hn]; the encoder output is fixed during
+        #             decoding so it is only projected once.
 
         # Attention heads. [b, s, hp]
         mixed_query_layer = self.query(query)
-        #print_rank_0(enc_hidden_states.size())
-        mixed_x_layer = self.key_value(enc_hidden_states)
-        (mixed_key_layer,
-         mixed_value_layer) = split_tensor_along_last_dim(mixed_x_layer, 2)
-
-        # Reshape and transpose [b, np, s, hn]
         query_layer = self._transpose_for_scores(mixed_query_layer)
-        key_layer = self._transpose_for_scores(mixed_key_layer)
-        value_layer = self._transpose_for_scores(mixed_value_layer)
+
+        if layer_past is not None:
+            key_layer, value_layer = layer_past
+            key_layer = key_layer.type(query_layer.type())
+            value_layer = value_layer.type(query_layer.type())
+        else:
+            #print_rank_0(enc_hidden_states.size())
+            mixed_x_layer = self.key_value(enc_hidden_states)
+            (mixed_key_layer,
+             mixed_value_layer) = split_tensor_along_last_dim(mixed_x_layer, 2)
+
+            # Reshape and transpose [b, np, s, hn]
+            key_layer = self._transpose_for_scores(mixed_key_layer)
+            value_layer = self._transpose_for_scores(mixed_value_layer)
+        present = (key_layer, value_layer) if use_cache else None
 
         # Raw attention scores. [b, np, s, s]
         attention_scores = torch.matmul(query_layer,
@@ -877,8 +908,11 @@ class PalmParallelCrossAttention(torch.nn.Module):
         
         # This is actually dropping out entire tokens to attend to, which might
         # seem a bit unusual, but is taken from the original Transformer paper.
-        with get_cuda_rng_tracker().fork():
-            attention_probs = self.attention_dropout(attention_probs)
+        # Dropout is the identity in eval mode, so skip the rng fork (it
+        # also lets inference run without CUDA).
+        if self.training:
+            with get_cuda_rng_tracker().fork():
+                attention_probs = self.attention_dropout(attention_probs)
 
         # Context layer.
         # [b, np, s, hn]
@@ -894,4 +928,6 @@ class PalmParallelCrossAttention(torch.nn.Module):
         output = self.dense(context_layer)
         output = self.output_dropout(output)
 
+        if use_cache:
+            return output, present
         return output
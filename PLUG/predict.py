@@ -1,7 +1,10 @@
+import threading
 import torch
+import mpu
 from utils import print_rank_0
 from generate_plug import get_model_tokenizer
 from generate_plug import generate_samples
+from serving import PlugServingEngine
 
 class predict_plug(object):
     
@@ -12,6 +15,7 @@ class predict_plug(object):
         self.model = model
         self.tokenizer = tokenizer
         self.args = args
+        self.engine = None
         print('================= init end =====================')
 
     def process(self, data):
@@ -22,6 +26,30 @@ class predict_plug(object):
         generate_passage = generate_samples(self.model, self.tokenizer, self.args, torch.cuda.current_device(), length, passage)
         return {'generage_passage': generate_passage}
 
+    def start_engine(self, max_batch_size=8):
+        # Batched serving: on model parallel rank 0 the engine runs in a background
+        # thread and `process_batch` may be called concurrently; the other ranks
+        # block here following rank 0's batches, and only return once
+        # `stop_engine` has been called on rank 0.
+        self.engine = PlugServingEngine(self.model, self.tokenizer, self.args,
+                                        torch.cuda.current_device(), max_batch_size=max_batch_size)
+        if mpu.get_model_parallel_rank() == 0:
+            self.engine_thread = threading.Thread(target=self.engine.serve_forever, daemon=True)
+            self.engine_thread.start()
+        else:
+            self.engine.serve_forever()
+
+    def stop_engine(self):
+        # only rank 0 takes requests; the other ranks already returned from `start_engine`
+        if mpu.get_model_parallel_rank() == 0:
+            self.engine.stop()
+            self.engine_thread.join()
+
+    def process_batch(self, data_list):
+        # data_list: list of {'passage': str, 'length': int}
+        futures = [self.engine.submit(data) for data in data_list]
+        return [{'generage_passage': future.result()} for future in futures]
+
 if __name__ == '__main__':
     data = {'passage': '段誉轻挥折扇，摇了摇头，说', 'length': 512}
     plug = predict_plug()
@@ -0,0 +1,279 @@
+# coding=utf-8
+# Copyright (c) 2019, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batched multi-request serving engine for PLUG generation."""
+
+import queue
+from concurrent.futures import Future
+
+import torch
+import torch.nn.functional as F
+
+import mpu
+from generate_plug import detokenize
+from generate_plug import top_k_logits
+
+
+class PlugServingEngine(object):
+    """Decodes many `{'passage', 'length'}` requests together.
+
+    Requests are queued with `submit`, which returns a `Future` resolving to
+    the generated text. `serve_forever` pads up to `max_batch_size` waiting
+    requests into one batch, runs the encoder once, and decodes all of them
+    in lockstep with the decoder key/value cache. A sequence leaves the batch
+    (and its future is resolved) as soon as it finishes, and the remaining
+    rows keep decoding.
+
+    Every model parallel rank must call `serve_forever`; requests are only
+    accepted on the source rank and each batch is broadcast once to the
+    other ranks of the group.
+
+    A batch that fails (e.g. out of memory) fails the futures of its
+    unfinished requests and serving goes on with the next batch; a request
+    whose passage cannot be encoded fails on its own. If the engine itself
+    dies, the queued requests are failed as well.
+
+    Generation follows `generate_samples`: [SEP] ends a sequence once more
+    than 80% of its requested length has been produced, and every
+    `context_length` tokens the generated window is appended to the encoder
+    input and decoding restarts from [CLS]. Since all rows have to advance
+    together, an early [SEP] is masked out of the distribution instead of
+    being sampled and skipped.
+    """
+
+    def __init__(self, model, tokenizer, args, device, max_batch_size=8,
+                 input_length=512, context_length=128):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.args = args
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.input_length = input_length
+        self.context_length = context_length
+        self.pad_id = 0
+        self.cls_id = tokenizer.vocab[args.cls_token]
+        self.sep_id = tokenizer.vocab[args.sep_token]
+        self.unk_id = tokenizer.vocab['[UNK]']
+        self.vocab_size = len(tokenizer.vocab)
+        self.requests = queue.Queue()
+        # set when `serve_forever` died, new requests fail right away
+        self.error = None
+        self._batch = []
+
+    def submit(self, data):
+        """Queue a `{'passage': str, 'length': int}` request."""
+        future = Future()
+        self.requests.put((data, future))
+        if self.error is not None:
+            self._fail_queued(self.error)
+        return future
+
+    def stop(self):
+        """Finish the queued requests and make `serve_forever` return."""
+        self.requests.put(None)
+
+    def serve_forever(self):
+        is_src = mpu.get_model_parallel_rank() == 0
+        try:
+            self._serve(is_src)
+        except Exception as e:
+            # the engine is gone: fail the waiting requests instead of leaving them unresolved
+            self.error = e
+            if is_src:
+                for _, future in self._batch:
+                    if not future.done():
+                        future.set_exception(e)
+                self._fail_queued(e)
+            raise
+
+    def _serve(self, is_src):
+        with torch.no_grad():
+            self.model.eval()
+            while True:
+                if is_src:
+                    batch, terminate = self._next_batch()
+                    self._batch = batch
+                    batch, contexts = self._encode_batch(batch)
+                    header = torch.tensor([len(batch), int(terminate)],
+                                          dtype=torch.long, device=self.device)
+                else:
+                    header = torch.zeros(2, dtype=torch.long, device=self.device)
+                torch.distributed.broadcast(header, mpu.get_model_parallel_src_rank(),
+                                            group=mpu.get_model_parallel_group())
+                batch_size, terminate = header.tolist()
+
+                if batch_size > 0:
+                    if is_src:
+                        contexts = torch.tensor(contexts, dtype=torch.long, device=self.device)
+                        lengths = torch.tensor([max(1, data['length']) for data, _ in batch],
+                                               dtype=torch.long, device=self.device)
+                    else:
+                        contexts = torch.zeros(batch_size, self.input_length,
+                                               dtype=torch.long, device=self.device)
+                        lengths = torch.zeros(batch_size, dtype=torch.long, device=self.device)
+                    torch.distributed.broadcast(contexts, mpu.get_model_parallel_src_rank(),
+                                                group=mpu.get_model_parallel_group())
+                    torch.distributed.broadcast(lengths, mpu.get_model_parallel_src_rank(),
+                                                group=mpu.get_model_parallel_group())
+
+                    error = None
+                    try:
+                        for index, generate_tokens in self.generate_batch(contexts, lengths.tolist()):
+                            if is_src:
+                                batch[index][1].set_result(detokenize(self.tokenizer, generate_tokens))
+                    except Exception as e:
+                        error = e
+                    # every rank learns whether the batch failed anywhere, so all of them
+                    # drop it and meet again at the next header broadcast
+                    failed = torch.tensor([int(error is not None)], dtype=torch.long, device=self.device)
+                    torch.distributed.all_reduce(failed, op=torch.distributed.ReduceOp.MAX,
+                                                 group=mpu.get_model_parallel_group())
+                    if failed.item():
+                        if error is None:
+                            error = RuntimeError('generation failed on another model parallel rank')
+                        if is_src:
+                            for _, future in batch:
+                                if not future.done():
+                                    future.set_exception(error)
+                        if torch.cuda.is_available():
+                            torch.cuda.empty_cache()
+                if terminate:
+                    return
+
+    def _encode_batch(self, batch):
+        """Encode the passages of `batch`, failing the requests that cannot be encoded."""
+        encoded, contexts = [], []
+        for data, future in batch:
+            try:
+                contexts.append(self._encode_passage(data['passage']))
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                encoded.append((data, future))
+        return encoded, contexts
+
+    def _fail_queued(self, error):
+        while True:
+            try:
+                item = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                item[1].set_exception(error)
+
+    def _next_batch(self):
+        """Block for one request, then take whatever else is already waiting."""
+        batch = []
+        item = self.requests.get()
+        while item is not None:
+            batch.append(item)
+            if len(batch) == self.max_batch_size:
+                return batch, False
+            try:
+                item = self.requests.get_nowait()
+            except queue.Empty:
+                return batch, False
+        return batch, True
+
+    def _encode_passage(self, passage):
+        raw_text = passage.replace('‘', '\'').replace('“', '\"').replace('——', '--')
+        context_tokens = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(raw_text))
+        if len(context_tokens) > self.input_length - 2:
+            context_tokens = context_tokens[len(context_tokens) - self.input_length + 2:]
+        context_tokens = [self.cls_id] + context_tokens + [self.sep_id]
+        return context_tokens + [self.pad_id] * (self.input_length - len(context_tokens))
+
+    def _rollover(self, context_tokens, window):
+        """Replace the context's [SEP] by the generated window plus [SEP]."""
+        start = context_tokens.index(self.sep_id)
+        context_tokens = (context_tokens[:start] + window + [self.sep_id])[-self.input_length:]
+        return context_tokens + [self.pad_id] * (self.input_length - len(context_tokens))
+
+    def _get_batch(self, contexts):
+        attention_mask = (contexts != self.pad_id).long()
+        types = torch.zeros_like(contexts)
+        dec_input_ids = torch.full([contexts.size(0), 1], self.cls_id,
+                                   dtype=torch.long, device=contexts.device)
+        return contexts, attention_mask, types, dec_input_ids
+
+    @staticmethod
+    def _reorder_cache(past_key_values, index):
+        return [tuple(tuple(t.index_select(0, index) for t in kv) for kv in layer_past)
+                for layer_past in past_key_values]
+
+    def generate_batch(self, contexts, lengths):
+        """Decode a padded [batch_size, input_length] batch of contexts.
+
+        Yields `(index, generate_tokens)` for each row as soon as it is done.
+        """
+        args = self.args
+        # original batch index of every row still being decoded
+        active = list(range(contexts.size(0)))
+        generated = [[] for _ in active]
+        window = [[] for _ in active]
+        max_lengths = torch.tensor(lengths, dtype=torch.long, device=contexts.device)
+        min_lengths = (max_lengths.float() * 0.8).long()
+
+        tokens, attention_mask, types, dec_input_ids = self._get_batch(contexts)
+        sequence_output = None
+        past_key_values = None
+        counter = 0
+        while active:
+            if counter % self.context_length == 0 and counter != 0:
+                contexts = torch.tensor(
+                    [self._rollover(row, window[index])
+                     for row, index in zip(tokens.tolist(), active)],
+                    dtype=torch.long, device=tokens.device)
+                tokens, attention_mask, types, dec_input_ids = self._get_batch(contexts)
+                window = [[] for _ in window]
+                sequence_output = None
+                past_key_values = None
+
+            _, logits, sequence_output, presents = self.model(
+                tokens, types, attention_mask, dec_input_ids[:, -1:], None, attention_mask,
+                is_infer=True, sequence_output=sequence_output, parallel_output=False,
+                past_key_values=past_key_values, use_cache=True)
+
+            logits = logits[:, -1, :] / args.temperature
+            logits[min_lengths >= counter, self.sep_id] = -float('Inf')
+            logits = top_k_logits(logits, top_k=args.top_k, top_p=args.top_p)
+            prev = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
+            prev[prev >= self.vocab_size] = self.unk_id
+            dec_input_ids = torch.cat([dec_input_ids, prev], dim=1)
+            past_key_values = presents
+            counter += 1
+
+            keep = []
+            for row, (index, token) in enumerate(zip(active, prev.view(-1).tolist())):
+                if token != self.sep_id:
+                    generated[index].append(token)
+                    window[index].append(token)
+                if token == self.sep_id or len(generated[index]) >= lengths[index]:
+                    yield index, generated[index]
+                else:
+                    keep.append(row)
+
+            if len(keep) < len(active):
+                active = [active[row] for row in keep]
+                if not active:
+                    break
+                keep = torch.tensor(keep, dtype=torch.long, device=tokens.device)
+                tokens = tokens.index_select(0, keep)
+                types = types.index_select(0, keep)
+                attention_mask = attention_mask.index_select(0, keep)
+                dec_input_ids = dec_input_ids.index_select(0, keep)
+                sequence_output = sequence_output.index_select(0, keep)
+                min_lengths = min_lengths.index_select(0, keep)
+                past_key_values = self._reorder_cache(past_key_values, keep)
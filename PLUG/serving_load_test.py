@@ -0,0 +1,116 @@
+# coding=utf-8
+# Copyright (c) 2019, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local load test for `PlugServingEngine`.
+
+Builds a tiny random-weight PLUG on CPU with a generated character
+vocabulary, fires concurrent requests at the engine for several
+`max_batch_size` values and reports requests/sec and tokens/sec.
+
+    python serving_load_test.py --num-requests 32 --batch-sizes 1 4 16
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import torch
+
+import mpu
+from benchmark_generate import initialize_single_process
+from data_utils.wordpiece import BertTokenizer
+from model.modeling import BertConfig
+from model.modeling import PalmForPreTraining
+from serving import PlugServingEngine
+
+
+def build_tokenizer(vocab_size):
+    """Write a BERT-style vocabulary ([PAD]=0, [UNK]=100, [CLS]=101, [SEP]=102)."""
+    tokens = ['[PAD]'] + ['[unused{}]'.format(i) for i in range(1, 100)] + \
+             ['[UNK]', '[CLS]', '[SEP]', '[MASK]']
+    tokens += [chr(0x4e00 + i) for i in range(vocab_size - len(tokens))]
+    vocab_file = os.path.join(tempfile.mkdtemp(), 'vocab.txt')
+    with open(vocab_file, 'w', encoding='utf-8') as writer:
+        writer.write('\n'.join(tokens) + '\n')
+    return BertTokenizer(vocab_file), tokens[104:]
+
+
+def run(engine, requests):
+    futures = []
+    start = time.time()
+    submitters = [threading.Thread(target=lambda data=data: futures.append(engine.submit(data)))
+                  for data in requests]
+    for submitter in submitters:
+        submitter.start()
+    for submitter in submitters:
+        submitter.join()
+    results = [future.result() for future in futures]
+    return results, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hidden-size', type=int, default=128)
+    parser.add_argument('--num-attention-heads', type=int, default=4)
+    parser.add_argument('--num-layers', type=int, default=2)
+    parser.add_argument('--dec-layers', type=int, default=2)
+    parser.add_argument('--vocab-size', type=int, default=2000)
+    parser.add_argument('--num-requests', type=int, default=32)
+    parser.add_argument('--length', type=int, default=64)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args()
+    args.cls_token, args.sep_token = '[CLS]', '[SEP]'
+    args.temperature, args.top_k, args.top_p = 0.9, 20, 0.0
+
+    initialize_single_process()
+    torch.manual_seed(args.seed)
+    tokenizer, chars = build_tokenizer(args.vocab_size)
+    config = BertConfig(args.vocab_size,
+                        hidden_size=args.hidden_size,
+                        num_hidden_layers=args.num_layers,
+                        num_attention_heads=args.num_attention_heads,
+                        intermediate_size=4 * args.hidden_size,
+                        max_position_embeddings=2048,
+                        type_vocab_size=3,
+                        dec_hidden_layers=args.dec_layers)
+    model = PalmForPreTraining(config)
+
+    generator = torch.Generator().manual_seed(args.seed)
+    requests = []
+    for _ in range(args.num_requests):
+        passage_length = int(torch.randint(16, 256, (1,), generator=generator))
+        passage = ''.join(chars[i] for i in torch.randint(len(chars), (passage_length,), generator=generator))
+        requests.append({'passage': passage, 'length': args.length})
+
+    for max_batch_size in args.batch_sizes:
+        engine = PlugServingEngine(model, tokenizer, args, torch.device('cpu'),
+                                   max_batch_size=max_batch_size)
+        server = threading.Thread(target=engine.serve_forever)
+        server.start()
+        results, elapsed = run(engine, requests)
+        engine.stop()
+        server.join()
+        num_tokens = sum(len(text) for text in results)
+        print('max_batch_size={:3d}: {:3d} requests in {:7.2f}s, {:6.2f} requests/sec, '
+              '{:8.2f} chars/sec'.format(max_batch_size, len(results), elapsed,
+                                         len(results) / elapsed, num_tokens / elapsed))
+    mpu.destroy_model_parallel()
+
+
+if __name__ == '__main__':
+    main()
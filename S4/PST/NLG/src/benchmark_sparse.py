@@ -0,0 +1,101 @@
+"""Checkpoint size, load time and CPU latency of PST sparse checkpoints.
+
+Prunes a randomly initialized GPT-2 to each sparsity, saves it with
+`save_sparse_model` (dense weights) and `save_compact_sparse_model` (bitmask
+plus surviving values), then loads both into a fresh `GPT2LMModel` on CPU and
+times the forward pass of its `GPT2Model`.
+
+    PYTHONPATH=../.. python benchmark_sparse.py --model_card gpt2.sm --sparsity 0.5 0.8 0.9
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+import warnings
+
+import torch
+
+from model import GPT2Config, GPT2LMModel
+
+from pst.utils import convert_sparse_network, update_network_sparsity, save_sparse_model, \
+    save_compact_sparse_model, load_compact_sparse_model
+
+parser = argparse.ArgumentParser(description='PST sparse checkpoint benchmark')
+parser.add_argument('--model_card', default='gpt2.sm', choices=['gpt2.sm', 'gpt2.md', 'gpt2.lg'])
+parser.add_argument('--sparsity', type=float, nargs='+', default=[0.5, 0.8, 0.9])
+parser.add_argument('--sparse_threshold', type=float, default=0.75,
+                    help='sparsity from which the compact model multiplies with CSR weights')
+parser.add_argument('--batch_size', type=int, default=1)
+parser.add_argument('--seq_len', type=int, default=128)
+parser.add_argument('--repeat', type=int, default=10)
+parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 keeps the default')
+
+
+def build_model(model_card):
+    n_embd, n_layer, n_head = {'gpt2.sm': (768, 12, 12), 'gpt2.md': (1024, 24, 16),
+                               'gpt2.lg': (1280, 36, 20)}[model_card]
+    return GPT2LMModel(GPT2Config(n_embd=n_embd, n_layer=n_layer, n_head=n_head)).eval()
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def latency(lm_net, input_ids, repeat):
+    """Seconds per GPT2Model forward (the LM head is not pruned), and the logits."""
+    with torch.no_grad():
+        lm_logits, _ = lm_net(input_ids)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            lm_net.transformer(input_ids)
+    return (time.perf_counter() - start) / repeat, lm_logits
+
+
+def load_dense(model_card, path):
+    lm_net = build_model(model_card)
+    lm_net.load_state_dict(torch.load(path, map_location='cpu'))
+    lm_net.set_tied()
+    return lm_net
+
+
+def load_compact(model_card, path, sparse_threshold, logger):
+    lm_net = build_model(model_card)
+    load_compact_sparse_model(lm_net, path, sparse_threshold, logger)
+    lm_net.set_tied()
+    return lm_net
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    logger = logging.getLogger('benchmark_sparse')
+    warnings.filterwarnings('ignore', message='Sparse CSR tensor support is in beta state')
+    work_dir = tempfile.mkdtemp()
+    input_ids = torch.randint(0, 50257, (args.batch_size, args.seq_len))
+
+    print('sparsity  dense: MB  load(s)  latency(ms)   compact: MB  load(s)  latency(ms)   max |diff|')
+    for sparsity in args.sparsity:
+        torch.manual_seed(0)
+        lm_net = build_model(args.model_card)
+        convert_sparse_network(lm_net.transformer.h, 'pst', 8, 1.0, 8, 1.0, 1.0, logger=logger)
+        update_network_sparsity(lm_net, sparsity)
+        dense_path = os.path.join(work_dir, 'sparse_model.pt')
+        compact_path = os.path.join(work_dir, 'sparse_model.compact.pt')
+        save_sparse_model(lm_net, dense_path)
+        save_compact_sparse_model(lm_net, compact_path)
+
+        dense_net, dense_load = timed(lambda: load_dense(args.model_card, dense_path))
+        compact_net, compact_load = timed(
+            lambda: load_compact(args.model_card, compact_path, args.sparse_threshold, logger))
+        dense_latency, dense_logits = latency(dense_net, input_ids, args.repeat)
+        compact_latency, compact_logits = latency(compact_net, input_ids, args.repeat)
+
+        print('{:8.2f}  {:9.1f}  {:7.2f}  {:11.1f}   {:11.1f}  {:7.2f}  {:11.1f}   {:.2e}'.format(
+            sparsity,
+            os.path.getsize(dense_path) / 2 ** 20, dense_load, dense_latency * 1000,
+            os.path.getsize(compact_path) / 2 ** 20, compact_load, compact_latency * 1000,
+            (dense_logits - compact_logits).abs().max().item()))
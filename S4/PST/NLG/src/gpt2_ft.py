@@ -33,7 +33,8 @@ from data_utils import FT_Dataset
 from model import GPT2Config, GPT2LMModel, Conv1D
 from exp_utils import create_exp_dir
 
-from pst.utils import convert_sparse_network, schedule_sparsity_ratio, update_network_sparsity, save_sparse_model
+from pst.utils import convert_sparse_network, schedule_sparsity_ratio, update_network_sparsity, save_sparse_model, \
+    save_compact_sparse_model
 
 parser = argparse.ArgumentParser(description='PyTorch GPT2 ft script')
 
@@ -264,6 +265,7 @@ def train_validate(
         model_path = os.path.join(args.work_dir, f'model.{train_step}.pt')
         print('saving checkpoint', model_path)
         torch.save({'model_state_dict': model.state_dict()}, model_path)
+        save_compact_sparse_model(model, os.path.join(args.work_dir, 'sparse_model.compact.pt'))
         save_sparse_model(model, os.path.join(args.work_dir, 'sparse_model.pt'))
 
     distributed_sync(args)
@@ -71,7 +71,8 @@ class SparseLinear(nn.Linear):
         else:
             return F.linear(inputs, self.weight, self.bias)
     
-    def convert(self):
+    def masked_weight(self):
+        """The pruned weight at the current sparsity and its keep mask."""
         if self.pruning_method == "pst":
             weight = self.weight + self.weight_beta * self.weight_U @ self.weight_V
             mask_scores = weight.abs() + self.mask_alpha1 * self.mask_scores_A @ self.mask_scores_B + \
@@ -79,7 +80,12 @@ class SparseLinear(nn.Linear):
 
             mask = SparseBinarizer.apply(mask_scores, self.cur_sparsity)
 
-            masked_weight = mask * weight
+            return mask * weight, mask.bool()
+        return self.weight, torch.ones_like(self.weight, dtype=torch.bool)
+
+    def convert(self):
+        if self.pruning_method == "pst":
+            masked_weight, _ = self.masked_weight()
 
             self.old_weight = self.weight.data.clone()
             self.weight.data = masked_weight.data
@@ -87,4 +93,68 @@ class SparseLinear(nn.Linear):
     def restore(self):
         if self.pruning_method == "pst":
             self.weight.data = self.old_weight
-            del self.old_weight
\ No newline at end of file
+            del self.old_weight
+
+class FrozenSparseLinear(nn.Module):
+    """
+    Inference form of a pruned SparseLinear, holding only the surviving weights.
+
+    The kept weights are stored row-major as `values` with a packed bitmask of
+    their positions (see `pack_mask`). Above `sparse_threshold`
+    sparsity the forward pass multiplies with a CSR weight; below it the dense
+    weight is rebuilt once, as a dense matmul is faster on CPU there.
+    """
+
+    def __init__(self, in_features, out_features, mask, values, bias=None, sparse_threshold=0.75):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.sparsity = 1.0 - values.numel() / float(in_features * out_features)
+
+        mask = mask.reshape(out_features, in_features)
+        if self.sparsity >= sparse_threshold:
+            crow_indices = torch.zeros(out_features + 1, dtype=torch.long)
+            crow_indices[1:] = torch.cumsum(mask.sum(1), 0)
+            col_indices = mask.nonzero()[:, 1]
+            weight = torch.sparse_csr_tensor(crow_indices, col_indices, values,
+                                             size=(out_features, in_features))
+        else:
+            weight = values.new_zeros(out_features, in_features)
+            weight[mask] = values
+        self.register_buffer("weight", weight)
+        self.register_buffer("bias", bias)
+
+    @classmethod
+    def from_dense(cls, weight, bias=None, mask=None, **kwargs):
+        if mask is None:
+            mask = weight != 0
+        mask = mask.bool()
+        return cls(weight.size(1), weight.size(0), mask, weight[mask].contiguous(), bias, **kwargs)
+
+    @staticmethod
+    def pack_mask(mask):
+        """Bool mask -> uint8 tensor with 8 positions per byte, row-major."""
+        flat = mask.reshape(-1).to(torch.uint8)
+        flat = torch.cat([flat, flat.new_zeros(-flat.numel() % 8)]).view(-1, 8)
+        shifts = torch.arange(7, -1, -1, dtype=torch.uint8)
+        return (flat << shifts).sum(1, dtype=torch.uint8)
+
+    @staticmethod
+    def unpack_mask(packed, shape):
+        shifts = torch.arange(7, -1, -1, dtype=torch.uint8)
+        flat = (packed.unsqueeze(1) >> shifts) & 1
+        return flat.reshape(-1)[:shape[0] * shape[1]].bool().reshape(shape)
+
+    def forward(self, inputs):
+        if not self.weight.is_sparse_csr:
+            return F.linear(inputs, self.weight, self.bias)
+        input_shape = inputs.shape
+        inputs = inputs.reshape(-1, self.in_features)
+        outputs = torch.sparse.mm(self.weight, inputs.t()).t()
+        if self.bias is not None:
+            outputs = outputs + self.bias
+        return outputs.reshape(input_shape[:-1] + (self.out_features,))
+
+    def extra_repr(self):
+        return "in_features={}, out_features={}, bias={}, sparsity={:.3f}, csr={}".format(
+            self.in_features, self.out_features, self.bias is not None, self.sparsity, self.weight.is_sparse_csr)
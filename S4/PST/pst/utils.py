@@ -4,7 +4,7 @@ import torch.nn as nn
 
 from collections import OrderedDict
 
-from pst.sparse import SparseLinear
+from pst.sparse import SparseLinear, FrozenSparseLinear
 
 def _setattr(model, name, module):
     name_list = name.split(".")
@@ -82,4 +82,73 @@ def save_sparse_model(model, save_path, logger=None):
     # convert sparse weight to original weight
     for name, module in model.named_modules():
         if isinstance(module, SparseLinear):
-            module.restore()
\ No newline at end of file
+            module.restore()
+
+def save_compact_sparse_model(model, save_path, logger=None):
+    """
+    Save the pruned network keeping only the surviving weights of every
+    SparseLinear: `<name>.sparse_mask` (bitmask packed 8 positions per byte),
+    `<name>.sparse_values` (kept weights, row-major), `<name>.sparse_shape`
+    and `<name>.bias`. Other params are saved as they are.
+    """
+    save_state_dict = OrderedDict()
+    sparse_names = []
+    with torch.no_grad():
+        for name, module in model.named_modules():
+            if isinstance(module, SparseLinear):
+                weight, mask = module.masked_weight()
+                save_state_dict[name + '.sparse_mask'] = FrozenSparseLinear.pack_mask(mask.cpu())
+                save_state_dict[name + '.sparse_values'] = weight[mask].cpu().clone()
+                save_state_dict[name + '.sparse_shape'] = torch.tensor(weight.shape)
+                if module.bias is not None:
+                    save_state_dict[name + '.bias'] = module.bias.detach().cpu().clone()
+                sparse_names.append(name + '.')
+
+    model_state_dict = model.state_dict()
+    for key in model_state_dict:
+        if not any(key.startswith(name) for name in sparse_names):
+            save_state_dict[key] = model_state_dict[key]
+
+    torch.save(save_state_dict, save_path)
+    if logger:
+        logger.info(f"save {len(sparse_names)} sparse modules to {save_path}.")
+
+def _strip_prefix(model, module_name):
+    """Prefix of a saved module name that `model` does not have, e.g. `module.transformer.`."""
+    module_names = set(name for name, _ in model.named_modules())
+    parts = module_name.split(".")
+    for i in range(len(parts)):
+        if ".".join(parts[i:]) in module_names:
+            return "".join(part + "." for part in parts[:i])
+    raise KeyError(f"{module_name} does not match any module of the model.")
+
+def load_compact_sparse_model(model, load_path, sparse_threshold=0.75, logger=None):
+    """
+    Load a checkpoint written by `save_compact_sparse_model` into a dense
+    model (e.g. GPT2LMModel, GPT2Model or a transformers NLU model), replacing
+    every pruned linear layer by a FrozenSparseLinear.
+    """
+    state_dict = torch.load(load_path, map_location='cpu')
+    sparse_names = [key[:-len('.sparse_mask')] for key in state_dict if key.endswith('.sparse_mask')]
+    prefix = _strip_prefix(model, sparse_names[0]) if sparse_names else ''
+
+    for name in sparse_names:
+        shape = tuple(state_dict.pop(name + '.sparse_shape').tolist())
+        mask = FrozenSparseLinear.unpack_mask(state_dict.pop(name + '.sparse_mask'), shape)
+        values = state_dict.pop(name + '.sparse_values')
+        bias = state_dict.pop(name + '.bias', None)
+        new_module = FrozenSparseLinear(shape[1], shape[0], mask, values, bias, sparse_threshold)
+        _setattr(model, name[len(prefix):], new_module)
+
+    state_dict = OrderedDict((key[len(prefix):], value) for key, value in state_dict.items()
+                             if key.startswith(prefix))
+    missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
+    frozen_names = tuple(name[len(prefix):] + '.' for name in sparse_names)
+    missing_keys = [key for key in missing_keys if not key.startswith(frozen_names)]
+    message = f"load {len(sparse_names)} sparse modules from {load_path}, " \
+              f"missing keys: {missing_keys}, unexpected keys: {unexpected_keys}."
+    if logger:
+        logger.info(message)
+    else:
+        print(message)
+    return model
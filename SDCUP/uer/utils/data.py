@@ -1,9 +1,11 @@
 # -*- encoding:utf-8 -*-
+import io
 import os
 import torch
 import codecs
 import random
 import pickle
+import numpy as np
 from multiprocessing import Pool
 from uer.utils.constants import *
 from uer.utils.misc import count_lines
@@ -37,20 +39,59 @@ def mask_seq(src, vocab_size):
     return src, tgt_mlm
 
 
+def index_path(dataset_path):
+    """ path of the instance offsets written next to a dataset """
+    return dataset_path + ".idx"
+
+
+def load_offsets(dataset_path):
+    """
+    byte offsets of the pickled instances of a dataset,
+    offsets[i] is where instance i starts and offsets[-1] is the file size
+    """
+    return np.load(index_path(dataset_path))
+
+
+class InstanceWriter(object):
+    """
+    Pickle instances one after another and record where each of them starts,
+    so that readers can seek straight to any instance.
+    """
+    def __init__(self, dataset_path):
+        self.dataset_path = dataset_path
+        self.f_write = open(dataset_path, "wb")
+        self.offsets = [0]
+
+    def write(self, instance):
+        pickle.dump(instance, self.f_write)
+        self.offsets.append(self.f_write.tell())
+
+    def close(self):
+        self.f_write.close()
+        with open(index_path(self.dataset_path), "wb") as f:
+            np.save(f, np.array(self.offsets, dtype=np.int64))
+
+
 def merge_dataset(dataset_path, workers_num):
-        # Merge datasets.
+        # Merge datasets and their instance offsets.
         f_writer = open(dataset_path, "wb")
+        offsets = [np.zeros(1, dtype=np.int64)]
         for i in range(workers_num):
-            tmp_dataset_reader = open("dataset-tmp-"+str(i)+".pt", "rb")
+            tmp_dataset_path = "dataset-tmp-"+str(i)+".pt"
+            tmp_dataset_reader = open(tmp_dataset_path, "rb")
+            base = f_writer.tell()
             while True:
-                tmp_data = tmp_dataset_reader.read(2^20)
+                tmp_data = tmp_dataset_reader.read(2**20)
                 if tmp_data:
                     f_writer.write(tmp_data)
                 else:
                     break
             tmp_dataset_reader.close()
+            offsets.append(load_offsets(tmp_dataset_path)[1:] + base)
             # os.remove("dataset-tmp-"+str(i)+".pt")
         f_writer.close()
+        with open(index_path(dataset_path), "wb") as f:
+            np.save(f, np.concatenate(offsets))
 
 
 class Dataset(object):
@@ -91,6 +132,13 @@ class Dataset(object):
 
 
 class DataLoader(object):
+    """
+    Iterate over the instances of process proc_id out of proc_num.
+    When the dataset has an offsets file, each process reads only its own
+    contiguous slice, instances_buffer_size instances at a time, and shuffles
+    the order of these blocks every pass. Datasets without offsets are read
+    sequentially and every proc_num-th instance is kept.
+    """
     def __init__(self, args, dataset_path, batch_size, proc_id, proc_num, shuffle=False):
         self.batch_size = batch_size
         self.instances_buffer_size = args.instances_buffer_size
@@ -102,8 +150,21 @@ class DataLoader(object):
         self.start = 0
         self.end = 0
         self.buffer = []
+        self.offsets = None
+        if os.path.exists(index_path(dataset_path)):
+            offsets = load_offsets(dataset_path)
+            instances_num = len(offsets) - 1
+            first = instances_num * proc_id // proc_num
+            last = instances_num * (proc_id + 1) // proc_num
+            assert last > first, "%d instances are too few for %d processes" % (instances_num, proc_num)
+            self.offsets = offsets[first:last + 1]
+            self.blocks = list(range(0, last - first, self.instances_buffer_size))
+            self.block_id = len(self.blocks)
 
     def _fill_buf(self):
+        if self.offsets is not None:
+            self._fill_buf_indexed()
+            return
         try:
             self.buffer = []
             while True:
@@ -122,6 +183,26 @@ class DataLoader(object):
         self.start = 0
         self.end = len(self.buffer)
 
+    def _fill_buf_indexed(self):
+        if self.block_id >= len(self.blocks):
+            # Start a new pass over the slice of this process.
+            if self.shuffle:
+                random.shuffle(self.blocks)
+            self.block_id = 0
+        first = self.blocks[self.block_id]
+        last = min(first + self.instances_buffer_size, len(self.offsets) - 1)
+        self.block_id += 1
+
+        self.f_read.seek(int(self.offsets[first]))
+        block = io.BytesIO(self.f_read.read(int(self.offsets[last] - self.offsets[first])))
+        self.buffer = [pickle.load(block) for _ in range(last - first)]
+        self.read_count += last - first
+
+        if self.shuffle:
+            random.shuffle(self.buffer)
+        self.start = 0
+        self.end = len(self.buffer)
+
     def _empty(self):
         return self.start >= self.end
 
@@ -149,7 +230,7 @@ class BertDataset(Dataset):
         docs_buffer = []
         document = []
         pos = 0
-        f_write = open("dataset-tmp-" + str(proc_id) + ".pt", "wb")
+        f_write = InstanceWriter("dataset-tmp-" + str(proc_id) + ".pt")
         with open(self.corpus_path, mode="r", encoding="utf-8") as f:
             while pos < start:
                 try:
@@ -174,7 +255,7 @@ class BertDataset(Dataset):
                         instances = self.build_instances(docs_buffer)
                         # Save instances.
                         for instance in instances:
-                            pickle.dump(instance, f_write)
+                            f_write.write(instance)
                         # Clear buffer.
                         docs_buffer = []
                         instances = []
@@ -187,7 +268,7 @@ class BertDataset(Dataset):
                     if len(docs_buffer) > 0:
                         instances = self.build_instances(docs_buffer)
                         for instance in instances:
-                            pickle.dump(instance, f_write)
+                            f_write.write(instance)
                     break
         f_write.close()
 
@@ -346,7 +427,7 @@ class LmDataset(Dataset):
         print("Worker %d is building dataset ... " % proc_id)
         set_seed(self.seed)
         pos = 0
-        f_write = open("dataset-tmp-" + str(proc_id) + ".pt", "wb")
+        f_write = InstanceWriter("dataset-tmp-" + str(proc_id) + ".pt")
         with open(self.corpus_path, mode="r", encoding="utf-8") as f:
             while pos < start:
                 try:
@@ -377,7 +458,7 @@ class LmDataset(Dataset):
                         tgt.append(PAD_ID)
                         seg.append(PAD_ID)
 
-                pickle.dump((src, tgt, seg), f_write)
+                f_write.write((src, tgt, seg))
 
                 if pos >= end - 1:
                     break
@@ -416,7 +497,7 @@ class BilmDataset(Dataset):
         print("Worker %d is building dataset ... " % proc_id)
         set_seed(self.seed)
         pos = 0
-        f_write = open("dataset-tmp-" + str(proc_id) + ".pt", "wb")
+        f_write = InstanceWriter("dataset-tmp-" + str(proc_id) + ".pt")
         with open(self.corpus_path, mode="r", encoding="utf-8") as f:
             while pos < start:
                 try:
@@ -451,7 +532,7 @@ class BilmDataset(Dataset):
                         tgt_backward.append(PAD_ID)
                         seg.append(PAD_ID)
                 
-                pickle.dump((src, tgt_forward, tgt_backward, seg), f_write)
+                f_write.write((src, tgt_forward, tgt_backward, seg))
 
                 if pos >= end - 1:
                     break
@@ -493,7 +574,7 @@ class ClsDataset(Dataset):
         print("Worker %d is building dataset ... " % proc_id)
         set_seed(self.seed)
         pos = 0
-        f_write = open("dataset-tmp-" + str(proc_id) + ".pt", "wb")
+        f_write = InstanceWriter("dataset-tmp-" + str(proc_id) + ".pt")
         with open(self.corpus_path, mode="r", encoding="utf-8") as f:
             while pos < start:
                 try:
@@ -525,7 +606,7 @@ class ClsDataset(Dataset):
                         while len(src) != self.seq_length:
                             src.append(PAD_ID)
                             seg.append(PAD_ID)
-                    pickle.dump((src, tgt, seg), f_write)
+                    f_write.write((src, tgt, seg))
                 elif len(line) == 3: # For sentence pair input.
                     label = int(line[0])
                     text_a, text_b = line[1], line[2]
@@ -545,7 +626,7 @@ class ClsDataset(Dataset):
                         while len(src) != self.seq_length:
                             src.append(PAD_ID)
                             seg.append(PAD_ID)
-                    pickle.dump((src, tgt, seg), f_write)
+                    f_write.write((src, tgt, seg))
                 else:
                     pass
 
@@ -590,7 +671,7 @@ class MlmDataset(Dataset):
         print("Worker %d is building dataset ... " % proc_id)
         set_seed(self.seed)
         pos = 0
-        f_write = open("dataset-tmp-" + str(proc_id) + ".pt", "wb")
+        f_write = InstanceWriter("dataset-tmp-" + str(proc_id) + ".pt")
         for _ in range(self.dup_factor):
             with open(self.corpus_path, mode="r", encoding="utf-8") as f:
                 while pos < start:
@@ -620,7 +701,7 @@ class MlmDataset(Dataset):
                         src.append(PAD_ID)
                         seg.append(PAD_ID)
 
-                    pickle.dump((src, tgt, seg), f_write)
+                    f_write.write((src, tgt, seg))
 
                     if pos >= end - 1:
                         break
@@ -0,0 +1,70 @@
+"""FLOPs and CPU latency of ACT inference, full layer versus halted-token compaction.
+
+Builds a randomly initialized `BertModel` with transformer_type 'act' and
+halting units scaled so tokens halt after different numbers of steps, then
+runs the encoder in eval mode with the layer applied to every token and with
+`act_compact_inference`, counting FLOPs with `FlopCounterMode` and comparing
+the sequence outputs.
+
+    python benchmark_act.py --batch_size 8 --seq_len 128
+"""
+import argparse
+import time
+
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+
+from modeling import BertConfig, BertModel
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--hidden_size', type=int, default=256)
+parser.add_argument('--num_hidden_layers', type=int, default=12)
+parser.add_argument('--batch_size', type=int, default=8)
+parser.add_argument('--seq_len', type=int, default=128)
+parser.add_argument('--halting_scale', type=float, default=0.3,
+                    help='std of the halting unit weights, larger spreads the halting steps')
+parser.add_argument('--halting_bias', type=float, default=-1.5)
+parser.add_argument('--repeat', type=int, default=10)
+parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 keeps the default')
+parser.add_argument('--seed', type=int, default=42)
+
+
+def run(model, input_ids, attention_mask, repeat):
+    """Sequence output, ponder cost (mean steps), FLOPs and seconds of one forward."""
+    with torch.no_grad():
+        with FlopCounterMode(display=False) as counter:
+            all_encoder_layers, _ = model(input_ids, attention_mask=attention_mask)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            model(input_ids, attention_mask=attention_mask)
+    return all_encoder_layers[-1], len(all_encoder_layers) - 2, counter.get_total_flops(), \
+        (time.perf_counter() - start) / repeat
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    config = BertConfig(vocab_size=8000, hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers,
+                        num_attention_heads=args.hidden_size // 64, intermediate_size=4 * args.hidden_size,
+                        max_position_embeddings=512, transformer_type='act')
+    model = BertModel(config).eval()
+    for module in model.encoder.p:
+        module.weight.data.normal_(0, args.halting_scale)
+        module.bias.data.fill_(args.halting_bias)
+
+    input_ids = torch.randint(5, config.vocab_size, (args.batch_size, args.seq_len))
+    lengths = torch.randint(args.seq_len // 4, args.seq_len + 1, (args.batch_size,))
+    attention_mask = (torch.arange(args.seq_len).unsqueeze(0) < lengths.unsqueeze(1)).long()
+
+    model.encoder.compact_inference = False
+    dense_output, steps, dense_flops, dense_time = run(model, input_ids, attention_mask, args.repeat)
+    model.encoder.compact_inference = True
+    compact_output, _, compact_flops, compact_time = run(model, input_ids, attention_mask, args.repeat)
+
+    print('{} steps for batch {}x{}'.format(steps, args.batch_size, args.seq_len))
+    print('full layer: {:8.2f} GFLOPs {:8.1f} ms'.format(dense_flops / 1e9, dense_time * 1000))
+    print('compacted:  {:8.2f} GFLOPs {:8.1f} ms'.format(compact_flops / 1e9, compact_time * 1000))
+    print('FLOPs -{:.1%}, latency {:.2f}x, max |diff| {:.2e}'.format(
+        1 - compact_flops / dense_flops, dense_time / compact_time, (dense_output - compact_output).abs().max().item()))
@@ -0,0 +1,107 @@
+"""Training tokens/sec with fixed-size batches versus token-budget batches.
+
+Trains a small randomly initialized `BertForSequenceClassificationMultiTask`
+on CPU for one pass over synthetic features with log-normal lengths, batched
+(1) in random order padded to max_seq_length, (2) by `SortedBatchSampler`
+with `train_batch_size` examples and (3) by `TokenBudgetBatchSampler` with
+the same worst-case budget of train_batch_size * max_seq_length tokens, and
+reports real (non-padding) tokens per second. It also checks that token-budget
+epochs are reproducible and how evenly a step is split over `--world_size`
+ranks.
+
+    python benchmark_token_budget.py --num_examples 4000 --train_batch_size 32
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, RandomSampler, TensorDataset
+
+from modeling import BertConfig, BertForSequenceClassificationMultiTask
+from optimization import BERTAdam
+from run_classifier_multi_task import PackedFeatures, FeatureDataset, SortedBatchSampler, TokenBudgetBatchSampler
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_examples', type=int, default=4000)
+parser.add_argument('--max_seq_length', type=int, default=128)
+parser.add_argument('--train_batch_size', type=int, default=32)
+parser.add_argument('--max_tokens', type=int, default=0, help='defaults to train_batch_size * max_seq_length')
+parser.add_argument('--hidden_size', type=int, default=256)
+parser.add_argument('--num_hidden_layers', type=int, default=4)
+parser.add_argument('--world_size', type=int, default=4, help='ranks to split token-budget steps over')
+parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 keeps the default')
+parser.add_argument('--seed', type=int, default=42)
+
+
+def synthetic_features(num_examples, max_seq_length, vocab_size, rng):
+    lengths = np.clip(rng.lognormal(3.5, 0.6, num_examples).astype(np.int64), 4, max_seq_length)
+    features = {
+        'input_ids': rng.randint(5, vocab_size, lengths.sum()).astype(np.int32),
+        'segment_ids': np.zeros(lengths.sum(), dtype=np.int8),
+        'offsets': np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(lengths)]),
+        'labels': rng.randint(0, 2, num_examples).astype(np.float32),
+    }
+    return PackedFeatures.concat([features])
+
+
+def train(model, dataloader):
+    """Seconds for one pass over `dataloader`, real and padded tokens seen."""
+    optimizer = BERTAdam(model.parameters(), lr=1e-5)
+    model.train()
+    real_tokens, padded_tokens = 0, 0
+    start = time.perf_counter()
+    for input_ids, input_mask, segment_ids, label_ids, label_index in dataloader:
+        loss, _ = model(input_ids, segment_ids, input_mask, label_ids, label_index)
+        loss.backward()
+        optimizer.step()
+        model.zero_grad()
+        real_tokens += int(input_mask.sum())
+        padded_tokens += input_ids.numel()
+    return time.perf_counter() - start, real_tokens, padded_tokens
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    max_tokens = args.max_tokens or args.train_batch_size * args.max_seq_length
+    rng = np.random.RandomState(args.seed)
+    config = BertConfig(vocab_size=8000, hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers,
+                        num_attention_heads=args.hidden_size // 64, intermediate_size=4 * args.hidden_size,
+                        max_position_embeddings=512)
+    features = synthetic_features(args.num_examples, args.max_seq_length, config.vocab_size, rng)
+    dataset = FeatureDataset(features)
+    print('{} examples, length mean {:.1f} max {}'.format(
+        len(features), features.lengths().mean(), features.lengths().max()))
+
+    padded = TensorDataset(*features.batch(np.arange(len(features)), args.max_seq_length))
+    token_budget = TokenBudgetBatchSampler(dataset.lengths(), max_tokens, seed=args.seed)
+    loaders = [
+        ('padded, batch_size={}'.format(args.train_batch_size),
+         DataLoader(padded, sampler=RandomSampler(padded), batch_size=args.train_batch_size)),
+        ('sorted, batch_size={}'.format(args.train_batch_size),
+         DataLoader(dataset, sampler=SortedBatchSampler(dataset.lengths(), args.train_batch_size),
+                    batch_size=args.train_batch_size, collate_fn=dataset.collate)),
+        ('token budget, max_tokens={}'.format(max_tokens),
+         DataLoader(dataset, batch_sampler=token_budget, collate_fn=dataset.collate)),
+    ]
+    for name, dataloader in loaders:
+        torch.manual_seed(args.seed)
+        model = BertForSequenceClassificationMultiTask(config, [['0', '1']], 'bert')
+        seconds, real_tokens, padded_tokens = train(model, dataloader)
+        print('{:32s} {:4d} steps  {:5.1%} padding  {:8.0f} tokens/s'.format(
+            name, len(dataloader), 1 - real_tokens / padded_tokens, real_tokens / seconds))
+
+    samplers = [TokenBudgetBatchSampler(dataset.lengths(), max_tokens, seed=args.seed, rank=rank,
+                                        world_size=args.world_size) for rank in range(args.world_size)]
+    for sampler in samplers:
+        sampler.set_epoch(1)
+    steps = list(zip(*samplers))
+    padded_per_rank = np.array([[len(batch) * dataset.lengths()[batch].max() for batch in step] for step in steps])
+    reproducible = steps == list(zip(*samplers))
+    samplers[0].set_epoch(2)
+    print('world_size={}: {} steps, padded tokens per rank max/min {:.3f} (mean over steps), '
+          'reproducible: {}, epochs differ: {}'.format(
+            args.world_size, len(steps), (padded_per_rank.max(1) / padded_per_rank.min(1)).mean(),
+            reproducible, list(samplers[0]) != [step[0] for step in steps]))
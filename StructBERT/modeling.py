@@ -66,7 +66,8 @@ class BertConfig(object):
                 set_mask_zero=False,
                 init_scale=False,
                 safer_fp16=False,
-                grad_checkpoint=False,): #support 0/1
+                grad_checkpoint=False,
+                act_compact_inference=False,): #support 0/1
         """Constructs BertConfig.
 
         Args:
@@ -90,6 +91,8 @@ class BertConfig(object):
                 `BertModel`.
             initializer_range: The sttdev of the truncated_normal_initializer for
                 initializing all weight matrices.
+            act_compact_inference: With transformer_type 'act', run the layer in eval
+                mode only on the tokens that have not halted yet.
         """
         self.vocab_size = vocab_size
         self.hidden_size = hidden_size
@@ -118,6 +121,7 @@ class BertConfig(object):
         self.init_scale = init_scale
         self.safer_fp16 = safer_fp16
         self.grad_checkpoint = grad_checkpoint
+        self.act_compact_inference = act_compact_inference
 
     @classmethod
     def from_dict(cls, json_object):
@@ -564,16 +568,56 @@ class BERTEncoderACT(nn.Module):
         self.config = config
         self.act_max_steps = config.num_hidden_layers
         self.threshold = 0.99
+        # a token's layer output must only depend on the other tokens through attention keys/values
+        self.compact_inference = getattr(config, 'act_compact_inference', False) and \
+            config.attention_type.lower() == 'self' and \
+            config.transition_function.lower() == 'linear' and \
+            not config.squeeze_excitation
 
     def should_continue(self, halting_probability, n_updates):
         return (halting_probability.lt(self.threshold).__and__(n_updates.lt(self.act_max_steps))).any()
 
+    def compact_layer(self, hidden_states, attention_mask, active):
+        """
+        Apply `self.layer` to the positions where `active` is set only, they
+        still attend over the keys and values of the whole sequence.
+        Returns the outputs [num_active, hidden] and the (row, column) indices
+        of the active positions they belong to.
+        """
+        attention = self.layer.attention.self
+        batch_size, seq_len, hdim = hidden_states.size()
+        counts = active.sum(1)
+        num_queries = int(counts.max())
+        # active positions first, in sequence order
+        order = torch.sort(active.to(torch.uint8), dim=1, descending=True, stable=True)[1][:, :num_queries]
+        valid = torch.arange(num_queries, device=active.device).unsqueeze(0) < counts.unsqueeze(1)
+        rows = torch.arange(batch_size, device=active.device).unsqueeze(1).expand_as(order)[valid]
+        columns = order[valid]
+
+        states = attention.LayerNorm(hidden_states) if self.config.pre_ln else hidden_states
+        query_states = states.gather(1, order.unsqueeze(2).expand(-1, -1, hdim))
+        query_layer = attention.transpose_for_scores(attention.query(query_states))
+        key_layer = attention.transpose_for_scores(attention.key(states))
+        value_layer = attention.transpose_for_scores(attention.value(states))
+
+        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+        attention_scores = attention_scores / math.sqrt(attention.attention_head_size)
+        attention_probs = nn.Softmax(dim=-1)(attention_scores + attention_mask)
+        context_layer = torch.matmul(attention_probs, value_layer).permute(0, 2, 1, 3).contiguous()
+        context_layer = context_layer.view(batch_size, num_queries, attention.all_head_size)[valid]
+
+        attention_output = self.layer.attention.output(context_layer, hidden_states[rows, columns])
+        intermediate_output = self.layer.intermediate(attention_output)
+        layer_output = self.layer.output(intermediate_output, attention_output)
+        return layer_output, rows, columns
+
     def forward(self, hidden_states, attention_mask):
         all_encoder_layers = [hidden_states]
         batch_size, seq_len, hdim = hidden_states.size()
-        halting_probability = torch.zeros(batch_size, seq_len).cuda()
-        remainders = torch.zeros(batch_size, seq_len).cuda()
-        n_updates = torch.zeros(batch_size, seq_len).cuda()
+        halting_probability = hidden_states.new_zeros(batch_size, seq_len)
+        remainders = hidden_states.new_zeros(batch_size, seq_len)
+        n_updates = hidden_states.new_zeros(batch_size, seq_len)
+        compact = self.compact_inference and not self.training
         #accumulated_hidden_states = torch.zeros_like(hidden_states)
         for i in range(self.act_max_steps):
             p = torch.sigmoid(self.p[i](hidden_states).squeeze(2))
@@ -585,9 +629,18 @@ class BERTEncoderACT(nn.Module):
             halting_probability = halting_probability + new_halted * remainders
             n_updates = n_updates + still_running + new_halted
             update_weights = (p * still_running + new_halted * remainders).unsqueeze(2)
-            transformed_states = self.layer(hidden_states, attention_mask)
-            #accumulated_hidden_states = (transformed_states * update_weights) + accumulated_hidden_states
-            hidden_states = transformed_states * update_weights + hidden_states * (1 - update_weights)
+            if compact:
+                # halted tokens have zero update weights, only the others go through the layer
+                active = (still_running + new_halted).gt(0)
+                if active.any():
+                    transformed_states, rows, columns = self.compact_layer(hidden_states, attention_mask, active)
+                    weights = update_weights[rows, columns]
+                    hidden_states = hidden_states.index_put(
+                        (rows, columns), transformed_states * weights + hidden_states[rows, columns] * (1 - weights))
+            else:
+                _, transformed_states = self.layer(hidden_states, attention_mask)
+                #accumulated_hidden_states = (transformed_states * update_weights) + accumulated_hidden_states
+                hidden_states = transformed_states * update_weights + hidden_states * (1 - update_weights)
             all_encoder_layers.append(hidden_states)
             if not self.should_continue(halting_probability, n_updates):
                 #print(len(all_encoder_layers))
@@ -19,6 +19,7 @@ from __future__ import division
 from __future__ import print_function
 
 import csv
+import hashlib
 import os
 import logging
 import argparse
@@ -34,7 +35,7 @@ import numpy as np
 import scipy.stats as sp
 from multiprocessing import Pool
 import multiprocessing as mp
-from itertools import repeat
+from functools import partial
 import tokenization
 from modeling import BertConfig, BertForSequenceClassificationMultiTask
 from optimization import BERTAdam, Adamax
@@ -66,18 +67,66 @@ class InputExample(object):
         self.label = label
 
 
-class InputFeatures(object):
-    """A single set of features of data."""
+class PackedFeatures(object):
+    """Features of a set of examples as flat numpy arrays.
 
-    def __init__(self, input_ids, input_mask, segment_ids, label_id, index):
+    The real tokens of example i are `input_ids[offsets[i]:offsets[i + 1]]`,
+    padding is only added when batches are built.
+    """
+
+    def __init__(self, input_ids, segment_ids, offsets, labels, task_index, max_index):
         self.input_ids = input_ids
-        self.input_mask = input_mask
         self.segment_ids = segment_ids
-        self.label_id = label_id
-        self.index = index
+        self.offsets = offsets
+        self.labels = labels
+        self.task_index = task_index
+        self.max_index = max_index
+
+    @classmethod
+    def concat(cls, features_list):
+        """Features of several tasks, the i-th one gets task index i."""
+        offsets = [np.zeros(1, dtype=np.int64)]
+        for features in features_list:
+            offsets.append(features['offsets'][1:] + offsets[-1][-1])
+        return cls(np.concatenate([features['input_ids'] for features in features_list]),
+                   np.concatenate([features['segment_ids'] for features in features_list]),
+                   np.concatenate(offsets),
+                   np.concatenate([features['labels'] for features in features_list]),
+                   np.concatenate([np.full(len(features['labels']), index, dtype=np.int64)
+                                   for index, features in enumerate(features_list)]),
+                   len(features_list))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def batch(self, indices, seq_len=None, with_labels=True):
+        """Zero-padded tensors of the examples at `indices`, to the longest one if `seq_len` is None."""
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        if seq_len is None:
+            seq_len = int(lengths.max()) if len(indices) else 0
+        positions = np.arange(seq_len)
+        mask = positions < lengths[:, None]
+        gather = (starts[:, None] + positions)[mask]
+        # input_ids, input_mask and segment_ids
+        padded = np.zeros((3, len(indices), seq_len), dtype=np.int64)
+        padded[0][mask] = self.input_ids[gather]
+        padded[1] = mask
+        padded[2][mask] = self.segment_ids[gather]
+        input_ids, input_mask, segment_ids = torch.from_numpy(padded).unbind(0)
+        label_index = torch.from_numpy(self.task_index[indices])
+        if not with_labels:
+            return input_ids, input_mask, segment_ids, label_index
+        label_id = torch.zeros(len(indices), self.max_index, dtype=torch.float)
+        label_id[torch.arange(len(indices)), label_index] = torch.from_numpy(self.labels[indices])
+        return input_ids, input_mask, segment_ids, label_id, label_index
 
 class FeatureDataset(Dataset):
-    """Squad dataset"""
+    """Example indices of `PackedFeatures`, batched by `collate`."""
     def __init__(self, features):
         self.features = features
 
@@ -85,10 +134,13 @@ class FeatureDataset(Dataset):
         return len(self.features)
 
     def __getitem__(self, index):
-        return self.features[index]
+        return index
 
     def lengths(self):
-        return [len(feature.input_ids) for feature in self.features]
+        return self.features.lengths()
+
+    def collate(self, indices):
+        return self.features.batch(indices)
 
 class SortedBatchSampler(Sampler):
 
@@ -100,7 +152,7 @@ class SortedBatchSampler(Sampler):
     def __iter__(self):
         lengths = np.array(
             [(-l, np.random.random()) for l in self.lengths],
-            dtype=[('sent_len', np.int_), ('rand', np.float_)]
+            dtype=[('sent_len', np.int_), ('rand', np.float64)]
         )
         indices = np.argsort(lengths, order=('sent_len', 'rand'))
         batches = [indices[i:i + self.batch_size]
@@ -112,27 +164,56 @@ class SortedBatchSampler(Sampler):
     def __len__(self):
         return len(self.lengths)
 
-def batchify(batch):
-    seq_len = max([len(feature.input_ids) for feature in batch])
-    input_ids, input_mask, segment_ids, label_id, label_index = \
-        list(), list(), list(), list(), list()
-    for feature in batch:
-        padding = [0 for _ in range(seq_len - len(feature.input_ids))]
-        input_ids_ins = feature.input_ids
-        input_mask_ins = feature.input_mask
-        segment_ids_ins = feature.segment_ids
-        input_ids_ins.extend(padding), input_mask_ins.extend(padding), segment_ids_ins.extend(padding)
-        input_ids.append(torch.tensor(input_ids_ins, dtype=torch.long))
-        input_mask.append(torch.tensor(input_mask_ins, dtype=torch.long))
-        segment_ids.append(torch.tensor(segment_ids_ins, dtype=torch.long))
-        label_id.append(torch.tensor(feature.label_id, dtype=torch.float))
-        label_index.append(torch.tensor(feature.index, dtype=torch.long))
-    input_ids = torch.stack(input_ids, 0)
-    input_mask = torch.stack(input_mask, 0)
-    segment_ids = torch.stack(segment_ids, 0)
-    label_id = torch.stack(label_id, 0)
-    label_index = torch.stack(label_index, 0)
-    return input_ids, input_mask, segment_ids, label_id, label_index
+class TokenBudgetBatchSampler(Sampler):
+    """Batches of similar-length examples with at most `max_tokens` padded tokens.
+
+    Examples are sorted by decreasing length (ties broken at random) and cut
+    into batches whose size times longest length fits the budget, an example
+    longer than `max_tokens` gets a batch of its own. Consecutive groups of
+    `world_size` batches form one step, so the batches of the ranks in a step
+    have about the same number of padded tokens, and the steps are shuffled.
+    Both only depend on `seed` and the epoch given to `set_epoch`, so every
+    rank builds the same steps. The last step is completed with batches from
+    the start of the epoch.
+    """
+
+    def __init__(self, lengths, max_tokens, shuffle=True, seed=0, rank=0, world_size=1):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        # batch boundaries only depend on the sorted lengths, not on the tie breaking
+        self.num_batches = len(self._batch_bounds(np.sort(self.lengths)[::-1]))
+
+    def _batch_bounds(self, sorted_lengths):
+        bounds, start = [], 0
+        while start < len(sorted_lengths):
+            end = min(start + max(1, self.max_tokens // max(1, int(sorted_lengths[start]))), len(sorted_lengths))
+            bounds.append((start, end))
+            start = end
+        return bounds
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        tie_break = rng.random_sample(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        order = np.lexsort((tie_break, -self.lengths))
+        batches = [order[start:end] for start, end in self._batch_bounds(self.lengths[order])]
+        num_steps = len(self)
+        batches += [batches[i % len(batches)] for i in range(num_steps * self.world_size - len(batches))]
+        steps = np.arange(num_steps)
+        if self.shuffle:
+            rng.shuffle(steps)
+        for step in steps:
+            yield batches[step * self.world_size + self.rank].tolist()
+
+    def __len__(self):
+        return (self.num_batches + self.world_size - 1) // self.world_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
 
 class DataProcessor(object):
     """Base class for data converters for sequence classification data sets."""
@@ -639,7 +720,14 @@ class ColaProcessor(DataProcessor):
                 InputExample(guid=guid, text_a=text_a, text_b=None, label=label))
         return examples
 
-def examples_to_features_worker(example, max_seq_length, tokenizer, label_map, index, max_index, is_training, args):
+_worker_tokenizer = None
+
+def _init_features_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+def examples_to_features_worker(example, max_seq_length, label_map):
+    tokenizer = _worker_tokenizer
     tokens_a = tokenizer.tokenize(example.text_a)
 
     tokens_b = None
@@ -693,53 +781,84 @@ def examples_to_features_worker(example, max_seq_length, tokenizer, label_map, i
 
     input_ids = tokenizer.convert_tokens_to_ids(tokens)
 
-    # The mask has 1 for real tokens and 0 for padding tokens. Only real
-    # tokens are attended to.
-    input_mask = [1] * len(input_ids)
-
-    # Zero-pad up to the sequence length.
-    if not (is_training and args.fast_train):
-        while len(input_ids) < max_seq_length:
-            input_ids.append(0)
-            input_mask.append(0)
-            segment_ids.append(0)
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
+    if len(label_map) != 0:
+        label = label_map[example.label]
     else:
-        assert len(input_ids) == len(input_mask) == len(segment_ids)
+        label = float(example.label)
 
-    label_id = [0] * max_index
-    if len(label_map[index]) != 0:
-        label_id[index] = label_map[index][example.label]
-    else:
-        label_id[index] = example.label
+    return input_ids, segment_ids, label
 
-    return  InputFeatures(
-                    input_ids=input_ids,
-                    input_mask=input_mask,
-                    segment_ids=segment_ids,
-                    label_id=label_id,
-                    index=index,)    
+def convert_examples_to_features(examples, label_list, max_seq_length, pool):
+    """Tokenizes the examples of one task in `pool`, returns the arrays of `PackedFeatures`.
 
-def convert_examples_to_features(args, examples, label_lists, max_seq_length, tokenizer, index, max_index, is_training=False):
-    """Loads a data file into a list of `InputBatch`s."""
-    
-    label_map_lst = []
-    for label_list in label_lists:
-        label_map = {}
-        if len(label_list)!= 1:
-            for (i, label) in enumerate(label_list):
-                label_map[label] = i
-        label_map_lst.append(label_map)
-    pool = Pool(mp.cpu_count())
+    Workers tokenize with the tokenizer given to `_init_features_worker`, so it
+    is pickled once per worker instead of once per example.
+    """
+    label_map = {}
+    if len(label_list) != 1:
+        for (i, label) in enumerate(label_list):
+            label_map[label] = i
     logger.info('start tokenize')
-    features = pool.starmap(examples_to_features_worker, zip(examples, repeat(max_seq_length), repeat(tokenizer), repeat(label_map_lst), repeat(index), repeat(max_index), repeat(is_training), repeat(args)))
-    pool.close()
-    pool.join()
+    worker = partial(examples_to_features_worker, max_seq_length=max_seq_length, label_map=label_map)
+    features = pool.map(worker, examples, chunksize=max(1, min(1024, len(examples) // (4 * mp.cpu_count())))) \
+        if len(examples) else []
+    lengths = np.array([len(input_ids) for input_ids, _, _ in features], dtype=np.int64)
+    return {
+        'input_ids': np.fromiter((i for input_ids, _, _ in features for i in input_ids),
+                                 dtype=np.int32, count=int(lengths.sum())),
+        'segment_ids': np.fromiter((i for _, segment_ids, _ in features for i in segment_ids),
+                                   dtype=np.int8, count=int(lengths.sum())),
+        'offsets': np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(lengths)]),
+        'labels': np.array([label for _, _, label in features], dtype=np.float32),
+    }
+
+class FeatureConverter(object):
+    """Converts the examples of each task to features, with an on-disk cache.
+
+    Cached features are keyed by task, split, max_seq_length and a hash of the
+    vocabulary, casing and examples, so restarting a run with unchanged data
+    skips tokenization. The tokenization pool is only started on a cache miss
+    and is shared by all tasks.
+    """
 
-    return features
+    def __init__(self, args, tokenizer):
+        self.args = args
+        self.tokenizer = tokenizer
+        self.pool = None
+        with open(args.vocab_file, 'rb') as f:
+            self.vocab_hash = hashlib.sha1(f.read()).hexdigest()
+
+    def cache_file(self, task_name, split, examples):
+        digest = hashlib.sha1('{}\t{}\n'.format(self.vocab_hash, self.args.do_lower_case).encode('utf-8'))
+        for example in examples:
+            digest.update('{}\t{}\t{}\n'.format(example.text_a, example.text_b, example.label).encode('utf-8'))
+        cache_dir = self.args.feature_cache_dir or os.path.join(self.args.data_dir, task_name)
+        return os.path.join(cache_dir, 'cached_{}_{}_{}_{}.npz'.format(
+            task_name.lower(), split, self.args.max_seq_length, digest.hexdigest()[:16]))
+
+    def __call__(self, task_name, split, examples, label_list):
+        if len(examples) == 0:
+            return convert_examples_to_features(examples, label_list, self.args.max_seq_length, None)
+        cache_file = self.cache_file(task_name, split, examples)
+        if os.path.exists(cache_file) and not self.args.overwrite_cache:
+            logger.info('Loading features from cached file %s', cache_file)
+            with np.load(cache_file) as cached:
+                return {key: cached[key] for key in cached.files}
+        if self.pool is None:
+            self.pool = Pool(mp.cpu_count(), initializer=_init_features_worker, initargs=(self.tokenizer,))
+        features = convert_examples_to_features(examples, label_list, self.args.max_seq_length, self.pool)
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = '{}.{}.tmp.npz'.format(cache_file[:-len('.npz')], os.getpid())
+        np.savez(tmp_file, **features)
+        os.replace(tmp_file, cache_file)
+        logger.info('Saved features into cached file %s', cache_file)
+        return features
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
 
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
@@ -955,6 +1074,13 @@ def main():
                         type=float, default=128,
                         help='Loss scaling, positive power of 2 values can improve fp16 convergence.')
     parser.add_argument("--num_workers", default=16, type=int, help="data loader workers")
+    parser.add_argument("--max_tokens", default=0, type=int,
+                        help="with --fast_train, batch by at most this many padded tokens per device "
+                             "instead of train_batch_size examples")
+    parser.add_argument("--feature_cache_dir", default=None, type=str,
+                        help="where featurized tasks are cached, defaults to the data dir of each task")
+    parser.add_argument("--overwrite_cache", default=False, action='store_true',
+                        help="featurize again even if cached features exist")
     parser.add_argument("--amp_type", default=None, type=str, help="whether to use mix precision, must in [O0, O1, O2, O3]")
     args = parser.parse_args()
 
@@ -1029,6 +1155,7 @@ def main():
 
     tokenizer = tokenization.FullTokenizer(
         vocab_file=args.vocab_file, do_lower_case=args.do_lower_case)
+    feature_converter = FeatureConverter(args, tokenizer)
 
     train_examples = None
     num_train_steps = None
@@ -1134,23 +1261,16 @@ def main():
     global_step = 0
     if args.do_train:
         logger.info("***** Process training data *****")
-        train_features = []
-        max_index = len(train_examples)
-        for index, train_examples_spec in enumerate(train_examples):
-            train_features.extend(convert_examples_to_features(
-                args, train_examples_spec, label_list, args.max_seq_length, tokenizer, index, max_index, is_training=True))
+        train_features = PackedFeatures.concat([
+            feature_converter(task_name, 'train', train_examples_spec, label_list[index])
+            for index, (task_name, train_examples_spec) in enumerate(zip(args.task_name.split(','), train_examples))])
         logger.info("***** Running training *****")
         logger.info("  Num examples = %d", len(train_features))
         logger.info("  Num tasks = %d", len(train_examples))
         logger.info("  Batch size = %d", args.train_batch_size)
         logger.info("  Num steps = %d", num_train_steps)
         if not args.fast_train:
-            all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-            all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-            all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-            all_label_ids = torch.tensor([f.label_id for f in train_features], dtype=torch.float)
-            all_label_index = torch.tensor([f.index for f in train_features], dtype=torch.long)
-            train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids, all_label_index)
+            train_data = TensorDataset(*train_features.batch(np.arange(len(train_features)), args.max_seq_length))
             if args.local_rank == -1:
                 if args.sequential:
                     train_sampler = SequentialSampler(train_data)
@@ -1159,6 +1279,23 @@ def main():
             else:
                 train_sampler = DistributedSampler(train_data)
             train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+        elif args.max_tokens > 0:
+            train_data = FeatureDataset(train_features)
+            train_sampler = TokenBudgetBatchSampler(train_data.lengths(),
+                                                    args.max_tokens,
+                                                    shuffle=not args.sequential,
+                                                    seed=args.seed,
+                                                    rank=0 if args.local_rank == -1 else torch.distributed.get_rank(),
+                                                    world_size=1 if args.local_rank == -1 else torch.distributed.get_world_size())
+            train_dataloader = DataLoader(train_data,
+                                       batch_sampler=train_sampler,
+                                       num_workers=args.num_workers,
+                                       collate_fn=train_data.collate)
+            # the learning rate schedule follows the number of token-budget batches
+            num_train_steps = int(len(train_sampler) / args.gradient_accumulation_steps * args.num_train_epochs)
+            for group in optimizer.param_groups:
+                group['t_total'] = num_train_steps
+            logger.info("  Num token-budget batches = %d, num steps = %d", len(train_sampler), num_train_steps)
         else:
             train_data = FeatureDataset(train_features)
             train_sampler = SortedBatchSampler(train_data.lengths(),
@@ -1168,7 +1305,7 @@ def main():
                                        batch_size=args.train_batch_size,
                                        sampler = train_sampler,
                                        num_workers=args.num_workers,
-                                       collate_fn=batchify,
+                                       collate_fn=train_data.collate,
                                        drop_last=len(train_data) % args.train_batch_size == 1)
 
     if args.do_eval:
@@ -1187,20 +1324,14 @@ def main():
                 else:
                     eval_examples.append(processor.get_dev_examples(data_dir, add_token=True))
         max_eval_index = len(eval_examples)
-        eval_features = []
-        for index, eval_examples_spec in enumerate(eval_examples):
-            eval_features.extend(convert_examples_to_features(
-                args, eval_examples_spec, label_list, args.max_seq_length, tokenizer, index, max_eval_index))
+        eval_features = PackedFeatures.concat([
+            feature_converter(task_name, 'dev', eval_examples_spec, label_list[index])
+            for index, (task_name, eval_examples_spec) in enumerate(zip(args.task_name.split(','), eval_examples))])
         logger.info("***** Running evaluation *****")
         logger.info("  Num examples = %d", len(eval_features))
         logger.info("  Num tasks = %d", len(eval_examples))
         logger.info("  Batch size = %d", args.eval_batch_size)
-        all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
-        all_label_ids = torch.tensor([f.label_id for f in eval_features], dtype=torch.float)
-        all_label_index = torch.tensor([f.index for f in eval_features], dtype=torch.long)
-        eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids, all_label_index)
+        eval_data = TensorDataset(*eval_features.batch(np.arange(len(eval_features)), args.max_seq_length))
         if args.local_rank == -1:
             eval_sampler = SequentialSampler(eval_data)
         else:
@@ -1224,29 +1355,28 @@ def main():
                     test_examples.append(processor.get_test_examples(data_dir))
                 else:
                     test_examples.append(processor.get_test_examples(data_dir, add_token=True))
-        max_test_index = len(test_examples)
-        test_features = []
-        for index, test_examples_spec in enumerate(test_examples):
-            test_features.extend(convert_examples_to_features(
-                args, test_examples_spec, label_list, args.max_seq_length, tokenizer, index, max_test_index))
+        test_features = PackedFeatures.concat([
+            feature_converter(task_name, 'test', test_examples_spec, label_list[index])
+            for index, (task_name, test_examples_spec) in enumerate(zip(args.task_name.split(','), test_examples))])
         logger.info("***** Running prediction *****")
         logger.info("  Num examples = %d", len(test_features))
         logger.info("  Num tasks = %d", len(test_examples))
         logger.info("  Batch size = %d", args.eval_batch_size)
-        all_input_ids = torch.tensor([f.input_ids for f in test_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in test_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in test_features], dtype=torch.long)
-        all_label_index = torch.tensor([f.index for f in test_features], dtype=torch.long)
-        test_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_index)
+        test_data = TensorDataset(*test_features.batch(
+            np.arange(len(test_features)), args.max_seq_length, with_labels=False))
         if args.local_rank == -1:
             test_sampler = SequentialSampler(test_data)
         else:
             test_sampler = DistributedSampler(test_data)
         test_dataloader = DataLoader(test_data, sampler=test_sampler, batch_size=args.eval_batch_size)
 
+    feature_converter.close()
+
     if args.do_train:
         for epoch_id in trange(int(args.num_train_epochs), desc="Epoch"):
             model.train()
+            if isinstance(train_sampler, TokenBudgetBatchSampler):
+                train_sampler.set_epoch(epoch_id)
             tr_loss = 0
             nb_tr_examples, nb_tr_steps = 0, 0
             for step, batch in enumerate(tqdm(train_dataloader, desc="Iteration")):
@@ -141,6 +141,8 @@ def parse_args():
 
     parser.add_argument("--use_hdf5", dest='use_hdf5', action='store_const', default=False, const=True)
     parser.add_argument("--use_npz", dest='use_npz', action='store_const', default=False, const=True)
+    parser.add_argument("--use_mmap", dest='use_mmap', action='store_const', default=False, const=True,
+                        help='read --image_hdf5_file as store directories written by utils.py')
     parser.add_argument("--use_jpg", dest='use_jpg', action='store_const', default=False, const=True)
     parser.add_argument("--image_hdf5_file", dest='image_hdf5_file', default='data/mscoco_imgfeat/train2014_obj36.tsv.token,data/mscoco_imgfeat/val2014_obj36.tsv.token', type=str)
     parser.add_argument("--padding", dest='padding', action='store_const', default=False, const=True)
@@ -8,7 +8,7 @@ from torch.utils.data import Dataset
 import logging
 
 from param import args
-from utils import load_obj_tsv
+from utils import load_obj_tsv, ObjFeatureStore
 import h5py
 import base64
 import glob
@@ -95,6 +95,14 @@ class NLVR2TorchDataset(Dataset):
                     image_id = image_npz_file.split('/')[-1].split('.')[0]
                     self.imgid2img[image_id] = image_npz_file
             logger.info('total image number is: {}'.format(len(self.imgid2img)))
+        elif args.use_mmap:
+            self.imgid2img = {}
+            self.image_stores = [ObjFeatureStore(store_dir) for store_dir in args.image_hdf5_file.split(',')]
+            for i, image_store in enumerate(self.image_stores):
+                img_ids = image_store.img_ids if topk == -1 else image_store.img_ids[:topk]
+                for row, image_id in enumerate(img_ids):
+                    self.imgid2img[image_id] = (i, row)
+            logger.info('total image number is: {}'.format(len(self.imgid2img)))
         else:
             img_data = []
             if 'train' in dataset.splits:
@@ -143,6 +151,13 @@ class NLVR2TorchDataset(Dataset):
                 obj_num = img_info['num_boxes']
                 feats = img_info['features'].copy()
                 boxes = img_info['boxes'].copy()
+            elif args.use_mmap:
+                store_idx, row = self.imgid2img[img_id]
+                img_info = self.image_stores[store_idx][row]
+                boxes = img_info['boxes'].copy()
+                feats = img_info['features'].copy()
+                obj_num = img_info['num_boxes']
+                img_h, img_w = img_info['img_h'], img_info['img_w']
             else:
                 img_info = self.imgid2img[img_id]
                 boxes = img_info['boxes'].copy()
@@ -1,6 +1,7 @@
 # coding=utf-8
 # Copyleft 2019 project LXRT.
 
+import itertools
 import json
 import os
 import pickle
@@ -11,7 +12,7 @@ import logging
 from torch.utils.data import Dataset
 
 from param import args
-from utils import load_obj_tsv
+from utils import load_obj_tsv, ObjFeatureStore
 import h5py
 import base64
 import glob
@@ -130,6 +131,19 @@ class VQATorchDataset(Dataset):
                     image_id = image_npz_file.split('/')[-1].split('.')[0]
                     self.imgid2img[image_id] = image_npz_file
             logger.info('total image number is: {}'.format(len(self.imgid2img)))
+        elif args.use_mmap:
+            self.imgid2img = {}
+            self.image_stores = [ObjFeatureStore(store_dir) for store_dir in args.image_hdf5_file.split(',')]
+            for split in dataset.splits:
+                # Same images as the tsv path: the first load_topk images of the split's tsv,
+                # e.g. the COCO_val2014_* images in store order for minival.
+                source = SPLIT2NAME[split].split('.')[0]
+                load_topk = 5000 if (split == 'minival' and topk is None) else topk
+                split_images = ((i, row, image_id) for i, image_store in enumerate(self.image_stores)
+                                for row, image_id in enumerate(image_store.img_ids) if source in image_id)
+                for i, row, image_id in itertools.islice(split_images, load_topk):
+                    self.imgid2img[image_id] = (i, row)
+            logger.info('total image number is: {}'.format(len(self.imgid2img)))
         else:
             img_data = []
             for split in dataset.splits:
@@ -177,6 +191,13 @@ class VQATorchDataset(Dataset):
             obj_num = img_info['num_boxes']
             feats = img_info['features'].copy()
             boxes = img_info['boxes'].copy()
+        elif args.use_mmap:
+            store_idx, row = self.imgid2img[img_id]
+            img_info = self.image_stores[store_idx][row]
+            img_h, img_w = img_info['img_h'], img_info['img_w']
+            obj_num = img_info['num_boxes']
+            feats = img_info['features'].copy()
+            boxes = img_info['boxes'].copy()
         else:
             img_info = self.imgid2img[img_id]
             obj_num = img_info['num_boxes']
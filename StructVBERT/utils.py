@@ -1,8 +1,11 @@
 # coding=utf-8
 # Copyleft 2019 Project LXRT
 
+import os
 import sys
+import glob
 import csv
+import json
 import base64
 import time
 import logging
@@ -60,3 +63,147 @@ def load_obj_tsv(fname, topk=None):
     logger.info("Loaded %d images in file %s in %d seconds." % (len(data), fname, elapsed_time))
     return data
 
+
+
+def iter_obj_tsv(fname):
+    """Stream (img_id, img_h, img_w, boxes, features) from a Faster-RCNN tsv file."""
+    with open(fname) as f:
+        reader = csv.DictReader(f, FIELDNAMES, delimiter="\t")
+        for item in reader:
+            num_boxes = int(item['num_boxes'])
+            boxes = np.frombuffer(base64.b64decode(item['boxes']), dtype=np.float32).reshape((num_boxes, 4))
+            features = np.frombuffer(base64.b64decode(item['features']), dtype=np.float32).reshape((num_boxes, -1))
+            yield item['img_id'], int(item['img_h']), int(item['img_w']), boxes, features
+
+
+def iter_obj_hdf5(fname):
+    """Stream (img_id, img_h, img_w, boxes, features) from the HDF5 file read with --use_hdf5."""
+    import h5py
+    with h5py.File(fname, 'r') as all_images:
+        for img_id in all_images.keys():
+            img_info = all_images[img_id]
+            img_h, img_w, obj_num = np.frombuffer(base64.b64decode(img_info[0]), dtype=np.int64).tolist()
+            features = np.frombuffer(base64.b64decode(img_info[6]), dtype=np.float32).reshape((obj_num, -1))
+            boxes = np.frombuffer(base64.b64decode(img_info[5]), dtype=np.float32).reshape((obj_num, 4))
+            yield img_id, img_h, img_w, boxes, features
+
+
+def iter_obj_npz(image_dir):
+    """Stream (img_id, img_h, img_w, boxes, features) from a directory of per-image .npz files."""
+    for npz_file in sorted(glob.glob(os.path.join(image_dir, '*.npz'))):
+        img_id = npz_file.split('/')[-1].split('.')[0]
+        img_info = np.load(npz_file)
+        yield img_id, int(img_info['img_h']), int(img_info['img_w']), \
+            img_info['boxes'].astype(np.float32), img_info['features'].astype(np.float32)
+
+
+def convert_obj_features(fnames, store_dir):
+    """One-time conversion of Faster-RCNN features to an `ObjFeatureStore` directory.
+
+    :param fnames: tsv files (see FIELDNAMES), HDF5 files ending in .h5/.hdf5
+        in the layout read with --use_hdf5, or directories of .npz files as
+        read with --use_npz.
+    :param store_dir: Output directory. The raw arrays are written first and
+        `meta.json` last, so a directory with `meta.json` is complete.
+    """
+    start_time = time.time()
+    os.makedirs(store_dir, exist_ok=True)
+    meta_file = os.path.join(store_dir, 'meta.json')
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+
+    img_ids, img_hw, offsets = [], [], [0]
+    feat_dim = None
+    with open(os.path.join(store_dir, 'features.bin'), 'wb') as features_writer, \
+            open(os.path.join(store_dir, 'boxes.bin'), 'wb') as boxes_writer:
+        for fname in fnames:
+            logger.info("Converting Faster-RCNN detected objects from %s" % fname)
+            if os.path.isdir(fname):
+                items = iter_obj_npz(fname)
+            elif fname.endswith('.h5') or fname.endswith('.hdf5'):
+                items = iter_obj_hdf5(fname)
+            else:
+                items = iter_obj_tsv(fname)
+            for img_id, img_h, img_w, boxes, features in items:
+                if feat_dim is None:
+                    feat_dim = features.shape[1]
+                assert features.shape[1] == feat_dim, \
+                    "%s has %d-d features, expected %d" % (img_id, features.shape[1], feat_dim)
+                features_writer.write(features.tobytes())
+                boxes_writer.write(boxes.tobytes())
+                img_ids.append(img_id)
+                img_hw.append((img_h, img_w))
+                offsets.append(offsets[-1] + len(boxes))
+
+    np.array(offsets, dtype=np.int64).tofile(os.path.join(store_dir, 'offsets.bin'))
+    np.array(img_hw, dtype=np.int64).reshape((-1, 2)).tofile(os.path.join(store_dir, 'img_hw.bin'))
+    with open(os.path.join(store_dir, 'img_ids.json'), 'w') as f:
+        json.dump(img_ids, f)
+    with open(meta_file, 'w') as f:
+        json.dump({'num_images': len(img_ids), 'num_boxes': offsets[-1], 'feat_dim': feat_dim or 0}, f)
+    elapsed_time = time.time() - start_time
+    logger.info("Converted %d images (%d boxes) to %s in %d seconds." % (
+        len(img_ids), offsets[-1], store_dir, elapsed_time))
+
+
+class ObjFeatureStore(object):
+    """Memory-mapped object features written by `convert_obj_features`.
+
+    Rows are the images in conversion order; `store[row]` returns the same
+    keys as `load_obj_tsv` for the fields the datasets use (img_id, img_h,
+    img_w, num_boxes, boxes, features), with boxes and features as read-only
+    views into the mapped files. Opening only reads the offsets and the ids,
+    and all DataLoader workers share the page cache of the mapped arrays.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(store_dir, 'img_ids.json')) as f:
+            self.img_ids = json.load(f)
+        self.img_hw = np.fromfile(os.path.join(store_dir, 'img_hw.bin'), dtype=np.int64).reshape((-1, 2))
+        self.offsets = np.fromfile(os.path.join(store_dir, 'offsets.bin'), dtype=np.int64)
+        self._features = None
+        self._boxes = None
+
+    def _open(self):
+        num_boxes = self.meta['num_boxes']
+        self._features = np.memmap(os.path.join(self.store_dir, 'features.bin'), dtype=np.float32, mode='r',
+                                   shape=(num_boxes, self.meta['feat_dim']))
+        self._boxes = np.memmap(os.path.join(self.store_dir, 'boxes.bin'), dtype=np.float32, mode='r',
+                                shape=(num_boxes, 4))
+
+    def __getstate__(self):
+        # the maps are reopened in every worker instead of being pickled as arrays
+        state = self.__dict__.copy()
+        state['_features'] = None
+        state['_boxes'] = None
+        return state
+
+    def __len__(self):
+        return len(self.img_ids)
+
+    def __getitem__(self, row):
+        if self._features is None:
+            self._open()
+        start, end = self.offsets[row], self.offsets[row + 1]
+        img_h, img_w = self.img_hw[row].tolist()
+        return {
+            'img_id': self.img_ids[row],
+            'img_h': img_h,
+            'img_w': img_w,
+            'num_boxes': int(end - start),
+            'boxes': self._boxes[start:end],
+            'features': self._features[start:end],
+        }
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert Faster-RCNN features to a memory-mapped store '
+                                                 'read with --use_mmap.')
+    parser.add_argument('inputs', nargs='+', help='tsv files, HDF5 (.h5/.hdf5) files or directories of .npz files')
+    parser.add_argument('--output', required=True, help='store directory')
+    cli_args = parser.parse_args()
+    convert_obj_features(cli_args.inputs, cli_args.output)
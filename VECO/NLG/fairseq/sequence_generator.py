@@ -593,61 +593,28 @@ class SequenceGenerator(nn.Module):
             return True
         return False
 
-    def calculate_banned_tokens(
-        self,
-        tokens,
-        step: int,
-        gen_ngrams: List[Dict[str, List[int]]],
-        no_repeat_ngram_size: int,
-        bbsz_idx: int,
-    ):
-        tokens_list: List[int] = tokens[
-            bbsz_idx, step + 2 - no_repeat_ngram_size : step + 1
-        ].tolist()
-        # before decoding the next token, prevent decoding of ngrams that have already appeared
-        ngram_index = ",".join([str(x) for x in tokens_list])
-        return gen_ngrams[bbsz_idx].get(ngram_index, torch.jit.annotate(List[int], []))
-
-    def transpose_list(self, l: List[List[int]]):
-        # GeneratorExp aren't supported in TS so ignoring the lint
-        min_len = min([len(x) for x in l])  # noqa
-        l2 = [[row[i] for row in l] for i in range(min_len)]
-        return l2
-
     def _no_repeat_ngram(self, tokens, lprobs, bsz: int, beam_size: int, step: int):
-        # for each beam and batch sentence, generate a list of previous ngrams
-        gen_ngrams: List[Dict[str, List[int]]] = [
-            torch.jit.annotate(Dict[str, List[int]], {})
-            for bbsz_idx in range(bsz * beam_size)
-        ]
-        cpu_tokens = tokens.cpu()
-        for bbsz_idx in range(bsz * beam_size):
-            gen_tokens: List[int] = cpu_tokens[bbsz_idx].tolist()
-            for ngram in self.transpose_list(
-                [gen_tokens[i:] for i in range(self.no_repeat_ngram_size)]
-            ):
-                key = ",".join([str(x) for x in ngram[:-1]])
-                gen_ngrams[bbsz_idx][key] = gen_ngrams[bbsz_idx].get(
-                    key, torch.jit.annotate(List[int], [])
-                ) + [ngram[-1]]
+        """
+        Prevent every hypothesis from generating an ngram it already contains.
 
-        if step + 2 - self.no_repeat_ngram_size >= 0:
+        All ngrams of the generated prefixes are taken at once with `unfold`,
+        their first n-1 tokens are compared with the last n-1 tokens of each
+        hypothesis, and the tokens following the matches are banned with a
+        single scatter. Everything stays on the device of `tokens`.
+        """
+        ngram_size = self.no_repeat_ngram_size
+        if step + 2 - ngram_size <= 0:
             # no banned tokens if we haven't generated no_repeat_ngram_size tokens yet
-            banned_tokens = [
-                self.calculate_banned_tokens(
-                    tokens, step, gen_ngrams, self.no_repeat_ngram_size, bbsz_idx
-                )
-                for bbsz_idx in range(bsz * beam_size)
-            ]
-        else:
-            banned_tokens = [
-                torch.jit.annotate(List[int], []) for bbsz_idx in range(bsz * beam_size)
-            ]
-        for bbsz_idx in range(bsz * beam_size):
-            lprobs[bbsz_idx][
-                torch.tensor(banned_tokens[bbsz_idx]).long()
-            ] = torch.tensor(-math.inf, dtype=torch.float)
-        return lprobs
+            return lprobs
+        # bsz * beam_size x (step + 2 - ngram_size) x ngram_size
+        ngrams = tokens[:, : step + 1].unfold(1, ngram_size, 1)
+        # before decoding the next token, prevent decoding of ngrams that have already appeared
+        last_tokens = tokens[:, step + 2 - ngram_size : step + 1].unsqueeze(1)
+        matches = ngrams[:, :, :-1].eq(last_tokens).all(dim=2)
+        banned = torch.zeros_like(lprobs).scatter_add_(
+            1, ngrams[:, :, -1], matches.type_as(lprobs)
+        )
+        return lprobs.masked_fill(banned > 0, -math.inf)
 
 
 class EnsembleModel(nn.Module):
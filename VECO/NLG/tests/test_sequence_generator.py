@@ -315,6 +315,34 @@ class TestSequeneceGenerator(TestSequenceGeneratorBase):
         self.assertHypoTokens(hypos[0][0], [w1, eos])
         self.assertHypoScore(hypos[0][0], [0.9, 1.0])
 
+    def test_no_repeat_ngram(self):
+        pad, eos = self.tgt_dict.pad(), self.tgt_dict.eos()
+        vocab_size = len(self.tgt_dict)
+        torch.manual_seed(0)
+        for ngram_size in [1, 2, 3]:
+            generator = SequenceGenerator(
+                [self.model], self.tgt_dict, beam_size=2, no_repeat_ngram_size=ngram_size
+            )
+            for step in range(8):
+                tokens = torch.full((4, 10), pad, dtype=torch.long)
+                tokens[:, 0] = eos
+                tokens[:, 1 : step + 1] = torch.randint(4, vocab_size, (4, step))
+                lprobs = torch.randn(4, vocab_size)
+                banned = generator._no_repeat_ngram(tokens, lprobs.clone(), 2, 2, step)
+                for row in range(4):
+                    prefix = tokens[row, : step + 1].tolist()
+                    last = prefix[len(prefix) - ngram_size + 1:] if ngram_size > 1 else []
+                    expected = set()
+                    if step + 2 - ngram_size > 0:
+                        for i in range(len(prefix) - ngram_size + 1):
+                            if prefix[i : i + ngram_size - 1] == last:
+                                expected.add(prefix[i + ngram_size - 1])
+                    for idx in range(vocab_size):
+                        if idx in expected:
+                            self.assertEqual(banned[row, idx].item(), float("-inf"))
+                        else:
+                            self.assertEqual(banned[row, idx].item(), lprobs[row, idx].item())
+
 
 class TestDiverseBeamSearch(TestSequenceGeneratorBase):
 
@@ -0,0 +1,82 @@
+"""Sentences/sec of `extract_embeddings` on CPU, file order versus length buckets.
+
+Embeds a random corpus with mixed sentence lengths using a small randomly
+initialized XLM-R, once in file-order batches of `--batch_size` and once in
+length-bucketed batches of at most `--max_tokens` padded tokens written to
+.npy memmaps, and compares the pooled embeddings of both.
+
+    python benchmark_extract_embeddings.py --num_sents 4000 --max_tokens 8192
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import torch
+from transformers import BertTokenizer, XLMRobertaConfig, XLMRobertaModel
+
+from run_retrieval import extract_embeddings
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_sents', type=int, default=4000)
+parser.add_argument('--vocab_size', type=int, default=5000)
+parser.add_argument('--hidden_size', type=int, default=256)
+parser.add_argument('--num_hidden_layers', type=int, default=4)
+parser.add_argument('--batch_size', type=int, default=100)
+parser.add_argument('--max_tokens', type=int, default=8192)
+parser.add_argument('--max_seq_length', type=int, default=256)
+parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 keeps the default')
+parser.add_argument('--seed', type=int, default=42)
+
+
+def write_corpus(work_dir, num_sents, vocab_size, max_seq_length, rng):
+  """Vocabulary file and tokenized corpus, lengths are log-normal like real corpora."""
+  vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + ['w{}'.format(i) for i in range(vocab_size - 5)]
+  vocab_file = os.path.join(work_dir, 'vocab.txt')
+  with open(vocab_file, 'w') as f:
+    f.write('\n'.join(vocab) + '\n')
+  lengths = np.clip(rng.lognormal(3.0, 0.7, num_sents).astype(int), 3, max_seq_length - 2)
+  tok_file = os.path.join(work_dir, 'corpus.tok')
+  with open(tok_file, 'w') as f:
+    for length in lengths:
+      f.write(' '.join(vocab[i] for i in rng.randint(5, vocab_size, length)) + '\n')
+  return vocab_file, tok_file, lengths
+
+
+if __name__ == '__main__':
+  cli = parser.parse_args()
+  if cli.threads > 0:
+    torch.set_num_threads(cli.threads)
+  torch.manual_seed(cli.seed)
+  rng = np.random.RandomState(cli.seed)
+  work_dir = tempfile.mkdtemp()
+
+  vocab_file, tok_file, lengths = write_corpus(work_dir, cli.num_sents, cli.vocab_size, cli.max_seq_length, rng)
+  tokenizer = BertTokenizer(vocab_file)
+  config = XLMRobertaConfig(vocab_size=cli.vocab_size, hidden_size=cli.hidden_size,
+                            num_hidden_layers=cli.num_hidden_layers, num_attention_heads=4,
+                            intermediate_size=4 * cli.hidden_size, max_position_embeddings=cli.max_seq_length + 2,
+                            pad_token_id=tokenizer.pad_token_id, output_hidden_states=True, return_dict=False)
+  model = XLMRobertaModel(config)
+
+  args = argparse.Namespace(num_layers=cli.num_hidden_layers + 1, batch_size=cli.batch_size, device='cpu',
+                            max_seq_length=cli.max_seq_length, pool_skip_special_token=False,
+                            embed_size=cli.hidden_size, max_tokens=0)
+  print('{} sentences, length mean {:.1f} max {}'.format(cli.num_sents, lengths.mean(), lengths.max()))
+
+  start = time.time()
+  file_order = extract_embeddings(args, model, config, tokenizer, None, tok_file, None)
+  file_order_time = time.time() - start
+
+  args.max_tokens = cli.max_tokens
+  start = time.time()
+  bucketed = extract_embeddings(args, model, config, tokenizer, None, tok_file, os.path.join(work_dir, 'emb'))
+  bucketed_time = time.time() - start
+
+  diff = max(np.abs(a - b).max() for a, b in zip(file_order, bucketed))
+  print('file order (batch_size={}):  {:8.1f} sents/s'.format(cli.batch_size, cli.num_sents / file_order_time))
+  print('bucketed (max_tokens={}):  {:8.1f} sents/s'.format(cli.max_tokens, cli.num_sents / bucketed_time))
+  print('speedup {:.2f}x, max |diff| {:.2e}'.format(file_order_time / bucketed_time, diff))
+  shutil.rmtree(work_dir)
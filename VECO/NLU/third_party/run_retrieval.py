@@ -111,6 +111,22 @@ def tokenize_text(text_file, tok_file, tokenizer, lang=None):
   logger.info('==================================')
   return tok_sentences
 
+def length_bucketed_batches(lengths, max_tokens):
+  """
+  Group sentence indices by length: sentences are sorted by `lengths` and cut
+  into batches whose padded size (batch size x longest length) stays within
+  `max_tokens`. The batches are returned longest first.
+  """
+  order = np.argsort(lengths, kind='stable')
+  batches = []
+  start = 0
+  for end in range(1, len(order) + 1):
+    if end == len(order) or (end + 1 - start) * lengths[order[end]] > max_tokens:
+      batches.append(order[start:end])
+      start = end
+  return batches[::-1]
+
+
 def extract_embeddings(args, model, config, tokenizer, text_file, tok_file, embed_file, lang='en', pool_type='mean'):
   num_embeds = args.num_layers
   all_embed_files = ["{}_{}.npy".format(embed_file, i) for i in range(num_embeds)]
@@ -123,6 +139,11 @@ def extract_embeddings(args, model, config, tokenizer, text_file, tok_file, embe
   sent_toks = tokenize_text(text_file, tok_file, tokenizer, lang)
   max_length = max([len(s) for s in sent_toks])
   logger.info('max length of tokenized text = {}'.format(max_length))
+
+  if args.max_tokens > 0:
+    return extract_embeddings_bucketed(args, model, tokenizer, sent_toks,
+                                       all_embed_files if embed_file is not None else None,
+                                       lang=lang, langid=langid, pool_type=pool_type)
   
   batch_size = args.batch_size
   num_batch = int(np.ceil(len(sent_toks) * 1.0 / batch_size))
@@ -164,6 +185,51 @@ def extract_embeddings(args, model, config, tokenizer, text_file, tok_file, embe
   return all_embeds
 
 
+def extract_embeddings_bucketed(args, model, tokenizer, sent_toks, all_embed_files=None, lang='en', langid=0, pool_type='mean'):
+  """
+  Embed sentences in length-sorted batches of at most `args.max_tokens` padded
+  tokens. The pooled embeddings are written in the original sentence order,
+  straight into one .npy memmap per layer when `all_embed_files` is given.
+  """
+  num_sents = len(sent_toks)
+  lengths = np.array([min(len(s), args.max_seq_length - 2) + 2 for s in sent_toks])
+  batches = length_bucketed_batches(lengths, args.max_tokens)
+  logger.info('{} sentences in {} length-bucketed batches of at most {} tokens'.format(
+    num_sents, len(batches), args.max_tokens))
+
+  if all_embed_files is not None:
+    # written under .tmp names and renamed once complete, extract_embeddings reuses any existing file
+    all_embeds = [np.lib.format.open_memmap(f + '.tmp', mode='w+', dtype=np.float32, shape=(num_sents, args.embed_size))
+                  for f in all_embed_files]
+  else:
+    all_embeds = [np.zeros(shape=(num_sents, args.embed_size), dtype=np.float32) for _ in range(args.num_layers)]
+
+  for indices in tqdm(batches, desc='Batch'):
+    batch, pool_mask = prepare_batch([sent_toks[i] for i in indices],
+                                     tokenizer,
+                                     args.device,
+                                     args.max_seq_length,
+                                     lang=lang,
+                                     langid=langid,
+                                     pool_skip_special_token=args.pool_skip_special_token)
+    with torch.no_grad():
+      all_layer_outputs = model(**batch)[2][-args.num_layers:]
+      if pool_type == 'cls':
+        all_batch_embeds = cls_pool_embedding(all_layer_outputs)
+      else:
+        all_batch_embeds = mean_pool_embedding(all_layer_outputs, pool_mask)
+
+    for embeds, batch_embeds in zip(all_embeds, all_batch_embeds):
+      embeds[indices] = batch_embeds.cpu().numpy().astype(np.float32)
+
+  if all_embed_files is not None:
+    for file, embeds in zip(all_embed_files, all_embeds):
+      logger.info('save embed {} to file {}'.format(embeds.shape, file))
+      embeds.flush()
+      os.replace(file + '.tmp', file)
+  return all_embeds
+
+
 def mean_pool_embedding(all_layer_outputs, masks):
   """
     Args:
@@ -234,6 +300,8 @@ def main():
   parser.add_argument("--src_languages", type=str, default="en", help="source languages separated by ','.")
   parser.add_argument("--tgt_language", type=str, default="de", help="target language.")
   parser.add_argument("--batch_size", type=int, default=100, help="batch size.")
+  parser.add_argument("--max_tokens", type=int, default=0,
+                      help="if > 0, batch length-sorted sentences up to this many padded tokens instead of batch_size.")
   parser.add_argument("--tgt_text_file", type=str, default=None, help="tgt_text_file.")
   parser.add_argument("--src_text_file", type=str, default=None, help="src_text_file.")
   parser.add_argument("--tgt_embed_file", type=str, default=None, help="tgt_embed_file")
@@ -246,6 +314,8 @@ def main():
   parser.add_argument("--candidate_prefix", type=str, default="candidates")
   parser.add_argument("--pool_skip_special_token", action="store_true")
   parser.add_argument("--dist", type=str, default='cosine')
+  parser.add_argument("--knn_backend", type=str, default='faiss', choices=['faiss', 'numpy'],
+                      help="nearest neighbor search with faiss, or exact blocked numpy search without faiss")
   parser.add_argument("--use_shift_embeds", action="store_true")
   parser.add_argument("--extract_embeds", action="store_true")
   parser.add_argument("--mine_bitext", action="store_true")
@@ -346,17 +416,22 @@ def main():
     src_emb_file = os.path.join(args.output_dir, '{}-en.emb.{}.npy'.format(src_lang2, src_lang2))
     tgt_emb_file = os.path.join(args.output_dir, '{}-en.emb.en.npy'.format(src_lang2))
 
-    if os.path.exists(src_emb_file):
-      all_src_embeds = np.load(src_emb_file)
+    if args.max_tokens > 0:
+      # one memmapped .npy per layer, reused on the next run
+      all_src_embeds = extract_embeddings(args, model, config, tokenizer, src_text_file, src_tok_file, src_emb_file[:-4], lang=src_lang2)
+      all_tgt_embeds = extract_embeddings(args, model, config, tokenizer, tgt_text_file, tgt_tok_file, tgt_emb_file[:-4], lang=tgt_lang2)
     else:
-      all_src_embeds = extract_embeddings(args, model, config, tokenizer, src_text_file, src_tok_file, None, lang=src_lang2)
-      np.save(src_emb_file, all_src_embeds)
+      if os.path.exists(src_emb_file):
+        all_src_embeds = np.load(src_emb_file)
+      else:
+        all_src_embeds = extract_embeddings(args, model, config, tokenizer, src_text_file, src_tok_file, None, lang=src_lang2)
+        np.save(src_emb_file, all_src_embeds)
 
-    if os.path.exists(tgt_emb_file):
-      all_tgt_embeds = np.load(tgt_emb_file)
-    else:
-      all_tgt_embeds = extract_embeddings(args, model, config, tokenizer, tgt_text_file, tgt_tok_file, None, lang=tgt_lang2)
-      np.save(tgt_emb_file, all_tgt_embeds)
+      if os.path.exists(tgt_emb_file):
+        all_tgt_embeds = np.load(tgt_emb_file)
+      else:
+        all_tgt_embeds = extract_embeddings(args, model, config, tokenizer, tgt_text_file, tgt_tok_file, None, lang=tgt_lang2)
+        np.save(tgt_emb_file, all_tgt_embeds)
 
     idx = list(range(1, len(all_src_embeds) + 1, 4))
     best_score = 0
@@ -364,11 +439,12 @@ def main():
     num_layers = len(all_src_embeds)
     for i in [args.specific_layer]:
       x, y = all_src_embeds[i], all_tgt_embeds[i]
-      predictions = similarity_search(x, y, args.embed_size, normalize=(args.dist == 'cosine'))
+      predictions = similarity_search(x, y, args.embed_size, normalize=(args.dist == 'cosine'),
+                                      knn_backend=args.knn_backend)
       with open(os.path.join(args.output_dir, f'test_{src_lang2}_predictions.txt'), 'w') as fout:
         for p in predictions:
           fout.write(str(p) + '\n')
           
 
-main()
-
+if __name__ == "__main__":
+  main()
@@ -20,41 +20,81 @@
 
 import os
 import sys
-import faiss
 import tempfile
 import numpy as np
-import faiss
+try:
+  import faiss
+except ImportError:
+  faiss = None
 
 
-def knn(x, y, k, use_gpu, dist='cosine'):
+def knn(x, y, k, use_gpu, dist='cosine', backend='faiss'):
+  if backend == 'numpy':
+    return knnNumpy(x, y, k, dist)
   return knnGPU(x, y, k) if use_gpu else knnCPU(x, y, k, dist)
 
 
 def knnGPU(x, y, k, mem=5*1024*1024*1024):
   dim = x.shape[1]
   batch_size = mem // (dim*4)
+  xblocks = [(xfrom, min(xfrom + batch_size, x.shape[0])) for xfrom in range(0, x.shape[0], batch_size)]
+  bsims = [[] for _ in xblocks]
+  binds = [[] for _ in xblocks]
+  # one index per y-block, searched by every x-block
+  for yfrom in range(0, y.shape[0], batch_size):
+    yto = min(yfrom + batch_size, y.shape[0])
+    idx = faiss.IndexFlatIP(dim)
+    idx = faiss.index_cpu_to_all_gpus(idx)
+    idx.add(y[yfrom:yto])
+    for b, (xfrom, xto) in enumerate(xblocks):
+      print('{}-{}  ->  {}-{}'.format(xfrom, xto, yfrom, yto))
+      bsim, bind = idx.search(x[xfrom:xto], min(k, yto-yfrom))
+      bsims[b].append(bsim)
+      binds[b].append(bind + yfrom)
+    del idx
   sim = np.zeros((x.shape[0], k), dtype=np.float32)
   ind = np.zeros((x.shape[0], k), dtype=np.int64)
+  for b, (xfrom, xto) in enumerate(xblocks):
+    bsim = np.concatenate(bsims[b], axis=1)
+    bind = np.concatenate(binds[b], axis=1)
+    aux = np.argsort(-bsim, axis=1)[:, :k]
+    sim[xfrom:xto] = np.take_along_axis(bsim, aux, axis=1)
+    ind[xfrom:xto] = np.take_along_axis(bind, aux, axis=1)
+  return sim, ind
+
+
+def knnNumpy(x, y, k, dist='cosine', batch_size=4096):
+  """
+  Exact k-nn without faiss: the similarities of a batch_size x batch_size
+  block are reduced to their top-k, which is merged into the running top-k
+  of the x-block. Similarities are inner products for 'cosine' (x and y are
+  normalized by the caller) and 1 / (1 + squared L2 distance) otherwise,
+  as returned by knnCPU.
+  """
+  sim = np.zeros((x.shape[0], k), dtype=np.float32)
+  ind = np.zeros((x.shape[0], k), dtype=np.int64)
+  if dist != 'cosine':
+    y_sqnorm = (y ** 2).sum(axis=1)
   for xfrom in range(0, x.shape[0], batch_size):
     xto = min(xfrom + batch_size, x.shape[0])
-    bsims, binds = [], []
+    bsim = np.zeros((xto - xfrom, 0), dtype=np.float32)
+    bind = np.zeros((xto - xfrom, 0), dtype=np.int64)
     for yfrom in range(0, y.shape[0], batch_size):
       yto = min(yfrom + batch_size, y.shape[0])
-      print('{}-{}  ->  {}-{}'.format(xfrom, xto, yfrom, yto))
-      idx = faiss.IndexFlatIP(dim)
-      idx = faiss.index_cpu_to_all_gpus(idx)
-      idx.add(y[yfrom:yto])
-      bsim, bind = idx.search(x[xfrom:xto], min(k, yto-yfrom))
-      bsims.append(bsim)
-      binds.append(bind + yfrom)
-      del idx
-    bsims = np.concatenate(bsims, axis=1)
-    binds = np.concatenate(binds, axis=1)
-    aux = np.argsort(-bsims, axis=1)
-    for i in range(xfrom, xto):
-      for j in range(k):
-        sim[i, j] = bsims[i-xfrom, aux[i-xfrom, j]]
-        ind[i, j] = binds[i-xfrom, aux[i-xfrom, j]]
+      sims = x[xfrom:xto].dot(y[yfrom:yto].T)
+      if dist != 'cosine':
+        l2 = (x[xfrom:xto] ** 2).sum(axis=1)[:, None] + y_sqnorm[None, yfrom:yto] - 2 * sims
+        sims = 1 / (1 + np.maximum(l2, 0))
+      kk = min(k, yto - yfrom)
+      part = np.argpartition(-sims, kk - 1, axis=1)[:, :kk]
+      bsim = np.concatenate((bsim, np.take_along_axis(sims, part, axis=1)), axis=1)
+      bind = np.concatenate((bind, part + yfrom), axis=1)
+      # ties keep the smaller y index
+      aux = np.lexsort((bind, -bsim), axis=1)[:, :k]
+      bsim = np.take_along_axis(bsim, aux, axis=1)
+      bind = np.take_along_axis(bind, aux, axis=1)
+    sim[xfrom:xto] = bsim
+    ind[xfrom:xto] = bind
   return sim, ind
 
 
@@ -82,16 +122,33 @@ def score(x, y, fwd_mean, bwd_mean, margin, dist='cosine'):
     return margin(sim, (fwd_mean + bwd_mean) / 2)
 
 
-def score_candidates(x, y, candidate_inds, fwd_mean, bwd_mean, margin, dist='cosine'):
+# per-pair dot products, np.vecdot (numpy>=2) matches x.dot(y) bit for bit
+_vecdot = getattr(np, 'vecdot', lambda a, b: np.einsum('...d,...d->...', a, b))
+
+
+def score_candidates(x, y, candidate_inds, fwd_mean, bwd_mean, margin, dist='cosine', batch_size=4096):
+  """Vectorized score() of every (i, candidate_inds[i, j]) pair, batch_size rows of x at a time."""
   print(' - scoring {:d} candidates using {}'.format(x.shape[0], dist))
   scores = np.zeros(candidate_inds.shape)
-  for i in range(scores.shape[0]):
-    for j in range(scores.shape[1]):
-      k = candidate_inds[i, j]
-      scores[i, j] = score(x[i], y[k], fwd_mean[i], bwd_mean[k], margin, dist)
+  for start in range(0, scores.shape[0], batch_size):
+    end = min(start + batch_size, scores.shape[0])
+    inds = candidate_inds[start:end]
+    if dist == 'cosine':
+      sim = _vecdot(x[start:end, None, :], y[inds])
+    else:
+      sim = 1 / (1 + ((x[start:end, None, :] - y[inds]) ** 2).sum(axis=2))
+    scores[start:end] = margin(sim, (fwd_mean[start:end, None] + bwd_mean[inds]) / 2)
   return scores
 
 
+def normalize_L2(x):
+  if faiss is not None:
+    faiss.normalize_L2(x)
+  else:
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    x /= np.where(norms > 0, norms, 1)
+
+
 def text_load_unify(fname, encoding, unify=True):
   print(' - loading texts {:s}: '.format(fname), end='')
   fin = open(fname, encoding=encoding, errors='surrogateescape')
@@ -132,15 +189,16 @@ def shift_embeddings(x, y):
 
 def mine_bitext(x, y, src_text_file, trg_text_file, output_file, mode='mine',
                 retrieval='max', margin='ratio', threshold=0,
-                neighborhood=4, use_gpu=False, encoding='utf-8', dist='cosine', use_shift_embeds=False):
+                neighborhood=4, use_gpu=False, encoding='utf-8', dist='cosine', use_shift_embeds=False,
+                knn_backend='faiss'):
   src_inds, src_sents = text_load_unify(src_text_file, encoding, True)
   trg_inds, trg_sents = text_load_unify(trg_text_file, encoding, True)
 
   x = unique_embeddings(x, src_inds)
   y = unique_embeddings(y, trg_inds)
   if dist == 'cosine':
-    faiss.normalize_L2(x)
-    faiss.normalize_L2(y)
+    normalize_L2(x)
+    normalize_L2(y)
 
   if use_shift_embeds:
     x2y, y2x = shift_embeddings(x, y)
@@ -150,19 +208,19 @@ def mine_bitext(x, y, src_text_file, trg_text_file, output_file, mode='mine',
     print(' - perform {:d}-nn source against target, dist={}'.format(neighborhood, dist))
     if use_shift_embeds:
       # project x to y space, and search k-nn ys for each x
-      x2y_sim, x2y_ind = knn(x2y, y, min(y.shape[0], neighborhood), use_gpu, dist)
+      x2y_sim, x2y_ind = knn(x2y, y, min(y.shape[0], neighborhood), use_gpu, dist, knn_backend)
       x2y_mean = x2y_sim.mean(axis=1)
     else:
-      x2y_sim, x2y_ind = knn(x, y, min(y.shape[0], neighborhood), use_gpu, dist)
+      x2y_sim, x2y_ind = knn(x, y, min(y.shape[0], neighborhood), use_gpu, dist, knn_backend)
       x2y_mean = x2y_sim.mean(axis=1)
 
   if retrieval is not 'fwd':
     print(' - perform {:d}-nn target against source, dist={}'.format(neighborhood, dist))
     if use_shift_embeds:
-      y2x_sim, y2x_ind = knn(y2x, x, min(x.shape[0], neighborhood), use_gpu, dist)
+      y2x_sim, y2x_ind = knn(y2x, x, min(x.shape[0], neighborhood), use_gpu, dist, knn_backend)
       y2x_mean = y2x_sim.mean(axis=1)
     else:
-      y2x_sim, y2x_ind = knn(y, x, min(x.shape[0], neighborhood), use_gpu, dist)
+      y2x_sim, y2x_ind = knn(y, x, min(x.shape[0], neighborhood), use_gpu, dist, knn_backend)
       y2x_mean = y2x_sim.mean(axis=1)
 
   # margin function
@@ -189,8 +247,10 @@ def mine_bitext(x, y, src_text_file, trg_text_file, output_file, mode='mine',
       print(trg_sents[best[i]], file=fout)
 
   elif mode == 'score':
-    for i, j in zip(src_inds, trg_inds):
-      s = score(x[i], y[j], x2y_mean[i], y2x_mean[j], margin)
+    pairs = np.array(list(zip(src_inds, trg_inds)), dtype=np.int64).reshape(-1, 2)
+    src_pairs, trg_pairs = pairs[:, 0], pairs[:, 1]
+    scores = margin(_vecdot(x[src_pairs], y[trg_pairs]), (x2y_mean[src_pairs] + y2x_mean[trg_pairs]) / 2)
+    for s, i, j in zip(scores, src_pairs, trg_pairs):
       print(s, src_sents[i], trg_sents[j], sep='\t', file=fout)
 
   elif mode == 'mine':
@@ -330,12 +390,16 @@ def bucc_eval(candidates_file, gold_file, src_file, trg_file, src_id_file, trg_i
     return None
 
 
-def similarity_search(x, y, dim, normalize=False):
+def similarity_search(x, y, dim, normalize=False, knn_backend='faiss'):
   num = x.shape[0]
-  idx = faiss.IndexFlatL2(dim)
   if normalize:
-    faiss.normalize_L2(x)
-    faiss.normalize_L2(y)
+    normalize_L2(x)
+    normalize_L2(y)
+  if knn_backend == 'numpy':
+    # the nearest x in L2 distance is the one with the highest 1 / (1 + l2) similarity
+    scores, prediction = knnNumpy(y, x, 1, dist='l2')
+    return prediction
+  idx = faiss.IndexFlatL2(dim)
   idx.add(x)
   scores, prediction = idx.search(y, 1)
   return prediction
@@ -0,0 +1,164 @@
+"""SCST reward time per step, per-batch CIDEr-D versus the cached `CiderDReward`.
+
+Generates a random caption corpus (`--num_images` images with 5 references
+each) and beam candidates for `--steps` batches, then times
+
+  * the previous reward: both caption lists tokenized through a
+    `multiprocessing.Pool`, document frequencies recomputed from the
+    references repeated beam times, every candidate scored by the coco-caption
+    CIDEr-D loops;
+  * `CiderDReward`, built once over the corpus, scoring the same batches
+    (including caching the references of an image the first time it is seen).
+
+The coco-caption loops are also run with the corpus document frequencies to
+check that `CiderDReward` gives the same scores. The Java PTBTokenizer is not
+started here, so the time of the previous reward is a lower bound.
+
+    python benchmark_cider_reward.py --num_images 20000 --batch_size 32 --beam_size 5
+"""
+import argparse
+import itertools
+import multiprocessing
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from cider_reward import CiderDReward, count_ngrams, ptb_tokenize
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_images', type=int, default=20000)
+parser.add_argument('--vocab_size', type=int, default=3000)
+parser.add_argument('--batch_size', type=int, default=32)
+parser.add_argument('--beam_size', type=int, default=5)
+parser.add_argument('--steps', type=int, default=50)
+parser.add_argument('--seed', type=int, default=42)
+
+
+def tokenize_all(captions):
+    return [' '.join(ptb_tokenize(caption)) if isinstance(caption, str) else tokenize_all(caption)
+            for caption in captions]
+
+
+def document_frequency(cooked_refs):
+    df = defaultdict(float)
+    for refs in cooked_refs:
+        for ngram in set(ngram for ref in refs for ngram in ref):
+            df[ngram] += 1
+    return df
+
+
+def coco_cider_d(cooked_refs, cooked_hyps, df, ref_len, n=4, sigma=6.0):
+    """CIDEr-D of every hypothesis, the loops of the coco-caption CiderScorer."""
+
+    def counts2vec(counts):
+        vec = [defaultdict(float) for _ in range(n)]
+        norm = [0.0] * n
+        length = 0
+        for ngram, term_freq in counts.items():
+            k = len(ngram) - 1
+            vec[k][ngram] = float(term_freq) * (ref_len - np.log(max(1.0, df[ngram])))
+            norm[k] += pow(vec[k][ngram], 2)
+            if k == 1:
+                length += term_freq
+        return vec, [np.sqrt(x) for x in norm], length
+
+    def sim(vec_hyp, vec_ref, norm_hyp, norm_ref, length_hyp, length_ref):
+        delta = float(length_hyp - length_ref)
+        val = np.array([0.0] * n)
+        for k in range(n):
+            for ngram in vec_hyp[k]:
+                val[k] += min(vec_hyp[k][ngram], vec_ref[k][ngram]) * vec_ref[k][ngram]
+            if norm_hyp[k] != 0 and norm_ref[k] != 0:
+                val[k] /= norm_hyp[k] * norm_ref[k]
+            val[k] *= np.e ** (-(delta ** 2) / (2 * sigma ** 2))
+        return val
+
+    scores = []
+    for hyp, refs in zip(cooked_hyps, cooked_refs):
+        vec, norm, length = counts2vec(hyp)
+        score = np.array([0.0] * n)
+        for ref in refs:
+            vec_ref, norm_ref, length_ref = counts2vec(ref)
+            score += sim(vec, vec_ref, norm, norm_ref, length, length_ref)
+        scores.append(np.mean(score) / len(refs) * 10.0)
+    return np.array(scores)
+
+
+def per_batch_reward(pool, captions_gen, captions_gt, beam_size, timings):
+    start = time.time()
+    captions_gt = list(itertools.chain(*([c, ] * beam_size for c in captions_gt)))
+    captions_gen, captions_gt = pool.map(tokenize_all, [captions_gen, captions_gt])
+    timings['tokenize'] += time.time() - start
+
+    start = time.time()
+    cooked_refs = [[count_ngrams(ref.split()) for ref in refs] for refs in captions_gt]
+    cooked_hyps = [count_ngrams(hyp.split()) for hyp in captions_gen]
+    df = document_frequency(cooked_refs)
+    timings['document frequency'] += time.time() - start
+
+    start = time.time()
+    scores = coco_cider_d(cooked_refs, cooked_hyps, df, np.log(float(len(cooked_refs))))
+    timings['score'] += time.time() - start
+    return scores
+
+
+def random_caption(rng, words, weights, references=None):
+    if references is not None and rng.rand() < 0.5:
+        # copy a span of a reference, like a trained captioner
+        tokens = references[rng.randint(len(references))].split()
+        start = rng.randint(max(1, len(tokens) - 6))
+        tokens = tokens[start:start + rng.randint(6, 12)] + list(rng.choice(words, rng.randint(0, 4), p=weights))
+    else:
+        tokens = list(rng.choice(words, rng.randint(8, 16), p=weights))
+    return ' '.join(tokens) + rng.choice(['', '.', ' .'])
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    rng = np.random.RandomState(args.seed)
+    words = np.array(['w{}'.format(i) for i in range(args.vocab_size)])
+    weights = 1.0 / np.arange(1, args.vocab_size + 1)
+    weights /= weights.sum()
+    references = {'{}.jpg'.format(i): [random_caption(rng, words, weights) for _ in range(5)]
+                  for i in range(args.num_images)}
+    image_names = list(references)
+
+    batches = []
+    for _ in range(args.steps):
+        image_ids = [image_names[i] for i in rng.randint(len(image_names), size=args.batch_size)]
+        captions_gen = [random_caption(rng, words, weights, references[image_id])
+                        for image_id in image_ids for _ in range(args.beam_size)]
+        batches.append((image_ids, captions_gen, [references[image_id] for image_id in image_ids]))
+
+    timings = defaultdict(float)
+    pool = multiprocessing.Pool()
+    before = [per_batch_reward(pool, captions_gen, captions_gt, args.beam_size, timings)
+              for _, captions_gen, captions_gt in batches]
+    pool.close()
+
+    start = time.time()
+    cider_reward = CiderDReward(references)
+    setup = time.time() - start
+    start = time.time()
+    after = [cider_reward(image_ids, captions_gen, captions_gt) for image_ids, captions_gen, captions_gt in batches]
+    cached = time.time() - start
+
+    # same scores as the coco-caption loops once the document frequencies come from the corpus
+    cooked = {image_id: [count_ngrams(ptb_tokenize(ref)) for ref in refs] for image_id, refs in references.items()}
+    df = document_frequency(cooked.values())
+    diff = 0.0
+    for (image_ids, captions_gen, _), scores in zip(batches[:5], after):
+        cooked_refs = [cooked[image_id] for image_id in image_ids for _ in range(args.beam_size)]
+        expected = coco_cider_d(cooked_refs, [count_ngrams(ptb_tokenize(c)) for c in captions_gen],
+                                df, np.log(float(len(cooked))))
+        diff = max(diff, np.abs(expected - scores).max())
+
+    print('{} images, {} steps of {} images x {} beams'.format(args.num_images, args.steps, args.batch_size,
+                                                              args.beam_size))
+    print('per-batch reward:  {:7.2f} ms/step'.format(1000 * sum(timings.values()) / args.steps))
+    for name, value in timings.items():
+        print('  {:20s} {:7.2f} ms/step'.format(name, 1000 * value / args.steps))
+    print('CiderDReward:      {:7.2f} ms/step ({:.1f}s one-off setup)'.format(1000 * cached / args.steps, setup))
+    print('speedup {:.1f}x, max |diff| against coco-caption CIDEr-D {:.2e}, mean reward {:.3f}'.format(
+        sum(timings.values()) / cached, diff, np.mean(after)))
@@ -28,13 +28,11 @@ from dataset import create_dataset, create_sampler, create_loader, coco_collate_
 from scheduler import create_scheduler
 from optim import create_optimizer, create_two_optimizer
 
-import language_evaluation.coco_caption_py3.pycocoevalcap as evaluation_tools
-import multiprocessing
-import itertools
+from cider_reward import CiderDReward
 
 
-def train_scst(model, data_loader, test_loader, optimizer, tokenizer, epoch, warmup_steps, device, scheduler, config, do_amp=False,
-          do_two_optim=False, do_accum=False, accum_steps=1):
+def train_scst(model, data_loader, test_loader, optimizer, tokenizer, epoch, warmup_steps, device, scheduler, config, cider_reward,
+          do_amp=False, do_two_optim=False, do_accum=False, accum_steps=1):
     # train
     model.train()
 
@@ -45,13 +43,13 @@ def train_scst(model, data_loader, test_loader, optimizer, tokenizer, epoch, war
     else:
         metric_logger.add_meter('lr', utils.SmoothedValue(window_size=50, fmt='{value:.7f}'))
     metric_logger.add_meter('loss', utils.SmoothedValue(window_size=1, fmt='{value:.4f}'))
+    metric_logger.add_meter('reward_time', utils.SmoothedValue(window_size=50, fmt='{avg:.4f}'))
 
     header = 'Train Epoch: [{}]'.format(epoch)
     print_freq = 50
     step_size = 100
     warmup_iterations = warmup_steps * step_size
     beam_size=args.beam_size
-    tokenizer_pool=multiprocessing.Pool()
     best_cider = 0.0
     for i, (image, caption, object_labels, image_ids, gold_caption) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
         
@@ -76,11 +74,9 @@ def train_scst(model, data_loader, test_loader, optimizer, tokenizer, epoch, war
                 words.append(item.numel())
             topk_words.append(words)
         topk_words_tensor = torch.Tensor(topk_words).cuda()
-        caps_gt = gold_caption
-        caps_gt = list(itertools.chain(*([c, ] * beam_size for c in caps_gt)))
-        caps_gen,caps_gt = tokenizer_pool.map(evaluation_tools.PTBTokenizer.tokenize,[caps_gen,caps_gt])
-
-        reward=evaluation_tools.compute_ciders(caps_gt,caps_gen)[1].astype(np.float32)
+        start = time.time()
+        reward = cider_reward(image_ids, caps_gen, gold_caption)
+        metric_logger.update(reward_time=time.time() - start)
         reward = torch.from_numpy(reward).cuda().view(image.shape[0], beam_size)
         reward_baseline = torch.mean(reward, -1, keepdim=True)
         loss = - (topk_probs_tensor/topk_words_tensor) * (reward-reward_baseline)
@@ -354,6 +350,12 @@ def main(args, config):
         model = apex.parallel.DistributedDataParallel(model, delay_allreduce=True)
         model_without_ddp = model.module
 
+    # document frequencies over the training references, computed once for all SCST steps
+    train_references = {}
+    for ann in datasets[0].ann:
+        train_references.setdefault(ann['image'].split("/")[-1], ann['gold_caption'])
+    cider_reward = CiderDReward(train_references)
+
     print("Start training")
     start_time = time.time()
     for epoch in range(start_epoch, max_epoch):
@@ -366,7 +368,7 @@ def main(args, config):
                 train_loader.sampler.set_epoch(epoch)
 
             train_stats = train_scst(model, train_loader, test_loader, optimizer, tokenizer, epoch, warmup_steps, device, lr_scheduler,
-                                config, do_amp=args.do_amp, do_two_optim=args.do_two_optim, accum_steps=args.accum_steps)
+                                config, cider_reward, do_amp=args.do_amp, do_two_optim=args.do_two_optim, accum_steps=args.accum_steps)
 
         if args.evaluate:
             break
@@ -0,0 +1,138 @@
+"""In-process CIDEr-D reward for self-critical sequence training.
+
+`CiderDReward` computes the n-gram document frequencies once over the
+training references and keeps, for every image id, the tf-idf vectors of its
+tokenized references (built the first time the image is scored), so scoring
+a batch only tokenizes the generated captions. All candidates of an image (its beams) are scored against all of
+its references with a few array operations.
+
+Scores follow the CIDEr-D definition of the coco-caption toolkit: n-grams up
+to 4, clipped tf-idf cosine similarity per n, Gaussian length penalty with
+sigma 6, averaged over n and references and multiplied by 10. Sentences are
+tokenized by `ptb_tokenize`, a pure Python version of the coco-caption
+PTBTokenizer step (lower case, punctuation split off and dropped).
+"""
+import re
+from collections import Counter, defaultdict, namedtuple
+
+import numpy as np
+
+# tokens removed by the coco-caption PTBTokenizer, after the PTB escaping of brackets and quotes
+PUNCTUATIONS = {"''", "'", "``", "`", '"', '(', ')', '{', '}', '.', '?', '!', ',', ':', '-', '--', '...', ';'}
+_CONTRACTION = re.compile(r"(\w)(n't)\b")
+_CLITIC = re.compile(r"(\w)('(?:s|re|ve|ll|d|m))\b")
+_TOKEN = re.compile(r"n't|'\w+|\w+(?:[-./]\w+)*|\S")
+
+CachedReferences = namedtuple('CachedReferences', ['columns', 'vectors', 'levels', 'norms', 'lengths'])
+
+
+def ptb_tokenize(sentence):
+    """Lower cased PTB-style tokens of `sentence` without punctuation."""
+    sentence = sentence.lower().replace('\n', ' ')
+    sentence = _CLITIC.sub(r'\1 \2', _CONTRACTION.sub(r'\1 \2', sentence))
+    return [token for token in _TOKEN.findall(sentence) if token not in PUNCTUATIONS]
+
+
+def count_ngrams(tokens, n=4):
+    """Counts of the 1..n-grams of `tokens`, keyed by tuples."""
+    counts = Counter()
+    for k in range(1, n + 1):
+        for i in range(len(tokens) - k + 1):
+            counts[tuple(tokens[i:i + k])] += 1
+    return counts
+
+
+class CiderDReward(object):
+    """CIDEr-D of generated captions against the cached references of their images.
+
+    Args:
+        references: dict mapping image ids to lists of reference captions, the
+            document frequencies are computed over all of them.
+        n: largest n-gram order.
+        sigma: standard deviation of the Gaussian length penalty.
+    """
+
+    def __init__(self, references, n=4, sigma=6.0):
+        self.n = n
+        self.sigma = sigma
+        self.references = {}
+        self.ref_counts = {}
+        self.document_frequency = defaultdict(float)
+        for image_id, captions in references.items():
+            self.ref_counts[image_id] = [count_ngrams(ptb_tokenize(caption), n) for caption in captions]
+            for ngram in set(ngram for counts in self.ref_counts[image_id] for ngram in counts):
+                self.document_frequency[ngram] += 1
+        self.ref_len = np.log(float(max(1, len(self.ref_counts))))
+
+    def _weight(self, ngram, term_freq):
+        return term_freq * (self.ref_len - np.log(max(1.0, self.document_frequency.get(ngram, 0.0))))
+
+    def _cache(self, ref_counts):
+        """tf-idf vectors of the references of an image over the n-grams they contain."""
+        columns = {}
+        for counts in ref_counts:
+            for ngram in counts:
+                columns.setdefault(ngram, len(columns))
+        vectors = np.zeros((len(ref_counts), len(columns)))
+        levels = np.zeros((len(columns), self.n))
+        norms = np.zeros((len(ref_counts), self.n))
+        lengths = np.zeros(len(ref_counts))
+        for ngram, column in columns.items():
+            levels[column, len(ngram) - 1] = 1.0
+        for row, counts in enumerate(ref_counts):
+            for ngram, term_freq in counts.items():
+                weight = self._weight(ngram, term_freq)
+                vectors[row, columns[ngram]] = weight
+                norms[row, len(ngram) - 1] += weight * weight
+                if len(ngram) == 2:
+                    lengths[row] += term_freq
+        return CachedReferences(columns, vectors, levels, np.sqrt(norms), lengths)
+
+    def cached_references(self, image_id, captions=None):
+        """References of `image_id`, cached from `captions` if the image was not seen before."""
+        if image_id not in self.references:
+            if image_id in self.ref_counts:
+                ref_counts = self.ref_counts.pop(image_id)
+            elif captions is not None:
+                ref_counts = [count_ngrams(ptb_tokenize(caption), self.n) for caption in captions]
+            else:
+                raise KeyError('no references for image {}'.format(image_id))
+            self.references[image_id] = self._cache(ref_counts)
+        return self.references[image_id]
+
+    def score(self, refs, candidates):
+        """CIDEr-D of the `candidates` of one image against its cached references."""
+        hyp = np.zeros((len(candidates), len(refs.columns)))
+        hyp_norms = np.zeros((len(candidates), self.n))
+        hyp_lengths = np.zeros(len(candidates))
+        for row, candidate in enumerate(candidates):
+            for ngram, term_freq in count_ngrams(ptb_tokenize(candidate), self.n).items():
+                weight = self._weight(ngram, term_freq)
+                hyp_norms[row, len(ngram) - 1] += weight * weight
+                if len(ngram) == 2:
+                    hyp_lengths[row] += term_freq
+                column = refs.columns.get(ngram)
+                if column is not None:
+                    hyp[row, column] = weight
+        hyp_norms = np.sqrt(hyp_norms)
+
+        # clipped dot products per n-gram order, [candidates, references, n]
+        similarity = (np.minimum(hyp[:, None, :], refs.vectors[None]) * refs.vectors[None]) @ refs.levels
+        norms = hyp_norms[:, None, :] * refs.norms[None]
+        similarity = np.divide(similarity, norms, out=np.zeros_like(similarity), where=norms != 0)
+        delta = hyp_lengths[:, None] - refs.lengths[None]
+        similarity *= np.exp(-(delta ** 2) / (2 * self.sigma ** 2))[..., None]
+        return similarity.mean(-1).sum(-1) / len(refs.lengths) * 10.0
+
+    def __call__(self, image_ids, candidates, references=None):
+        """Rewards of `candidates`, the same number (e.g. the beams) for every image.
+
+        `references` optionally gives the reference captions of every image,
+        used for images that were not in the training references.
+        """
+        per_image = len(candidates) // len(image_ids)
+        rewards = np.zeros(len(candidates), dtype=np.float32)
+        for i, image_id in enumerate(image_ids):
+            refs = self.cached_references(image_id, references[i] if references is not None else None)
+            rewards[i * per_image:(i + 1) * per_image] = self.score(refs, candidates[i * per_image:(i + 1) * per_image])
+        return rewards
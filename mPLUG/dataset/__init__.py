@@ -95,13 +95,13 @@ def create_dataset(dataset, config, epoch=None):
 
 
     elif dataset=='video_qa': 
-        train_dataset = videoqa_dataset(config['train_file'], train_transform, config['videoqa_root'], split='train', read_local_data=config['read_local_data'], max_img_size=config['image_res'])  
-        vqa_test_dataset = videoqa_dataset(config['test_file'], test_transform, config['videoqa_root'], split='test', answer_list=config['answer_list'], read_local_data=config['read_local_data'], max_img_size=config['image_res'])       
-        vqa_val_dataset = videoqa_dataset(config['val_file'], test_transform, config['videoqa_root'], split='test', answer_list=config['answer_list'], read_local_data=config['read_local_data'], max_img_size=config['image_res'])        
+        train_dataset = videoqa_dataset(config['train_file'], train_transform, config['videoqa_root'], split='train', read_local_data=config['read_local_data'], max_img_size=config['image_res'], frame_store=config.get('frame_store'))  
+        vqa_test_dataset = videoqa_dataset(config['test_file'], test_transform, config['videoqa_root'], split='test', answer_list=config['answer_list'], read_local_data=config['read_local_data'], max_img_size=config['image_res'], frame_store=config.get('frame_store'))       
+        vqa_val_dataset = videoqa_dataset(config['val_file'], test_transform, config['videoqa_root'], split='test', answer_list=config['answer_list'], read_local_data=config['read_local_data'], max_img_size=config['image_res'], frame_store=config.get('frame_store'))        
         return train_dataset, vqa_val_dataset, vqa_test_dataset
 
     elif dataset== 'vatex_video_caps':
-        test_dataset = vatex_video_caps_dataset(config['test_file'], config['vatex_video_caps_root'], max_words=config['max_length'], read_local_data=config['read_local_data'], is_train=False, num_frm=config['num_frm_test'], max_img_size=config['image_res'], frm_sampling_strategy='uniform')
+        test_dataset = vatex_video_caps_dataset(config['test_file'], config['vatex_video_caps_root'], max_words=config['max_length'], read_local_data=config['read_local_data'], is_train=False, num_frm=config['num_frm_test'], max_img_size=config['image_res'], frm_sampling_strategy='uniform', frame_store=config.get('frame_store'))
         return test_dataset
 
 def videoqa_collate_fn(batch):
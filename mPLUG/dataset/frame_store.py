@@ -0,0 +1,208 @@
+"""Pre-extracted video frames in one memory-mapped uint8 array.
+
+A store directory holds
+
+    frames.bin  resized RGB frames of all clips, uint8 [num_frames, 3, height, width]
+    index.json  frame size, sampling settings and the [offset, count] of every clip
+
+Both are written under temporary names and renamed into place, index.json
+last, so a directory holding it is complete.
+
+`extract_frames` decodes every clip once. For 'uniform' sampling it keeps
+exactly the `num_frm` frames the video datasets decode, for 'rand' and
+'headtail' a uniformly spaced pool of `pool_frm` frames that the clips are
+sampled from at training time. `VideoFrameLoader` reads the sampled frames of
+a clip from a store and decodes the clips missing from it with decord.
+"""
+import json
+import os
+import random
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+INDEX_FILE = 'index.json'
+FRAMES_FILE = 'frames.bin'
+
+
+def sample_frame_indices(vlen, num_frm, frm_sampling_strategy, start_idx=0, end_idx=None):
+    """Indices of the frames sampled from a clip of `vlen` frames."""
+    end_idx = vlen if end_idx is None else end_idx
+    if frm_sampling_strategy == 'uniform':
+        return np.arange(start_idx, end_idx, vlen / num_frm, dtype=int)
+    elif frm_sampling_strategy == 'rand':
+        return sorted(random.sample(range(vlen), num_frm))
+    elif frm_sampling_strategy == 'headtail':
+        frame_indices_head = sorted(random.sample(range(vlen // 2), num_frm // 2))
+        frame_indices_tail = sorted(random.sample(range(vlen // 2, vlen), num_frm // 2))
+        return frame_indices_head + frame_indices_tail
+    raise NotImplementedError('Invalid sampling strategy {} '.format(frm_sampling_strategy))
+
+
+def decode_frames(video_path, frame_indices, height=None, width=None):
+    """uint8 frames [len(frame_indices), 3, height, width] of a video, `frame_indices` maps the clip length to indices."""
+    from decord import VideoReader
+    if not height or not width:
+        vr = VideoReader(video_path)
+    else:
+        vr = VideoReader(video_path, width=width, height=height)
+    frames = vr.get_batch(frame_indices(len(vr)))
+    # decord returns torch tensors when the torch bridge is set, its own NDArray otherwise
+    frames = frames.numpy() if isinstance(frames, torch.Tensor) else frames.asnumpy()
+    return np.ascontiguousarray(frames.transpose(0, 3, 1, 2))
+
+
+def _extract_clip(task):
+    name, video_path, size, num_frm = task
+    try:
+        return name, decode_frames(video_path, lambda vlen: sample_frame_indices(vlen, num_frm, 'uniform'), size, size)
+    except Exception as e:
+        print('failed to decode {}: {}'.format(video_path, e))
+        return name, None
+
+
+def extract_frames(video_paths, output_dir, image_size, num_frm, frm_sampling_strategy='uniform', pool_frm=32,
+                   workers=0):
+    """Decodes the clips of `video_paths` (dict clip name -> video file) into a store at `output_dir`.
+
+    Clips that fail to decode are left out of the index, `VideoFrameLoader`
+    decodes them from the video file again.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    stored_frm = num_frm if frm_sampling_strategy == 'uniform' else max(num_frm, pool_frm)
+    tasks = [(name, path, image_size, stored_frm) for name, path in video_paths.items()]
+    pool = None
+    if workers > 0:
+        from multiprocessing import Pool
+        pool = Pool(workers)
+    clips = {}
+    offset = 0
+    frames_file, index_file = os.path.join(output_dir, FRAMES_FILE), os.path.join(output_dir, INDEX_FILE)
+    with open(frames_file + '.tmp', 'wb') as f:
+        for name, frames in (pool.imap(_extract_clip, tasks, chunksize=4) if pool else map(_extract_clip, tasks)):
+            if frames is None:
+                continue
+            f.write(frames.tobytes())
+            clips[name] = [offset, len(frames)]
+            offset += len(frames)
+    if pool is not None:
+        pool.close()
+    index = {'height': image_size, 'width': image_size, 'num_frm': num_frm, 'pool_frm': stored_frm,
+             'frm_sampling_strategy': frm_sampling_strategy, 'num_frames': offset, 'clips': clips}
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(index, f)
+    # an index of a previous extraction must not point into the new frames
+    if os.path.exists(index_file):
+        os.remove(index_file)
+    os.replace(frames_file + '.tmp', frames_file)
+    os.replace(index_file + '.tmp', index_file)
+    return index
+
+
+class FrameStore(object):
+    """Read-only view of a store written by `extract_frames`."""
+
+    def __init__(self, root):
+        with open(os.path.join(root, INDEX_FILE), 'r') as f:
+            index = json.load(f)
+        self.height = index['height']
+        self.width = index['width']
+        self.num_frm = index['num_frm']
+        self.frm_sampling_strategy = index['frm_sampling_strategy']
+        self.clips = index['clips']
+        # frames stored per clip, older stores do not record it
+        self.pool_frm = index.get('pool_frm', min((count for _, count in self.clips.values()), default=self.num_frm))
+        self.root = root
+        self.num_frames = index['num_frames']
+        self._frames = None
+
+    @property
+    def frames(self):
+        # opened on first use, so every DataLoader worker maps the file itself
+        if self._frames is None:
+            self._frames = np.memmap(os.path.join(self.root, FRAMES_FILE), dtype=np.uint8, mode='r',
+                                     shape=(self.num_frames, 3, self.height, self.width))
+        return self._frames
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_frames'] = None
+        return state
+
+    def __contains__(self, clip_name):
+        return clip_name in self.clips
+
+    def __getitem__(self, clip_name):
+        offset, count = self.clips[clip_name]
+        return self.frames[offset:offset + count]
+
+
+class VideoFrameLoader(object):
+    """Sampled frames of a clip as a uint8 tensor [num_frm, 3, H, W].
+
+    Clips in `frame_store` are sampled from their stored frames, the others
+    are decoded from the video file. With 'rand' or 'headtail' sampling and
+    `cache_size` > 0, the decoded pool of `pool_frm` frames of the last
+    `cache_size` clips is kept in an LRU, so the clip is not decoded again
+    while it stays there.
+    """
+
+    def __init__(self, num_frm, frm_sampling_strategy, max_img_size, frame_store=None, cache_size=0, pool_frm=32):
+        self.num_frm = num_frm
+        self.frm_sampling_strategy = frm_sampling_strategy
+        self.max_img_size = max_img_size
+        if isinstance(frame_store, str):
+            frame_store = FrameStore(frame_store)
+        if frame_store is not None and (frame_store.height, frame_store.width) != (max_img_size, max_img_size):
+            raise ValueError('frames in {} are {}x{}, expected {}x{}'.format(
+                frame_store.root, frame_store.height, frame_store.width, max_img_size, max_img_size))
+        if frame_store is not None and (frm_sampling_strategy == 'uniform') != (
+                frame_store.frm_sampling_strategy == 'uniform' and frame_store.num_frm == num_frm):
+            raise ValueError('frames in {} were extracted for {} sampling of {} frames, not {} sampling of {}'.format(
+                frame_store.root, frame_store.frm_sampling_strategy, frame_store.num_frm, frm_sampling_strategy, num_frm))
+        if frame_store is not None and num_frm > frame_store.pool_frm:
+            raise ValueError('frames in {} hold {} frames per clip, can not sample {}'.format(
+                frame_store.root, frame_store.pool_frm, num_frm))
+        self.frame_store = frame_store
+        self.cache_size = cache_size if frm_sampling_strategy != 'uniform' else 0
+        self.pool_frm = pool_frm
+        self.cache = OrderedDict()
+
+    def _sample(self, frames):
+        frame_indices = sample_frame_indices(len(frames), self.num_frm, self.frm_sampling_strategy)
+        return torch.from_numpy(np.ascontiguousarray(frames[frame_indices]))
+
+    def _cached_pool(self, video_path):
+        if video_path in self.cache:
+            self.cache.move_to_end(video_path)
+            return self.cache[video_path]
+        pool_frm = max(self.num_frm, self.pool_frm)
+        frames = decode_frames(video_path, lambda vlen: sample_frame_indices(vlen, pool_frm, 'uniform'),
+                               self.max_img_size, self.max_img_size)
+        self.cache[video_path] = frames
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return frames
+
+    def __call__(self, clip_name, video_path, start_time=None, end_time=None, fps=-1):
+        if self.frame_store is not None and clip_name in self.frame_store and not (start_time or end_time):
+            return self._sample(self.frame_store[clip_name])
+        try:
+            if self.cache_size > 0 and not (start_time or end_time):
+                return self._sample(self._cached_pool(video_path))
+            if start_time or end_time:
+                assert fps > 0, 'must provide video fps if specifying start and end time.'
+
+            def frame_indices(vlen):
+                if start_time or end_time:
+                    start_idx, end_idx = min(int(start_time * fps), vlen), min(int(end_time * fps), vlen)
+                else:
+                    start_idx, end_idx = 0, vlen
+                return sample_frame_indices(vlen, self.num_frm, self.frm_sampling_strategy, start_idx, end_idx)
+
+            frames = decode_frames(video_path, frame_indices, self.max_img_size, self.max_img_size)
+        except Exception as e:
+            print(e)
+            return None
+        return torch.from_numpy(frames)
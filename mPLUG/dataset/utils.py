@@ -43,6 +43,7 @@ from vqaTools.vqaEval import VQAEval
 
 import json
 import os
+from collections import defaultdict
 import numpy as np
 import torch
 import torch.distributed as dist
@@ -153,46 +154,80 @@ def save_result(result, result_dir, filename, is_json=True, is_list=True, remove
 
 
 
-def grounding_eval(results,dets,cocos,refer,alpha,mask_size=24):
+_upsampling_tables = {}
+
+
+def upsampling_table(size, mask_size=24, device='cpu'):
+    # [size+1, mask_size] cumulated rows of the bicubic upsampling from mask_size to size:
+    # row i holds the weights of the sum of the first i upsampled rows
+    key = (size, mask_size, str(device))
+    if key not in _upsampling_tables:
+        basis = torch.eye(mask_size, dtype=torch.float64, device=device).view(mask_size,1,mask_size,1)
+        weights = F.interpolate(basis, size=(size,1), mode='bicubic').view(mask_size,size).t()
+        _upsampling_tables[key] = F.pad(weights.cumsum(0), (0,0,1,0))
+    return _upsampling_tables[key]
+
+
+def _rank_detections(image_res, image_dets, ref_boxes, height, width, alpha, mask_size, device):
+    """IoU of every ref box with the detection box its predicted mask scores highest."""
+    masks = torch.stack([res['pred'].view(mask_size,mask_size) for res in image_res]).to(device, torch.float64)
+    
+    # rank detection boxes: bicubic upsampling is separable, upsampled = up_h @ mask @ up_w.T, so the
+    # summed-area table of every upsampled mask is rows @ mask @ cols.T with the cumulated upsampling matrices
+    rows = upsampling_table(height, mask_size, device)
+    cols = upsampling_table(width, mask_size, device)
+    boxes = torch.tensor([det[:4] for det in image_dets], dtype=torch.float64, device=masks.device)
+    # rows int(y):int(y+h) and columns int(x):int(x+w), clipped to the image like a slice
+    x1 = boxes[:,0].long().clamp(0,width)
+    y1 = boxes[:,1].long().clamp(0,height)
+    x2 = torch.max((boxes[:,0]+boxes[:,2]).long().clamp(0,width), x1)
+    y2 = torch.max((boxes[:,1]+boxes[:,3]).long().clamp(0,height), y1)
+    score = torch.einsum('di,nij,dj->nd', rows[y2]-rows[y1], masks, cols[x2]-cols[x1])
+    score = score / (boxes[:,2]*boxes[:,3])**alpha
+    score[torch.isnan(score)] = -float('inf')
+    pred_boxes = boxes[score.argmax(1)].cpu()
+
+    return computeIoU_batch(ref_boxes, pred_boxes)
+
+
+def grounding_eval(results,dets,cocos,refer,alpha,mask_size=24,device='cpu'):
     
     correct_A_d, correct_B_d, correct_val_d = 0, 0, 0
     correct_A, correct_B, correct_val = 0, 0, 0 
     num_A,num_B,num_val = 0,0,0
+
+    # refs of the same image share the upsampling tables and the detection boxes
+    image_results = defaultdict(list)
+    for res in results:
+        image_results[refer.Refs[res['ref_id']]['image_id']].append(res)
     
-    for res in tqdm(results):
+    for image_id, image_res in tqdm(image_results.items()):
 
-        ref_id = res['ref_id']
-        ref = refer.Refs[ref_id]
-        ref_box = refer.refToAnn[ref_id]['bbox']
-        image = refer.Imgs[ref['image_id']]
+        refs = [refer.Refs[res['ref_id']] for res in image_res]
+        ref_boxes = torch.tensor([refer.refToAnn[res['ref_id']]['bbox'] for res in image_res], dtype=torch.float64)
+        image = refer.Imgs[image_id]
+        height, width = image['height'], image['width']
 
-        mask = res['pred'].cuda().view(1,1,mask_size,mask_size)    
-        mask = F.interpolate(mask,size = (image['height'],image['width']), mode='bicubic').squeeze()
-        
-        # rank detection boxes
-        max_score = 0
-        for det in dets[str(ref['image_id'])]:
-            score = mask[int(det[1]):int(det[1]+det[3]),int(det[0]):int(det[0]+det[2])]
-            area = det[2]*det[3]
-            score = score.sum() / area**alpha
-            if score>max_score:
-                pred_box = det[:4]
-                max_score = score    
-
-        IoU_det = computeIoU(ref_box, pred_box)
+        image_dets = dets.get(str(image_id), [])
+        if len(image_dets) == 0:
+            # no detection box to pick, every ref of the image counts as a miss
+            IoU_det = torch.zeros(len(refs), dtype=torch.float64)
+        else:
+            IoU_det = _rank_detections(image_res, image_dets, ref_boxes, height, width, alpha, mask_size, device)
         
-        if ref['split']=='testA':
-            num_A += 1    
-            if IoU_det >= 0.5:   
-                correct_A_d += 1            
-        elif ref['split']=='testB':
-            num_B += 1    
-            if IoU_det >= 0.5:   
-                correct_B_d += 1    
-        elif ref['split']=='val':
-            num_val += 1    
-            if IoU_det >= 0.5:   
-                correct_val_d += 1    
+        for ref, iou in zip(refs, IoU_det.tolist()):
+            if ref['split']=='testA':
+                num_A += 1    
+                if iou >= 0.5:   
+                    correct_A_d += 1            
+            elif ref['split']=='testB':
+                num_B += 1    
+                if iou >= 0.5:   
+                    correct_B_d += 1    
+            elif ref['split']=='val':
+                num_val += 1    
+                if iou >= 0.5:   
+                    correct_val_d += 1    
                 
     eval_result = {'val_d':correct_val_d/num_val,'testA_d':correct_A_d/num_A,'testB_d':correct_B_d/num_B}        
     
@@ -217,6 +252,16 @@ def computeIoU(box1, box2):
         inter = 0
     union = box1[2]*box1[3] + box2[2]*box2[3] - inter
     return float(inter)/union
-        
-        
-        
+
+
+def computeIoU_batch(boxes1, boxes2):
+    # computeIoU of the matching rows of two [N, 4] tensors of [x1, y1, w, h] boxes
+    inter_x1 = torch.max(boxes1[:,0], boxes2[:,0])
+    inter_y1 = torch.max(boxes1[:,1], boxes2[:,1])
+    inter_x2 = torch.min(boxes1[:,0]+boxes1[:,2]-1, boxes2[:,0]+boxes2[:,2]-1)
+    inter_y2 = torch.min(boxes1[:,1]+boxes1[:,3]-1, boxes2[:,1]+boxes2[:,3]-1)
+
+    inter = (inter_x2-inter_x1+1)*(inter_y2-inter_y1+1)
+    inter = torch.where((inter_x1 < inter_x2) & (inter_y1 < inter_y2), inter, torch.zeros_like(inter))
+    union = boxes1[:,2]*boxes1[:,3] + boxes2[:,2]*boxes2[:,3] - inter
+    return inter/union
@@ -6,10 +6,10 @@ import torch
 import numpy as np
 import random
 import decord
-from decord import VideoReader
 import json
 import os
 from dataset.utils import pre_caption
+from dataset.frame_store import VideoFrameLoader
 
 decord.bridge.set_bridge("torch")
 
@@ -36,10 +36,12 @@ def load_jsonl(filename):
 class VideoDataset(Dataset):
 
     def __init__(self, video_root, ann_root, num_frm=4, frm_sampling_strategy="rand", max_img_size=384,
-                 video_fmt='.mp4'):
+                 video_fmt='.mp4', frame_store=None, frame_cache_size=0):
         '''
         image_root (string): Root directory of video
         ann_root (string): directory to store the annotation file
+        frame_store (string): directory of frames pre-extracted by extract_video_frames.py
+        frame_cache_size (int): clips whose decoded frames are kept for 'rand' sampling
         '''
         url = 'https://storage.googleapis.com/sfr-vision-language-research/datasets/msrvtt_test.jsonl'
         filename = 'msrvtt_test.jsonl'
@@ -53,6 +55,7 @@ class VideoDataset(Dataset):
         self.video_root = video_root
         self.video_fmt = video_fmt
         self.img_norm = ImageNorm(mean=(0.48145466, 0.4578275, 0.40821073), std=(0.26862954, 0.26130258, 0.27577711))
+        self.frame_loader = VideoFrameLoader(num_frm, frm_sampling_strategy, max_img_size, frame_store, frame_cache_size)
 
         self.text = [pre_caption(ann['caption'], 40) for ann in self.annotation]
         self.txt2video = [i for i in range(len(self.annotation))]
@@ -67,52 +70,16 @@ class VideoDataset(Dataset):
 
         video_path = os.path.join(self.video_root, ann['clip_name'] + self.video_fmt)
 
-        vid_frm_array = self._load_video_from_path_decord(video_path, height=self.max_img_size, width=self.max_img_size)
+        vid_frm_array = self.frame_loader(ann['clip_name'], video_path)
 
         video = self.img_norm(vid_frm_array.float())
 
         return video, ann['clip_name']
 
-    def _load_video_from_path_decord(self, video_path, height=None, width=None, start_time=None, end_time=None, fps=-1):
-        try:
-            if not height or not width:
-                vr = VideoReader(video_path)
-            else:
-                vr = VideoReader(video_path, width=width, height=height)
-
-            vlen = len(vr)
-
-            if start_time or end_time:
-                assert fps > 0, 'must provide video fps if specifying start and end time.'
-
-                start_idx = min(int(start_time * fps), vlen)
-                end_idx = min(int(end_time * fps), vlen)
-            else:
-                start_idx, end_idx = 0, vlen
-
-            if self.frm_sampling_strategy == 'uniform':
-                frame_indices = np.arange(start_idx, end_idx, vlen / self.num_frm, dtype=int)
-            elif self.frm_sampling_strategy == 'rand':
-                frame_indices = sorted(random.sample(range(vlen), self.num_frm))
-            elif self.frm_sampling_strategy == 'headtail':
-                frame_indices_head = sorted(random.sample(range(vlen // 2), self.num_frm // 2))
-                frame_indices_tail = sorted(random.sample(range(vlen // 2, vlen), self.num_frm // 2))
-                frame_indices = frame_indices_head + frame_indices_tail
-            else:
-                raise NotImplementedError('Invalid sampling strategy {} '.format(self.frm_sampling_strategy))
-
-            raw_sample_frms = vr.get_batch(frame_indices)
-        except Exception as e:
-            return None
-
-        raw_sample_frms = raw_sample_frms.permute(0, 3, 1, 2)
-
-        return raw_sample_frms
-
 
 class vatex_video_caps_dataset(Dataset):
     def __init__(self, ann_file, video_root, max_words=30, read_local_data=True, is_train=True, num_frm=4,
-                 frm_sampling_strategy="rand", max_img_size=384, video_fmt='.mp4'):
+                 frm_sampling_strategy="rand", max_img_size=384, video_fmt='.mp4', frame_store=None, frame_cache_size=0):
 
         self.ann = []
         for f in ann_file:
@@ -127,53 +94,18 @@ class vatex_video_caps_dataset(Dataset):
         self.video_root = video_root
         self.video_fmt = video_fmt
         self.img_norm = ImageNorm(mean=(0.48145466, 0.4578275, 0.40821073), std=(0.26862954, 0.26130258, 0.27577711))
+        self.frame_loader = VideoFrameLoader(num_frm, frm_sampling_strategy, max_img_size, frame_store, frame_cache_size)
 
     def __len__(self):
         return len(self.ann)
 
-    def _load_video_from_path_decord(self, video_path, height=None, width=None, start_time=None, end_time=None, fps=-1):
-        try:
-            if not height or not width:
-                vr = VideoReader(video_path)
-            else:
-                vr = VideoReader(video_path, width=width, height=height)
-
-            vlen = len(vr)
-
-            if start_time or end_time:
-                assert fps > 0, 'must provide video fps if specifying start and end time.'
-
-                start_idx = min(int(start_time * fps), vlen)
-                end_idx = min(int(end_time * fps), vlen)
-            else:
-                start_idx, end_idx = 0, vlen
-
-            if self.frm_sampling_strategy == 'uniform':
-                frame_indices = np.arange(start_idx, end_idx, vlen / self.num_frm, dtype=int)
-            elif self.frm_sampling_strategy == 'rand':
-                frame_indices = sorted(random.sample(range(vlen), self.num_frm))
-            elif self.frm_sampling_strategy == 'headtail':
-                frame_indices_head = sorted(random.sample(range(vlen // 2), self.num_frm // 2))
-                frame_indices_tail = sorted(random.sample(range(vlen // 2, vlen), self.num_frm // 2))
-                frame_indices = frame_indices_head + frame_indices_tail
-            else:
-                raise NotImplementedError('Invalid sampling strategy {} '.format(self.frm_sampling_strategy))
-
-            raw_sample_frms = vr.get_batch(frame_indices)
-        except Exception as e:
-            return None
-
-        raw_sample_frms = raw_sample_frms.permute(0, 3, 1, 2)
-
-        return raw_sample_frms
-
     def __getitem__(self, index):
 
         ann = self.ann[index]
         video_id = ann['videoID']
 
         video_path = os.path.join(self.video_root, ann['videoID'] + self.video_fmt)
-        vid_frm_array = self._load_video_from_path_decord(video_path, height=self.max_img_size, width=self.max_img_size)
+        vid_frm_array = self.frame_loader(video_id, video_path)
         video = self.img_norm(vid_frm_array.float())
 
         return video, video_id
@@ -9,7 +9,7 @@ from torch.utils.data import Dataset
 from dataset.utils import pre_question
 
 import decord
-from decord import VideoReader
+from dataset.frame_store import VideoFrameLoader
 
 import oss2
 from io import BytesIO
@@ -38,7 +38,7 @@ def load_jsonl(filename):
         return [json.loads(l.strip("\n")) for l in f.readlines()]
 
 class videoqa_dataset(Dataset):
-    def __init__(self, ann_file, transform, vqa_root, eos='[SEP]', split="train", max_ques_words=30, answer_list='', max_img_size=384, read_local_data=True, num_frm=16, frm_sampling_strategy='uniform'):
+    def __init__(self, ann_file, transform, vqa_root, eos='[SEP]', split="train", max_ques_words=30, answer_list='', max_img_size=384, read_local_data=True, num_frm=16, frm_sampling_strategy='uniform', frame_store=None, frame_cache_size=0):
         self.split = split        
         self.ann = []
         for f in ann_file:
@@ -62,6 +62,7 @@ class videoqa_dataset(Dataset):
 
 
         self.img_norm = ImageNorm(mean=(0.48145466, 0.4578275, 0.40821073), std=(0.26862954, 0.26130258, 0.27577711))
+        self.frame_loader = VideoFrameLoader(num_frm, frm_sampling_strategy, max_img_size, frame_store, frame_cache_size)
         for idx, ann in enumerate(self.ann):
             ann['question_id'] = idx
         self.gts = {x['question_id']: x for x in self.ann}
@@ -76,45 +77,9 @@ class videoqa_dataset(Dataset):
 
         video_path = os.path.join(self.video_root, ann['video_id'] + self.video_fmt)
         # print(video_path)
-        vid_frm_array = self._load_video_from_path_decord(video_path, height=self.max_img_size, width=self.max_img_size)
+        vid_frm_array = self.frame_loader(ann['video_id'], video_path)
         video = self.img_norm(vid_frm_array.float())
         
         return video, ann['question'], ann['question_id']
 
     
-    def _load_video_from_path_decord(self, video_path, height=None, width=None, start_time=None, end_time=None, fps=-1):
-        try:
-            if not height or not width:
-                vr = VideoReader(video_path)
-            else:
-                vr = VideoReader(video_path, width=width, height=height)
-
-            vlen = len(vr)
-
-            if start_time or end_time:
-                assert fps > 0, 'must provide video fps if specifying start and end time.'
-
-                start_idx = min(int(start_time * fps), vlen)
-                end_idx = min(int(end_time * fps), vlen)
-            else:
-                start_idx, end_idx = 0, vlen
-
-            if self.frm_sampling_strategy == 'uniform':
-                frame_indices = np.arange(start_idx, end_idx, vlen / self.num_frm, dtype=int)
-            elif self.frm_sampling_strategy == 'rand':
-                frame_indices = sorted(random.sample(range(vlen), self.num_frm))
-            elif self.frm_sampling_strategy == 'headtail':
-                frame_indices_head = sorted(random.sample(range(vlen // 2), self.num_frm // 2))
-                frame_indices_tail = sorted(random.sample(range(vlen // 2, vlen), self.num_frm // 2))
-                frame_indices = frame_indices_head + frame_indices_tail
-            else:
-                raise NotImplementedError('Invalid sampling strategy {} '.format(self.frm_sampling_strategy))
-
-            raw_sample_frms = vr.get_batch(frame_indices)
-        except Exception as e:
-            print(e)
-            return None
-
-        raw_sample_frms = raw_sample_frms.permute(0, 3, 1, 2)
-
-        return raw_sample_frms
@@ -0,0 +1,54 @@
+"""Decode the sampled frames of a video dataset once into a memory-mapped frame store.
+
+The store is read by the video datasets when the config sets `frame_store`
+to its directory. It must be extracted with the frame size (`image_res`, or
+`image_size` for retrieval) and, for 'uniform' sampling, the number of frames
+used by the task, e.g. for VATEX captioning and MSRVTT retrieval:
+
+    python extract_video_frames.py --ann_file data/vatex/vatex_public_test_english_v1.1.json --video_key videoID \
+        --video_root video_root/vatex/ --output_dir frame_store/vatex_448_8 --image_size 448 --num_frm 8
+    python extract_video_frames.py --ann_file annotation/msrvtt_test.jsonl --video_key clip_name \
+        --video_root video_root/msrvtt/videos/all --output_dir frame_store/msrvtt_224_12 --image_size 224 --num_frm 12
+
+With 'rand' or 'headtail' sampling, `--pool_frm` uniformly spaced frames are
+kept per clip and the training frames are sampled from them.
+"""
+import argparse
+import json
+import os
+import time
+
+from dataset.frame_store import extract_frames
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--ann_file', nargs='+', required=True, help='json or jsonl annotation files')
+parser.add_argument('--video_key', default='video_id', help='annotation field holding the clip name')
+parser.add_argument('--video_root', required=True)
+parser.add_argument('--video_fmt', default='.mp4')
+parser.add_argument('--output_dir', required=True)
+parser.add_argument('--image_size', type=int, default=384)
+parser.add_argument('--num_frm', type=int, default=16)
+parser.add_argument('--frm_sampling_strategy', default='uniform', choices=['uniform', 'rand', 'headtail'])
+parser.add_argument('--pool_frm', type=int, default=32, help='frames kept per clip for rand/headtail sampling')
+parser.add_argument('--workers', type=int, default=8)
+
+
+def load_annotations(filename):
+    with open(filename, 'r') as f:
+        if filename.endswith('.jsonl'):
+            return [json.loads(l.strip('\n')) for l in f.readlines()]
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    video_paths = {}
+    for ann_file in args.ann_file:
+        for ann in load_annotations(ann_file):
+            video_paths[ann[args.video_key]] = os.path.join(args.video_root, ann[args.video_key] + args.video_fmt)
+
+    start = time.time()
+    index = extract_frames(video_paths, args.output_dir, args.image_size, args.num_frm, args.frm_sampling_strategy,
+                           args.pool_frm, args.workers)
+    print('{} of {} clips, {} frames extracted to {} in {:.1f}s'.format(
+        len(index['clips']), len(video_paths), index['num_frames'], args.output_dir, time.time() - start))
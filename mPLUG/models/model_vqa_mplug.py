@@ -240,7 +240,84 @@ class MPLUG(nn.Module):
         topk_ids = torch.gather(topk_ids, 1, rerank_id)    
 
         return topk_ids, topk_probs
-    
+
+    def encode_answer_list(self, answer_ids, answer_atts):
+        '''
+        Question independent part of `rank_answer_shared`, computed once for a fixed answer list:
+        the decoder embeddings and first self-attention only see the answer tokens.
+        '''
+        bert = self.text_decoder.bert
+        answer_mask = bert.get_extended_attention_mask(answer_atts, answer_ids.size(), answer_ids.device, True)
+        answer_states = bert.embeddings(input_ids=answer_ids)
+        answer_states = bert.encoder.layer[0].attention(answer_states, answer_mask)[0]
+        answer_targets = answer_ids.masked_fill(answer_ids == self.tokenizer.pad_token_id, -100)[:, 1:]
+        return answer_states, answer_mask, answer_targets
+
+    def rank_answer_shared(self, question_states, question_atts, answer_ids, answer_cache, k):
+        '''
+        Same ranking as `rank_answer`, with `answer_cache` from `encode_answer_list`.
+
+        The top-k answers start from their cached first self-attention states, and
+        since cross-attention treats every answer token on its own, the k answers of a
+        question attend to its question states as one [k * answer_len] sequence instead
+        of tiling the question states k times. Only the non-padding answer positions
+        go through the LM head.
+        '''
+        answer_states, answer_mask, answer_targets = answer_cache
+
+        num_ques = question_states.size(0)
+        start_ids = answer_ids[0,0].repeat(num_ques,1) # bos token
+
+        start_output = self.text_decoder(start_ids,
+                                         encoder_hidden_states = question_states,
+                                         encoder_attention_mask = question_atts,
+                                         return_dict = True,
+                                         reduction = 'none')
+        logits = start_output.logits[:,0,:] # first token's logit
+
+        # topk_probs: top-k probability
+        # topk_ids: [num_question, k]
+        answer_first_token = answer_ids[:,1]
+        prob_first_token = F.softmax(logits,dim=1).index_select(dim=1, index=answer_first_token)
+        topk_probs, topk_ids = prob_first_token.topk(k,dim=1)
+
+        # answer states: [num_question*k, answer_len, hidden]
+        bert = self.text_decoder.bert
+        flat_ids = topk_ids.view(-1)
+        hidden_states = answer_states.index_select(0, flat_ids)
+        self_mask = answer_mask.index_select(0, flat_ids)
+        question_mask = bert.invert_attention_mask(question_atts)
+        answer_len = hidden_states.size(1)
+        for i, layer in enumerate(bert.encoder.layer):
+            if i > 0:
+                hidden_states = layer.attention(hidden_states, self_mask)[0]
+            hidden_states = hidden_states.view(num_ques, k * answer_len, -1)
+            hidden_states = layer.crossattention(hidden_states, None, None, question_states, question_mask)[0]
+            hidden_states = layer.feed_forward_chunk(hidden_states).view(num_ques * k, answer_len, -1)
+
+        # next-token prediction on the answer positions that are not padding
+        targets_ids = answer_targets.index_select(0, flat_ids)
+        valid = targets_ids != -100
+        prediction_scores = self.text_decoder.cls(hidden_states[:, :-1][valid])
+        answer_loss = prediction_scores.new_zeros(targets_ids.size())
+        answer_loss[valid] = F.cross_entropy(prediction_scores, targets_ids[valid], reduction='none')
+        answer_loss = answer_loss.sum(1, keepdim=True)
+
+        # topk_prob: first token probability
+        topk_probs = topk_probs.view(-1,1)
+        log_probs = torch.cat([topk_probs.log(), -answer_loss],dim=1)
+
+        # re-calculate log probabilities for the answer sequences using chain rule
+        log_probs_sum = log_probs.sum(1)
+        log_probs_sum = log_probs_sum.view(num_ques,k)
+
+        topk_probs = F.softmax(log_probs_sum, dim=-1)
+        # get top-k after re-ranking
+        topk_probs, rerank_id = topk_probs.topk(k,dim=1)
+        topk_ids = torch.gather(topk_ids, 1, rerank_id)
+
+        return topk_ids, topk_probs
+
 def tile(x, dim, n_tile):
     init_dim = x.size(dim)
     repeat_idx = [1] * x.dim()
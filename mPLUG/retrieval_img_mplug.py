@@ -23,6 +23,7 @@ from dataset import create_dataset, create_sampler, create_loader
 
 from scheduler import create_scheduler
 from optim import create_optimizer, create_two_optimizer
+from retrieval_index import SHARDS_FILE, RetrievalIndex, ShardWriter, itm_rerank, shard_range, topk_search
 
 
 def train(model, data_loader, optimizer, tokenizer, epoch, warmup_steps, device, scheduler, config, do_amp=False,
@@ -84,117 +85,142 @@ def train(model, data_loader, optimizer, tokenizer, epoch, warmup_steps, device,
 
 
 @torch.no_grad()
-def evaluation(model, data_loader, tokenizer, device, config):
-    # test
-    model.eval()
-
-    metric_logger = utils.MetricLogger(delimiter="  ")
-    header = 'Evaluation:'
-
-    print('Computing features for evaluation...')
-    start_time = time.time()
+def build_index(model, data_loader, tokenizer, device, config, index_dir):
+    """Encode the rows of this rank into the text and image indexes under `index_dir`."""
+    num_tasks = utils.get_world_size()
+    rank = utils.get_rank()
+    feat_dtype = torch.float16 if config.get('index_fp16', False) else None
+    text_dir = os.path.join(index_dir, 'text')
+    image_dir = os.path.join(index_dir, 'image')
+    if utils.is_main_process():
+        for path in (text_dir, image_dir):
+            if os.path.exists(os.path.join(path, SHARDS_FILE)):
+                os.remove(os.path.join(path, SHARDS_FILE))
+    if utils.is_dist_avail_and_initialized():
+        dist.barrier()
 
     texts = data_loader.dataset.text
     num_text = len(texts)
     text_bs = 256
-    text_feats = []
-    text_embeds = []
-    text_atts = []
-    for i in range(0, num_text, text_bs):
-        text = texts[i: min(num_text, i + text_bs)]
+    start, end = shard_range(num_text, rank, num_tasks)
+    writer = ShardWriter(text_dir, start, end, feat_dtype)
+    for i in range(start, end, text_bs):
+        text = texts[i: min(end, i + text_bs)]
         text_input = tokenizer(text, padding='max_length', truncation=True, max_length=30, return_tensors="pt").to(
             device)
         text_output = model.text_encoder(text_input.input_ids, attention_mask=text_input.attention_mask)
         text_feat = text_output.last_hidden_state
         text_embed = F.normalize(model.text_proj(text_feat[:, 0, :]))
-        text_embeds.append(text_embed)
-        text_feats.append(text_feat)
-        text_atts.append(text_input.attention_mask)
-    text_embeds = torch.cat(text_embeds, dim=0)
-    text_feats = torch.cat(text_feats, dim=0)
-    text_atts = torch.cat(text_atts, dim=0)
-
-    image_feats = []
-    image_embeds = []
-    for image, img_id in data_loader:
+        writer.write(text_embed, text_feat, text_input.attention_mask)
+    writer.close()
+
+    num_image = len(data_loader.dataset.image)
+    start, end = shard_range(num_image, rank, num_tasks)
+    image_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(data_loader.dataset, range(start, end)),
+                                               batch_size=data_loader.batch_size,
+                                               num_workers=data_loader.num_workers,
+                                               pin_memory=True)
+    writer = ShardWriter(image_dir, start, end, feat_dtype)
+    for image, img_id in image_loader:
         image = image.to(device)
         image_feat = model.visual_encoder.visual(image, skip_last_layer=True)
         image_feat = model.visn_layer_norm(model.visn_fc(image_feat))
         # image_feat = model.visual_encoder(image)
         image_embed = model.vision_proj(image_feat[:, 0, :])
         image_embed = F.normalize(image_embed, dim=-1)
+        image_att = torch.ones(image_feat.size()[:-1], dtype=torch.int8)
+        writer.write(image_embed, image_feat, image_att)
+    writer.close()
+
+    if utils.is_dist_avail_and_initialized():
+        dist.barrier()
+    if utils.is_main_process():
+        ShardWriter.finalize(text_dir, num_text, num_tasks)
+        ShardWriter.finalize(image_dir, num_image, num_tasks)
+    if utils.is_dist_avail_and_initialized():
+        dist.barrier()
 
-        image_feats.append(image_feat)
-        image_embeds.append(image_embed)
 
-    image_feats = torch.cat(image_feats, dim=0)
-    image_embeds = torch.cat(image_embeds, dim=0)
+@torch.no_grad()
+def evaluation(model, data_loader, tokenizer, device, config, index_dir, reuse_index=False):
+    """
+    Two-stage retrieval: ITC top-`k_test` from the memory-mapped index, then
+    ITM re-ranking of the candidates. Returns the re-ranked candidates of
+    every query as `(scores, indices)` pairs of [num_query, k] arrays for
+    image-to-text and text-to-image.
+
+    With `reuse_index`, features already written to `index_dir` by a
+    previous run for the same gallery are not encoded again.
+    """
+    # test
+    model.eval()
 
-    sims_matrix = image_embeds @ text_embeds.t()
-    score_matrix_i2t = torch.full((len(data_loader.dataset.image), len(texts)), -100.0).to(device)
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    header = 'Evaluation:'
+
+    start_time = time.time()
+
+    num_text = len(data_loader.dataset.text)
+    num_image = len(data_loader.dataset.image)
+    text_dir = os.path.join(index_dir, 'text')
+    image_dir = os.path.join(index_dir, 'image')
+    if not (reuse_index and RetrievalIndex.exists(text_dir, num_text)
+            and RetrievalIndex.exists(image_dir, num_image)):
+        print('Computing features for evaluation...')
+        build_index(model, data_loader, tokenizer, device, config, index_dir)
+    text_index = RetrievalIndex(text_dir)
+    image_index = RetrievalIndex(image_dir)
 
     num_tasks = utils.get_world_size()
     rank = utils.get_rank()
-    step = sims_matrix.size(0) // num_tasks + 1
-    start = rank * step
-    end = min(sims_matrix.size(0), start + step)
-
-    for i, sims in enumerate(metric_logger.log_every(sims_matrix[start:end], 50, header)):
-        topk_sim, topk_idx = sims.topk(k=config['k_test'], dim=0)
-
-        encoder_output = image_feats[start + i].repeat(config['k_test'], 1, 1)
-        encoder_att = torch.ones(encoder_output.size()[:-1], dtype=torch.long).to(device)
-        _, output = model.fusion_encoder(encoder_embeds=text_feats[topk_idx],
-                                         attention_mask=text_atts[topk_idx],
-                                         encoder_hidden_states=encoder_output,
-                                         encoder_attention_mask=encoder_att,
-                                         return_dict=False,
-                                        )
-        score = model.itm_head(output[:, 0, :])[:, 1]
-        score_matrix_i2t[start + i, topk_idx] = score.float()
-
-    sims_matrix = sims_matrix.t()
-    score_matrix_t2i = torch.full((len(texts), len(data_loader.dataset.image)), -100.0).to(device)
-
-    step = sims_matrix.size(0) // num_tasks + 1
-    start = rank * step
-    end = min(sims_matrix.size(0), start + step)
-
-    for i, sims in enumerate(metric_logger.log_every(sims_matrix[start:end], 50, header)):
-        topk_sim, topk_idx = sims.topk(k=config['k_test'], dim=0)
-        encoder_output = image_feats[topk_idx]
-        encoder_att = torch.ones(encoder_output.size()[:-1], dtype=torch.long).to(device)
-        _, output = model.fusion_encoder(encoder_embeds=text_feats[start + i].repeat(config['k_test'], 1, 1),
-                                         attention_mask=text_atts[start + i].repeat(config['k_test'], 1),
-                                         encoder_hidden_states=encoder_output,
-                                         encoder_attention_mask=encoder_att,
-                                         return_dict=False,
-                                        )
-        score = model.itm_head(output[:, 0, :])[:, 1]
-        score_matrix_t2i[start + i, topk_idx] = score.float()
+    itm_batch_size = config.get('itm_batch_size', config['k_test'])
+    results = []
+    for queries, gallery, query_is_image in [(image_index, text_index, True), (text_index, image_index, False)]:
+        k = min(config['k_test'], len(gallery))
+        topk_score = torch.zeros(len(queries), k).to(device)
+        topk_idx = torch.zeros(len(queries), k, dtype=torch.long).to(device)
+
+        start, end = shard_range(len(queries), rank, num_tasks)
+        query_chunk = config.get('query_chunk', 256)
+        for i in metric_logger.log_every(range(start, end, query_chunk), 10, header):
+            chunk_end = min(end, i + query_chunk)
+            _, candidates = topk_search(queries, gallery, i, chunk_end, k, device)
+            query_ids = np.repeat(np.arange(i, chunk_end), k)
+            candidate_ids = candidates.view(-1).cpu().numpy()
+            if query_is_image:
+                score = itm_rerank(model, image_index, text_index, query_ids, candidate_ids, device, itm_batch_size)
+            else:
+                score = itm_rerank(model, image_index, text_index, candidate_ids, query_ids, device, itm_batch_size)
+            topk_score[i:chunk_end] = score.view(-1, k)
+            topk_idx[i:chunk_end] = candidates
 
-    if args.distributed:
-        dist.barrier()
-        torch.distributed.all_reduce(score_matrix_i2t, op=torch.distributed.ReduceOp.SUM)
-        torch.distributed.all_reduce(score_matrix_t2i, op=torch.distributed.ReduceOp.SUM)
+        if args.distributed:
+            dist.barrier()
+            torch.distributed.all_reduce(topk_score, op=torch.distributed.ReduceOp.SUM)
+            torch.distributed.all_reduce(topk_idx, op=torch.distributed.ReduceOp.SUM)
+        results.append((topk_score.cpu().numpy(), topk_idx.cpu().numpy()))
 
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Evaluation time {}'.format(total_time_str))
 
-    return score_matrix_i2t.cpu().numpy(), score_matrix_t2i.cpu().numpy()
+    return results[0], results[1]
 
 
 @torch.no_grad()
-def itm_eval(scores_i2t, scores_t2i, txt2img, img2txt):
+def itm_eval(topk_i2t, topk_t2i, txt2img, img2txt):
+    # Candidates are ranked by their re-ranked score, a ground truth that
+    # did not make it into the candidates ranks after all of them.
     # Images->Text
+    scores_i2t, indices_i2t = topk_i2t
     ranks = np.zeros(scores_i2t.shape[0])
     for index, score in enumerate(scores_i2t):
-        inds = np.argsort(score)[::-1]
+        inds = indices_i2t[index][np.argsort(score)[::-1]]
         # Score
         rank = 1e20
         for i in img2txt[index]:
-            tmp = np.where(inds == i)[0][0]
+            tmp = np.where(inds == i)[0]
+            tmp = tmp[0] if len(tmp) > 0 else len(inds)
             if tmp < rank:
                 rank = tmp
         ranks[index] = rank
@@ -205,11 +231,13 @@ def itm_eval(scores_i2t, scores_t2i, txt2img, img2txt):
     tr10 = 100.0 * len(np.where(ranks < 10)[0]) / len(ranks)
 
     # Text->Images
+    scores_t2i, indices_t2i = topk_t2i
     ranks = np.zeros(scores_t2i.shape[0])
 
     for index, score in enumerate(scores_t2i):
-        inds = np.argsort(score)[::-1]
-        ranks[index] = np.where(inds == txt2img[index])[0][0]
+        inds = indices_t2i[index][np.argsort(score)[::-1]]
+        tmp = np.where(inds == txt2img[index])[0]
+        ranks[index] = tmp[0] if len(tmp) > 0 else len(inds)
 
     # Compute metrics
     ir1 = 100.0 * len(np.where(ranks < 1)[0]) / len(ranks)
@@ -351,8 +379,11 @@ def main(args, config):
             train_stats = train(model, train_loader, optimizer, tokenizer, epoch, warmup_steps, device, lr_scheduler,
                                 config, do_amp=args.do_amp, do_two_optim=args.do_two_optim)
 
-        score_val_i2t, score_val_t2i, = evaluation(model_without_ddp, val_loader, tokenizer, device, config)
-        score_test_i2t, score_test_t2i = evaluation(model_without_ddp, test_loader, tokenizer, device, config)
+        index_dir = args.index_dir or os.path.join(args.output_dir, 'retrieval_index')
+        score_val_i2t, score_val_t2i, = evaluation(model_without_ddp, val_loader, tokenizer, device, config,
+                                                   os.path.join(index_dir, 'val'), args.evaluate and args.reuse_index)
+        score_test_i2t, score_test_t2i = evaluation(model_without_ddp, test_loader, tokenizer, device, config,
+                                                    os.path.join(index_dir, 'test'), args.evaluate and args.reuse_index)
 
         if utils.is_main_process():
 
@@ -421,6 +452,10 @@ if __name__ == '__main__':
     parser.add_argument('--do_two_optim', action='store_true')
     parser.add_argument('--do_amp', action='store_true')
     parser.add_argument('--do_zs', action='store_true')
+    parser.add_argument('--index_dir', default='', help='where the evaluation features are memory-mapped, '
+                                                        'defaults to output_dir/retrieval_index')
+    parser.add_argument('--reuse_index', action='store_true', help='with --evaluate, reuse the features '
+                                                                    'already written to index_dir')
     args = parser.parse_args()
 
     config = yaml.load(open(args.config, 'r'), Loader=yaml.Loader)
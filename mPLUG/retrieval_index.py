@@ -0,0 +1,175 @@
+"""Memory-mapped two-stage retrieval index (ITC top-k search, batched ITM re-rank).
+
+One side of a gallery (images or texts) is stored in a directory as
+row-range shards, each made of three .npy files opened with `mmap_mode`:
+
+    {shard}.embeds.npy  normalized ITC embeddings   [rows, embed_dim]
+    {shard}.feats.npy   fusion encoder inputs       [rows, seq_len, width]
+    {shard}.atts.npy    attention mask of the feats [rows, seq_len]
+
+plus `shards.json` listing the global row range of every shard, written last
+so a directory holding it is complete and can be reused on the next run.
+"""
+import json
+import os
+
+import numpy as np
+import torch
+
+SHARDS_FILE = 'shards.json'
+NAMES = ('embeds', 'feats', 'atts')
+
+
+def shard_range(num_rows, rank, world_size):
+    """Rows [start, end) encoded and written by `rank`."""
+    step = (num_rows + world_size - 1) // world_size
+    start = min(num_rows, rank * step)
+    return start, min(num_rows, start + step)
+
+
+class ShardWriter(object):
+    """Writes the rows [start, end) of an index, the files are created on the first batch."""
+
+    def __init__(self, path, start, end, feat_dtype=None):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.feat_dtype = feat_dtype
+        self.offset = 0
+        self.arrays = None
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, embeds, feats, atts):
+        batch = {'embeds': embeds.float(), 'feats': feats, 'atts': atts}
+        if self.feat_dtype is not None:
+            batch['feats'] = feats.to(self.feat_dtype)
+        if self.arrays is None:
+            self.arrays = {}
+            for name in NAMES:
+                array = batch[name].cpu().numpy()
+                self.arrays[name] = np.lib.format.open_memmap(
+                    self.filename(self.path, self.start, name), mode='w+', dtype=array.dtype,
+                    shape=(self.end - self.start,) + array.shape[1:])
+        size = embeds.size(0)
+        for name in NAMES:
+            self.arrays[name][self.offset:self.offset + size] = batch[name].cpu().numpy()
+        self.offset += size
+
+    def close(self):
+        assert self.offset == self.end - self.start, 'wrote {} of {} rows'.format(
+            self.offset, self.end - self.start)
+        if self.arrays is not None:
+            for array in self.arrays.values():
+                array.flush()
+        self.arrays = None
+
+    @staticmethod
+    def filename(path, start, name):
+        return os.path.join(path, '{:09d}.{}.npy'.format(start, name))
+
+    @staticmethod
+    def finalize(path, num_rows, world_size):
+        """Record the shards of all ranks once every one of them is closed."""
+        ranges = [shard_range(num_rows, rank, world_size) for rank in range(world_size)]
+        with open(os.path.join(path, SHARDS_FILE), 'w') as f:
+            json.dump([[start, end] for start, end in ranges if end > start], f)
+
+
+class RetrievalIndex(object):
+    """Read side of an index written by `ShardWriter`; rows are only read when used."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, SHARDS_FILE)) as f:
+            ranges = json.load(f)
+        self.offsets = np.array([start for start, _ in ranges] + [ranges[-1][1]], dtype=np.int64)
+        self.shards = [{name: np.load(ShardWriter.filename(path, start, name), mmap_mode='r')
+                        for name in NAMES} for start, _ in ranges]
+
+    @staticmethod
+    def exists(path, num_rows):
+        try:
+            with open(os.path.join(path, SHARDS_FILE)) as f:
+                ranges = json.load(f)
+        except (IOError, ValueError):
+            return False
+        return len(ranges) > 0 and ranges[-1][1] == num_rows
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def chunks(self, name, chunk_size):
+        """Yield `(start, rows)` over the whole index, at most `chunk_size` rows at a time."""
+        for offset, shard in zip(self.offsets, self.shards):
+            array = shard[name]
+            for start in range(0, len(array), chunk_size):
+                yield int(offset) + start, np.array(array[start:start + chunk_size])
+
+    def take(self, name, indices):
+        """Rows at the sorted, unique global `indices`."""
+        shard_ids = np.searchsorted(self.offsets, indices, side='right') - 1
+        rows = []
+        for shard_id in np.unique(shard_ids):
+            local = indices[shard_ids == shard_id] - self.offsets[shard_id]
+            rows.append(self.shards[shard_id][name][local])
+        return np.concatenate(rows)
+
+    def gather(self, name, indices, device):
+        """Rows at arbitrary `indices` as a tensor; every distinct row is read once."""
+        unique, inverse = np.unique(indices, return_inverse=True)
+        rows = torch.from_numpy(self.take(name, unique)).to(device)
+        return rows[torch.from_numpy(inverse.reshape(-1)).to(device)]
+
+
+def topk_search(queries, gallery, query_start, query_end, k, device,
+                query_chunk=1024, gallery_chunk=65536):
+    """
+    ITC top-k of the queries [query_start, query_end) over the whole gallery.
+
+    The similarities of at most `query_chunk` x `gallery_chunk` pairs exist at
+    a time; each gallery chunk is merged into the running top-k.
+    Returns `(scores, indices)`, both [query_end - query_start, k] tensors.
+    """
+    k = min(k, len(gallery))
+    all_scores, all_indices = [], []
+    for start in range(query_start, query_end, query_chunk):
+        query = queries.gather('embeds', np.arange(start, min(query_end, start + query_chunk)), device)
+        scores = query.new_empty(query.size(0), 0)
+        indices = torch.empty(query.size(0), 0, dtype=torch.long, device=device)
+        for offset, embeds in gallery.chunks('embeds', gallery_chunk):
+            sims = query @ torch.from_numpy(embeds).to(device).t()
+            chunk_scores, chunk_indices = sims.topk(min(k, sims.size(1)), dim=1)
+            scores = torch.cat([scores, chunk_scores], dim=1)
+            indices = torch.cat([indices, chunk_indices + offset], dim=1)
+            scores, order = scores.topk(min(k, scores.size(1)), dim=1)
+            indices = indices.gather(1, order)
+        all_scores.append(scores)
+        all_indices.append(indices)
+    if not all_scores:
+        return (torch.empty(0, k, device=device),
+                torch.empty(0, k, dtype=torch.long, device=device))
+    return torch.cat(all_scores), torch.cat(all_indices)
+
+
+@torch.no_grad()
+def itm_rerank(model, image_index, text_index, image_ids, text_ids, device, batch_size):
+    """
+    ITM scores of the (image_ids[i], text_ids[i]) pairs.
+
+    Pairs are flattened across queries and scored `batch_size` at a time, so
+    one fusion encoder call covers the candidates of several queries.
+    """
+    dtype = model.itm_head.weight.dtype
+    scores = torch.empty(len(image_ids), device=device)
+    for start in range(0, len(image_ids), batch_size):
+        images = image_ids[start:start + batch_size]
+        texts = text_ids[start:start + batch_size]
+        encoder_output = image_index.gather('feats', images, device).to(dtype)
+        encoder_att = torch.ones(encoder_output.size()[:-1], dtype=torch.long).to(device)
+        _, output = model.fusion_encoder(encoder_embeds=text_index.gather('feats', texts, device).to(dtype),
+                                         attention_mask=text_index.gather('atts', texts, device),
+                                         encoder_hidden_states=encoder_output,
+                                         encoder_attention_mask=encoder_att,
+                                         return_dict=False,
+                                        )
+        scores[start:start + len(images)] = model.itm_head(output[:, 0, :])[:, 1].float()
+    return scores
@@ -187,7 +187,8 @@ def main(args, config):
     #### Dataset ####
     print("Creating retrieval dataset")
     test_dataset = VideoDataset(config['video_root'], config['ann_root'], num_frm=config['num_frm_test'],
-                                max_img_size=config['image_size'], frm_sampling_strategy='uniform')
+                                max_img_size=config['image_size'], frm_sampling_strategy='uniform',
+                                frame_store=config.get('frame_store'))
 
     test_loader = DataLoader(
         test_dataset,
@@ -38,6 +38,7 @@ def evaluate(model, data_loader, dataset, tokenizer, device, config):
 
     answer_list = [answer + config['eos'] for answer in data_loader.dataset.answer_list]
     answer_input = tokenizer(answer_list, padding='longest', return_tensors='pt').to(device)
+    answer_cache = model.encode_answer_list(answer_input.input_ids, answer_input.attention_mask)
     for n, (image, question, question_id) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
         image = image.to(device, non_blocking=True)
         question_input = tokenizer(question, padding='longest', return_tensors="pt").to(device)
@@ -61,8 +62,8 @@ def evaluate(model, data_loader, dataset, tokenizer, device, config):
         image_output, question_output = fusion_output
         question_output = torch.cat([image_output, question_output], 1)
         merge_text_attention = torch.cat([image_atts, question_input.attention_mask], 1)
-        topk_ids, topk_probs = model.rank_answer(question_output, merge_text_attention, answer_input.input_ids,
-                                                 answer_input.attention_mask, config['k_test'])
+        topk_ids, topk_probs = model.rank_answer_shared(question_output, merge_text_attention, answer_input.input_ids,
+                                                        answer_cache, config['k_test'])
 
         result = []
         for ques_id, topk_id, topk_prob in zip(question_id, topk_ids, topk_probs):
@@ -160,7 +161,8 @@ def main(args, config):
         split='test',
         answer_list=config['answer_list'],
         read_local_data=config['read_local_data'],
-        max_img_size=config['image_res']
+        max_img_size=config['image_res'],
+        frame_store=config.get('frame_store')
     )]
 
     if "msvd" in config['val_file'][0]:
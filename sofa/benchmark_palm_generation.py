@@ -0,0 +1,98 @@
+# coding=utf-8
+# Copyright 2021-2022 The Alibaba DAMO NLP Team Authors.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Beam search latency of PalmForConditionalGeneration versus output length, with and without the decoder cache.
+
+Decodes random sources with a randomly initialized PALM, once with
+`TextGenerator` and once with `generate()`, every output forced to the full
+length, and checks that the cached and uncached searches return the same
+predictions.
+
+    python benchmark_palm_generation.py --lengths 16 32 64 128 --beam_size 5
+"""
+import argparse
+import time
+
+import torch
+
+import sofa
+sofa.environ("huggingface")
+from sofa import PalmConfig, PalmForConditionalGeneration
+from sofa.examples.finetune.generation import TextGenerator
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--lengths', type=int, nargs='+', default=[16, 32, 64, 128])
+parser.add_argument('--batch_size', type=int, default=4)
+parser.add_argument('--beam_size', type=int, default=5)
+parser.add_argument('--source_length', type=int, default=128)
+parser.add_argument('--vocab_size', type=int, default=21504)
+parser.add_argument('--hidden_size', type=int, default=512)
+parser.add_argument('--num_hidden_layers', type=int, default=6)
+parser.add_argument('--dec_hidden_layers', type=int, default=6)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('--seed', type=int, default=42)
+
+CLS, SEP = 101, 102
+
+
+def timed(fn):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.time()
+    output = fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return output, time.time() - start
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    config = PalmConfig(vocab_size=args.vocab_size, hidden_size=args.hidden_size,
+                        num_hidden_layers=args.num_hidden_layers, num_attention_heads=args.hidden_size // 64,
+                        intermediate_size=4 * args.hidden_size, dec_hidden_layers=args.dec_hidden_layers,
+                        max_position_embeddings=max(args.source_length, max(args.lengths) + 1))
+    model = PalmForConditionalGeneration(config).to(args.device).eval()
+
+    tokens = torch.randint(1000, args.vocab_size, (args.batch_size, args.source_length), device=args.device)
+    tokens[:, 0], tokens[:, -1] = CLS, SEP
+    types = torch.zeros_like(tokens)
+    padding_mask = torch.ones_like(tokens)
+    symbols = {'[CLS]': CLS, '[SEP]': SEP}
+
+    print('{} sources of {} tokens, beam {}, {} decoder layers of {}, {}'.format(
+        args.batch_size, args.source_length, args.beam_size, args.dec_hidden_layers, args.hidden_size, args.device))
+    print('{:>8} {:>12} {:>12} {:>8} {:>12} {:>12} {:>8} {:>6}'.format(
+        'length', 'TextGen ms', 'cached ms', 'speedup', 'generate ms', 'cached ms', 'speedup', 'same'))
+    for length in args.lengths:
+        times, outputs = [], []
+        for use_cache in (False, True):
+            generator = TextGenerator(model, None, symbols, beam_size=args.beam_size, min_length=length,
+                                      max_length=length, use_cache=use_cache)
+            result, elapsed = timed(lambda: generator.translate_batch([tokens, types, padding_mask]))
+            times.append(elapsed)
+            outputs.append([pred[0].tolist() for pred in result['predictions']])
+        for use_cache in (False, True):
+            with torch.no_grad():
+                result, elapsed = timed(lambda: model.generate(
+                    tokens, attention_mask=padding_mask, num_beams=args.beam_size, max_length=length + 1,
+                    min_length=length + 1, decoder_start_token_id=CLS, eos_token_id=SEP, pad_token_id=0,
+                    use_cache=use_cache))
+            times.append(elapsed)
+            outputs.append(result.tolist())
+        same = outputs[0] == outputs[1] and outputs[2] == outputs[3]
+        print('{:8d} {:12.1f} {:12.1f} {:7.2f}x {:12.1f} {:12.1f} {:7.2f}x {:>6}'.format(
+            length, 1000 * times[0], 1000 * times[1], times[0] / times[1],
+            1000 * times[2], 1000 * times[3], times[2] / times[3], str(same)))
@@ -44,6 +44,8 @@ class TextGenerator:
        cuda (bool): use cuda
        beam_trace (bool): trace beam search for debugging
        logger(logging.Logger): logger.
+       use_cache (bool): keep the decoder keys and values between steps
+         and only decode the last token of every beam.
     """
 
     def __init__(self,
@@ -55,8 +57,10 @@ class TextGenerator:
                  max_length=100,
                  global_scorer=None,
                  logger=None,
-                 dump_beam=""):
+                 dump_beam="",
+                 use_cache=True):
         self.alpha = 0.6
+        self.use_cache = use_cache
 
         self.logger = logger
         # self.cuda = args.visible_gpus != '-1'
@@ -196,6 +200,7 @@ class TextGenerator:
         results["batch"] = []
         dec_attn_mask = None
         dec_position_ids = None
+        past_key_values = None
 
         for step in range(max_length):
             tgt_len = alive_seq.size()[1]
@@ -205,7 +210,13 @@ class TextGenerator:
             #dec_feat_seq = self.model.decode(self.model.bert.embeddings, src_features, alive_seq,
             #                           enc_attn_mask=repeat_attention_mask, dec_attn_mask=dec_attn_mask)
             
-            prediction_scores, dec_feat_seq, _ = self.model(tokens, types, attention_mask, alive_seq, dec_position_ids, dec_attn_mask, checkpoint_activations=False, is_infer=True, sequence_output=src_features)
+            if self.use_cache:
+                decode_input = alive_seq if past_key_values is None else alive_seq[:, -1:]
+                prediction_scores, dec_feat_seq, _, past_key_values = self.model(
+                    tokens, types, attention_mask, decode_input, dec_position_ids, dec_attn_mask, checkpoint_activations=False,
+                    is_infer=True, sequence_output=src_features, past_key_values=past_key_values, use_cache=True)
+            else:
+                prediction_scores, dec_feat_seq, _ = self.model(tokens, types, attention_mask, alive_seq, dec_position_ids, dec_attn_mask, checkpoint_activations=False, is_infer=True, sequence_output=src_features)
 
             dec_feat_seq = dec_feat_seq[:, -1, :]
             vocab_size = dec_feat_seq.size(-1)
@@ -281,8 +292,18 @@ class TextGenerator:
                     .view(-1, alive_seq.size(-1))
             # Reorder states.
             select_indices = batch_index.view(-1)
-            src_features = src_features.index_select(0, select_indices)
-            attention_mask = attention_mask.index_select(0, select_indices)
+            if self.use_cache and select_indices.size(0) == src_features.size(0):
+                # no finished batch was removed and the source side is the same for all beams of a batch
+                past_key_values = tuple(
+                    tuple(state.index_select(0, select_indices) for state in layer_past[:2]) + layer_past[2:]
+                    for layer_past in past_key_values)
+            else:
+                src_features = src_features.index_select(0, select_indices)
+                attention_mask = attention_mask.index_select(0, select_indices)
+                if self.use_cache:
+                    past_key_values = tuple(
+                        tuple(state.index_select(0, select_indices) for state in layer_past)
+                        for layer_past in past_key_values)
 
         return results
 
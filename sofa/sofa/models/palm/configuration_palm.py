@@ -107,6 +107,8 @@ class PalmConfig(PretrainedConfig):
         attn_separate=False,
         **kwargs
     ):
+        # encoder-decoder, so `generate` encodes the source once and decodes from `decoder_start_token_id`
+        kwargs.setdefault("is_encoder_decoder", True)
         super().__init__(layer_norm_eps=layernorm_epsilon, **kwargs)
 
         self.vocab_size = vocab_size
@@ -21,6 +21,8 @@ import math
 import logging
 import tarfile
 import tempfile
+from dataclasses import dataclass
+from typing import Optional, Tuple
 
 import torch
 from torch import nn
@@ -29,6 +31,7 @@ from torch.utils import checkpoint
 
 from ...utils.modeling_utils import PreTrainedModel
 from ...utils import ACT2FN
+from ...utils import ModelOutput
 
 logger = logging.getLogger(__name__)
 
@@ -604,9 +607,11 @@ class PalmDecoderSelfAttention(torch.nn.Module):
 
         return tensor_list
 
-    def forward(self, hidden_states, ltor_mask, is_infer=False):
+    def forward(self, hidden_states, ltor_mask, is_infer=False, layer_past=None, use_cache=False):
         # hidden_states: [b, s, h]
         # ltor_mask: [1, 1, s, s]
+        # layer_past: keys and values [b, np, p, hn] of the p previous positions,
+        #   hidden_states then only holds the positions after them
 
         # Attention heads. [b, s, hp]
         tgt_len = hidden_states.size(1)
@@ -619,7 +624,11 @@ class PalmDecoderSelfAttention(torch.nn.Module):
         query_layer = self._transpose_for_scores(mixed_query_layer)
         key_layer = self._transpose_for_scores(mixed_key_layer)
         value_layer = self._transpose_for_scores(mixed_value_layer)
-        
+        if layer_past is not None:
+            key_layer = torch.cat((layer_past[0], key_layer), dim=2)
+            value_layer = torch.cat((layer_past[1], value_layer), dim=2)
+        present = (key_layer, value_layer) if use_cache else None
+
         previous_type = value_layer.type()
 
         # Raw attention scores. [b, np, s, s]
@@ -629,11 +638,14 @@ class PalmDecoderSelfAttention(torch.nn.Module):
             self.hidden_size_per_attention_head)
         # Apply the left to right attention mask.
         if is_infer:
+            # a single new position attends to all previous ones, no mask needed
             src_len = key_layer.size(2)
             ltor_mask = torch.tril(torch.ones(
-                        (1, tgt_len, src_len), device=hidden_states.device)).view(1, 1, tgt_len, src_len).type(previous_type)
-        attention_scores = torch.mul(attention_scores, ltor_mask) - \
-                           10000.0 * (1.0 - ltor_mask)
+                        (1, tgt_len, src_len), device=hidden_states.device), diagonal=src_len - tgt_len).view(
+                            1, 1, tgt_len, src_len).type(previous_type) if tgt_len > 1 else None
+        if ltor_mask is not None:
+            attention_scores = torch.mul(attention_scores, ltor_mask) - \
+                               10000.0 * (1.0 - ltor_mask)
 
         # Attention probabilities. [b, np, s, s]
         attention_probs = torch.nn.Softmax(dim=-1)(attention_scores)
@@ -655,6 +667,8 @@ class PalmDecoderSelfAttention(torch.nn.Module):
         output = self.dense(context_layer)
         output = self.output_dropout(output)
 
+        if use_cache:
+            return output, present
         return output
 
 
@@ -708,21 +722,25 @@ class PalmDecoderCrossAttention(torch.nn.Module):
 
         return tensor_list
 
-    def forward(self, query, enc_hidden_states, enc_attn_mask):
+    def forward(self, query, enc_hidden_states, enc_attn_mask, layer_past=None, use_cache=False):
+        # layer_past: keys and values of enc_hidden_states from a previous call, reused as they are
         # Attention heads. [b, s, hp]
         mixed_query_layer = self.query(query)
         #print_rank_0(enc_hidden_states.size())
-        if not self.attn_separate:
-            mixed_x_layer = self.key_value(enc_hidden_states)
-            (mixed_key_layer, mixed_value_layer) = self._split_tensor_along_last_dim(mixed_x_layer, 2)
+        query_layer = self._transpose_for_scores(mixed_query_layer)
+        if layer_past is not None:
+            key_layer, value_layer = layer_past
         else:
-            mixed_key_layer = self.key(enc_hidden_states)
-            mixed_value_layer = self.value(enc_hidden_states)
+            if not self.attn_separate:
+                mixed_x_layer = self.key_value(enc_hidden_states)
+                (mixed_key_layer, mixed_value_layer) = self._split_tensor_along_last_dim(mixed_x_layer, 2)
+            else:
+                mixed_key_layer = self.key(enc_hidden_states)
+                mixed_value_layer = self.value(enc_hidden_states)
 
-        # Reshape and transpose [b, np, s, hn]
-        query_layer = self._transpose_for_scores(mixed_query_layer)
-        key_layer = self._transpose_for_scores(mixed_key_layer)
-        value_layer = self._transpose_for_scores(mixed_value_layer)
+            # Reshape and transpose [b, np, s, hn]
+            key_layer = self._transpose_for_scores(mixed_key_layer)
+            value_layer = self._transpose_for_scores(mixed_value_layer)
 
         # Raw attention scores. [b, np, s, s]
         attention_scores = torch.matmul(query_layer,
@@ -752,6 +770,8 @@ class PalmDecoderCrossAttention(torch.nn.Module):
         output = self.dense(context_layer)
         output = self.output_dropout(output)
 
+        if use_cache:
+            return output, (key_layer, value_layer)
         return output
 
 
@@ -782,16 +802,26 @@ class PalmDecoderLayer(nn.Module):
         
         self.dropout = torch.nn.Dropout(config.hidden_dropout_prob)
         
-    def forward(self, hidden_states, enc_hidden_states, enc_attn_mask, dec_attn_mask, is_infer=False):
+    def forward(self, hidden_states, enc_hidden_states, enc_attn_mask, dec_attn_mask, is_infer=False,
+                layer_past=None, use_cache=False):
+        # layer_past: (self-attention key, value, cross-attention key, value) returned by a previous call
         residual = hidden_states
         hidden_states = self.input_layernorm(hidden_states)
-        hidden_states = self.attention(hidden_states, dec_attn_mask, is_infer=is_infer)
+        hidden_states = self.attention(hidden_states, dec_attn_mask, is_infer=is_infer,
+                                       layer_past=layer_past[:2] if layer_past is not None else None,
+                                       use_cache=use_cache)
+        if use_cache:
+            hidden_states, self_attention_present = hidden_states
         # add dropout?
         hidden_states = residual + hidden_states
 
         residual = hidden_states     
         hidden_states = self.post_attention_layernorm(hidden_states)
-        hidden_states = self.cross_attention(hidden_states, enc_hidden_states, enc_attn_mask)
+        hidden_states = self.cross_attention(hidden_states, enc_hidden_states, enc_attn_mask,
+                                             layer_past=layer_past[2:] if layer_past is not None else None,
+                                             use_cache=use_cache)
+        if use_cache:
+            hidden_states, cross_attention_present = hidden_states
         hidden_states = residual + hidden_states
         residual = hidden_states
         hidden_states = self.post_cross_attention_layernorm(hidden_states)
@@ -802,6 +832,8 @@ class PalmDecoderLayer(nn.Module):
         hidden_states = self.dropout(hidden_states)
         hidden_states = residual + hidden_states
         
+        if use_cache:
+            return hidden_states, self_attention_present + cross_attention_present
         return hidden_states
 
 
@@ -812,8 +844,10 @@ class PalmDecoder(nn.Module):
         
         self.final_layernorm = PalmLayerNorm(config.hidden_size, eps=config.layernorm_epsilon)
 
-    def forward(self, hidden_states, enc_hidden_states, enc_attn_mask, dec_attn_mask, checkpoint_activations=False, is_infer=False):
+    def forward(self, hidden_states, enc_hidden_states, enc_attn_mask, dec_attn_mask, checkpoint_activations=False, is_infer=False,
+                past_key_values=None, use_cache=False):
         pre_enc_hidden= enc_hidden_states.data
+        presents = () if use_cache else None
         #pre_enc_hidden= enc_hidden_states.clone()
         if checkpoint_activations:
             l = 0
@@ -825,11 +859,18 @@ class PalmDecoder(nn.Module):
                 l += chunk_length
             # decoder layers
         else:
-            for layer_module in self.layer:
-                hidden_states = layer_module(hidden_states, enc_hidden_states, enc_attn_mask, dec_attn_mask, is_infer=is_infer)
+            for i, layer_module in enumerate(self.layer):
+                hidden_states = layer_module(hidden_states, enc_hidden_states, enc_attn_mask, dec_attn_mask, is_infer=is_infer,
+                                             layer_past=past_key_values[i] if past_key_values is not None else None,
+                                             use_cache=use_cache)
+                if use_cache:
+                    hidden_states, present = hidden_states
+                    presents = presents + (present,)
         
         hidden_states = self.final_layernorm(hidden_states)
         
+        if use_cache:
+            return [hidden_states], presents
         return [hidden_states]
 
 
@@ -853,31 +894,49 @@ class PalmDecoderModel(PalmPreTrainedModel):
             a batch has varying length sentences.
         `dec_attn_mask`: an optional torch.LongTensor of shape [batch_size, sequence_length] with indices
             selected in [0, 1]. Similar to enc_attn_mask.
+        `past_key_values`: optional keys and values of the previous decoder positions returned with `use_cache`,
+            `decode_input_ids` then only holds the positions after them.
+        `use_cache`: a boolean, also return the keys and values to pass as `past_key_values` to the next call.
 
     Outputs: pooled_output(at the last position of sequence_output)
         `pooled_output`: a torch.FloatTensor of size [batch_size, hidden_size] which is the output of a
             classifier pretrained on top of the hidden state associated to the first character of the
             input (`CLF`) to train on the Next-Sentence task (see BERT's paper).
+        if `use_cache` is `True`, Tuple of (pooled_output, past_key_values), where `past_key_values` holds
+            (self-attention key, value, cross-attention key, value) of every layer, each of shape
+            [batch_size, num_heads, length, head_size].
     """
     def __init__(self, config):
         super().__init__(config)
         self.decoder = PalmDecoder(config)
         self.apply(self.init_bert_weights)
 
-    def forward(self, embeddings, sequence_output, decode_input_ids, position_ids=None, enc_attn_mask=None, dec_attn_mask=None, checkpoint_activations=False, is_infer=False):
+    def forward(self, embeddings, sequence_output, decode_input_ids, position_ids=None, enc_attn_mask=None, dec_attn_mask=None, checkpoint_activations=False, is_infer=False,
+                past_key_values=None, use_cache=False):
 
         extended_attention_mask = enc_attn_mask.unsqueeze(1).unsqueeze(2)
         extended_attention_mask = extended_attention_mask.to(dtype=next(self.decoder.parameters()).dtype) # fp16 compatibility
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
 
-        embedding_output = embeddings(decode_input_ids)
+        if past_key_values is not None:
+            past_length = past_key_values[0][0].size(2)
+            position_ids = torch.arange(past_length, past_length + decode_input_ids.size(1), dtype=torch.long,
+                                        device=decode_input_ids.device)
+            embedding_output = embeddings(decode_input_ids, position_ids=position_ids.unsqueeze(0).expand_as(decode_input_ids))
+        else:
+            embedding_output = embeddings(decode_input_ids)
         sequence_output = self.decoder(embedding_output,
                                        sequence_output,
                                        extended_attention_mask,
                                        dec_attn_mask,
                                        checkpoint_activations=checkpoint_activations,
-                                       is_infer=is_infer)
+                                       is_infer=is_infer,
+                                       past_key_values=past_key_values,
+                                       use_cache=use_cache)
 
+        if use_cache:
+            sequence_output, presents = sequence_output
+            return sequence_output[-1], presents
         return sequence_output[-1]
 
 
@@ -907,12 +966,16 @@ class PalmModel(PalmPreTrainedModel):
             input sequence length in the current batch. It's the mask that we typically use for attention when
             a batch has varying length sentences.
         `is_infer`: a boolean indicating whether the model is used for inference.
+        `past_key_values`: optional decoder keys and values returned by a previous call with `use_cache`,
+            `decode_input_ids` then only holds the positions after them. See `PalmDecoderModel`.
+        `use_cache`: a boolean, also return the decoder keys and values for the next call.
 
     Outputs:
         if `is_infer` is `True`:
             Tuple of (preduction_scores, seq_relationship_logits, encoder_sequence_output).
         if `is_infer` is `False`:
             Tuple if (preduction_scores, seq_relationship_logits).
+        if `use_cache` is `True`, `past_key_values` is appended to the tuple.
 
     Example usage:
     ```python
@@ -937,7 +1000,8 @@ class PalmModel(PalmPreTrainedModel):
 
     def forward(self, input_ids, token_type_ids=None, attention_mask=None,
                 decode_input_ids=None, position_ids=None, decode_attention_mask=None,
-                lm_labels=None, checkpoint_activations=False, is_infer=False, sequence_output=None):
+                lm_labels=None, checkpoint_activations=False, is_infer=False, sequence_output=None,
+                past_key_values=None, use_cache=False):
         
         if sequence_output is None:
             sequence_output, pooled_output = self.bert(input_ids, token_type_ids, attention_mask,
@@ -950,15 +1014,35 @@ class PalmModel(PalmPreTrainedModel):
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
         decode_output = self.decoder(self.bert.embeddings, sequence_output, decode_input_ids, position_ids, attention_mask,
-                                     decode_attention_mask, checkpoint_activations=checkpoint_activations, is_infer=is_infer)
+                                     decode_attention_mask, checkpoint_activations=checkpoint_activations, is_infer=is_infer,
+                                     past_key_values=past_key_values, use_cache=use_cache)
+        if use_cache:
+            decode_output, presents = decode_output
 
         #prediction_scores = self.cls(decode_output)
         
         logits = F.linear(decode_output, self.bert.embeddings.word_embeddings.weight)
         
         if is_infer:
-            return prediction_scores, logits, sequence_output
-        return prediction_scores, logits
+            output = (prediction_scores, logits, sequence_output)
+        else:
+            output = (prediction_scores, logits)
+        if use_cache:
+            output = output + (presents,)
+        return output
+
+
+@dataclass
+class PalmEncoderOutput(ModelOutput):
+    last_hidden_state: torch.FloatTensor = None
+
+
+@dataclass
+class PalmSeq2SeqLMOutput(ModelOutput):
+    loss: Optional[torch.FloatTensor] = None
+    logits: torch.FloatTensor = None
+    past_key_values: Optional[Tuple[Tuple[torch.FloatTensor]]] = None
+    encoder_last_hidden_state: Optional[torch.FloatTensor] = None
 
 
 class PalmForConditionalGeneration(PalmPreTrainedModel):
@@ -969,21 +1053,53 @@ class PalmForConditionalGeneration(PalmPreTrainedModel):
     def forward(self, input_tokens, token_type_ids=None, attention_mask=None,
                 target_tokens=None, position_ids=None, decode_attention_mask=None,
                 checkpoint_activations=False, is_infer=False, sequence_output=None,
-                labels=None, dec_loss_mask=None):
+                labels=None, dec_loss_mask=None, past_key_values=None, use_cache=False,
+                return_dict=False, output_attentions=None, output_hidden_states=None):
+        # output_attentions and output_hidden_states are passed by `generate` and not supported
         output = self.model(input_tokens, token_type_ids, attention_mask, target_tokens,
                             position_ids, decode_attention_mask, checkpoint_activations=checkpoint_activations,
-                            is_infer=is_infer, sequence_output=sequence_output)
+                            is_infer=is_infer, sequence_output=sequence_output,
+                            past_key_values=past_key_values, use_cache=use_cache)
 
         if is_infer:
+            if return_dict:
+                return PalmSeq2SeqLMOutput(logits=output[1], past_key_values=output[3] if use_cache else None,
+                                           encoder_last_hidden_state=output[2])
             return output
-        _, logits = output
+        logits = output[1]
         _logits = logits.view(-1, logits.size()[-1]).contiguous().float()
         losses = F.cross_entropy(_logits, labels.view(-1).contiguous())
         dec_loss_mask = dec_loss_mask.view(-1)
         loss = torch.sum(losses.view(-1) * dec_loss_mask) / dec_loss_mask.sum()
 
+        if return_dict:
+            return PalmSeq2SeqLMOutput(loss=loss, logits=logits, past_key_values=output[2] if use_cache else None)
         return loss, logits
 
+    def get_encoder(self):
+        def encoder(input_ids, token_type_ids=None, attention_mask=None, **kwargs):
+            sequence_output, _ = self.model.bert(input_ids, token_type_ids, attention_mask,
+                                                 output_all_encoded_layers=False)
+            return PalmEncoderOutput(last_hidden_state=sequence_output)
+        return encoder
+
+    def prepare_inputs_for_generation(self, input_ids, past=None, attention_mask=None, use_cache=None,
+                                      encoder_outputs=None, **kwargs):
+        # only the last position is decoded once the previous ones are cached
+        if past is not None:
+            input_ids = input_ids[:, -1:]
+
+        return {"input_tokens": None, "attention_mask": attention_mask, "target_tokens": input_ids,
+                "sequence_output": encoder_outputs.last_hidden_state, "past_key_values": past,
+                "use_cache": use_cache, "is_infer": True}
+
+    def _reorder_cache(self, past, beam_idx):
+        # the cross-attention keys and values are the same for all the beams of a source
+        reordered_past = ()
+        for layer_past in past:
+            reordered_past += (tuple(past_state.index_select(0, beam_idx) for past_state in layer_past[:2]) + layer_past[2:],)
+        return reordered_past
+
     def state_dict(self, destination=None, prefix='', keep_vars=False):
         return self.model.state_dict(destination=destination, prefix=prefix,
                                      keep_vars=keep_vars)
@@ -6,6 +6,7 @@ from .application_plug import (
     ModelPreparationWrapper,
     PlugType,
 )
+from .reshard_plug import reshard_checkpoint
 from .data_plug import (
     TaskTypeName,
     DataProcessor,
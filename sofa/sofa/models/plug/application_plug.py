@@ -3,6 +3,7 @@ from functools import reduce
 from this import d
 from .modeling_plug import BertForPreTraining, PalmForPreTraining, BertForClassification
 from .configuration_plug import PlugNLUConfig, PlugNLGConfig
+from .reshard_plug import reshard_checkpoint
 import torch
 import os
 from collections import OrderedDict
@@ -81,6 +82,11 @@ class ModelPreparationWrapper(object):
         self.model_dir = model_dir
         self.final_model_num = 1
     
+    # model files mp_in -> mp_out, one parameter at a time on cpu
+    def model_reshard(self, target_dir, mp_in, mp_out):
+        logger.info("Resharding the models from {} to {} model parallel ranks".format(mp_in, mp_out))
+        return reshard_checkpoint(self.model_dir, target_dir, mp_in, mp_out)
+
     # model files 1 -> 8
     def _model_split(self, model, mp1, mp2):
         model_name = model
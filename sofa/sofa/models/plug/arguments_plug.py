@@ -293,6 +293,9 @@ class PlugArgs(ArgsBase):
                         help='Use struct bert dataset or not.')
         group.add_argument('--task-name', default='ocnli', type=str)
         group.add_argument('--detach-index', default='-1', type=int)
+        group.add_argument('--max-tokens', default=0, type=int,
+                        help='Build NLU training batches of at most this many padded tokens per '
+                        'data parallel rank instead of batch-size examples. 0 disables it.')
         return self.parser
 
     def _add_data_args(self):
@@ -348,6 +351,10 @@ class PlugArgs(ArgsBase):
                         'each document consists of newline separated sentences')
         group.add_argument('--num-workers', type=int, default=2,
                         help="""Number of workers to use for dataloading""")
+        group.add_argument('--hdf5-prefetch-size', type=int, default=0,
+                        help='Read this many consecutive documents at once '
+                        'into a per-worker buffer when sampling from HDF5 '
+                        'pretraining data. 0 reads one document per sample')
         group.add_argument('--tokenizer-model-type', type=str,
                         default='bert-large-uncased',
                         help="Model type to use for sentencepiece tokenization \
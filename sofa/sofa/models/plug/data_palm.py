@@ -25,7 +25,7 @@ logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(messa
                     level = logging.INFO)
 logger = logging.getLogger(__name__)
 
-from .data_plug import InputExample, DataProcessor, \
+from .data_plug import InputExample, DataProcessor, BaseHDF5Dataset, \
                         create_instances_from_document, \
                         convert_instance_to_feature, \
                         make_data_loader, get_split\
@@ -206,35 +206,13 @@ class GenerationProcessor(DataProcessor):
         dev_example = self._create_examples(lines[int((len(lines)+1)*ratio):], "dev")
         return train_example, dev_example
 
-class PalmHDF5Dataset(Dataset):
+class PalmHDF5Dataset(BaseHDF5Dataset):
     """HDF5 dataset"""
-    def __init__(self, args, input_file, tokenizer, vocab_words, iter_per_epoch, is_training=True):
-        self.oss_file = input_file #[dist.get_rank()]
-        self.input_file = self.oss_file.split('/')[-1]+str(dist.get_rank()) if args.environ == 'jiuding' else self.oss_file
-        self.input_json_file = self.input_file+'.json' if args.environ == 'jiuding' else self.oss_file.replace('token.', 'token.json') 
-
-        self.is_training = is_training
-        self.args = args
-        self.sent_to_doc = json.load(open(self.input_json_file,'r'))['dict'] 
-        self.total_len = len(self.sent_to_doc) 
-        self.vocab_words = vocab_words
-        self.tokenizer = tokenizer
-        self.iter_per_epoch = iter_per_epoch
-
-    def __len__(self):
-        return self.iter_per_epoch
-
-    def remove_local_file(self):
-        os.remove(self.input_file)
-        os.remove(self.input_json_file)
-        logger.info("Remove local token file & json file!")
-
     def __getitem__(self, index):
-        with h5py.File(self.input_file, 'r') as all_documents:
-            document_index = str(self.sent_to_doc[random.randint(0, self.total_len - 1)])
-            instance, lenth = create_instances_from_document(
-                self.args, document_index, all_documents, self.vocab_words, random, self.tokenizer, index)
-            feature = convert_instance_to_feature(self.args, instance, self.tokenizer, lenth)
+        document_index, all_documents = self.next_document()
+        instance, lenth = create_instances_from_document(
+            self.args, document_index, all_documents, self.vocab_words, random, self.tokenizer, index)
+        feature = convert_instance_to_feature(self.args, instance, self.tokenizer, lenth)
         return feature
 
 def make_palm_loaders(args):
@@ -411,6 +389,8 @@ def get_masks_and_position_ids(data,
 
 def data_preparation_nlg(tokenizer, processor, args):
     args.fast_train = False
+    # generation features are padded to seq_length, token-budget batching is NLU only
+    args.max_tokens = 0
     
     if mpu.get_model_parallel_rank() == 0:
         dev_examples = processor.get_dev_examples(args.dev_data) if args.dev_data else []  # should be none []
@@ -436,6 +416,7 @@ def data_preparation_nlg(tokenizer, processor, args):
     args.data_size = data_size
     world_size = torch.distributed.get_world_size(
         group=mpu.get_data_parallel_group())
-    args.train_iters = args.data_size[0].item() // (world_size * args.batch_size) * args.num_epochs
+    args.epoch_iters = args.data_size[0].item() // (world_size * args.batch_size)
+    args.train_iters = args.epoch_iters * args.num_epochs
     return  train_data, val_data, test_data, [], args  
 
@@ -12,6 +12,7 @@ import torch.distributed as dist
 from torch.utils.data import Dataset, Subset
 from multiprocessing import Pool
 from itertools import repeat
+from functools import partial
 import multiprocessing as mp
 from .tokenization_plug import BertTokenizer, printable_text
 from sofa.utils import mpu, data_utils, print_rank_0
@@ -568,39 +569,29 @@ class WorkerInitObj(object):
     def __call__(self, id):
         random.seed(self.seed + id * 1000000)
 
-class HDF5Dataset(Dataset):
-    """HDF5 dataset"""
-    def __init__(self, args, input_file, tokenizer, vocab_words, iter_per_epoch, is_training=True):
-        self.oss_file = input_file #[dist.get_rank()]
-        self.input_file = self.oss_file.split('/')[-1]+str(dist.get_rank()) if args.environ == 'jiuding' else self.oss_file
-        self.input_json_file = self.input_file+'.json' if args.environ == 'jiuding' else self.oss_file.replace('token.', 'token.json') 
+class PrefetchedDocuments(object):
+    """Documents read ahead from an HDF5 file, falling back to the file for
+    any other document (e.g. the random next-sentence document)."""
+    def __init__(self, all_documents, documents):
+        self.all_documents = all_documents
+        self.documents = documents
 
-        self.is_training = is_training
-        self.args = args
-        self.sent_to_doc = json.load(open(self.input_json_file,'r'))['dict'] 
-        self.total_len = len(self.sent_to_doc) 
-        self.vocab_words = vocab_words
-        self.tokenizer = tokenizer
-        self.iter_per_epoch = iter_per_epoch
+    def __getitem__(self, document_index):
+        if document_index in self.documents:
+            return self.documents[document_index]
+        return self.all_documents[document_index]
 
     def __len__(self):
-        return self.iter_per_epoch
+        return len(self.all_documents)
 
-    def remove_local_file(self):
-        os.remove(self.input_file)
-        os.remove(self.input_json_file)
-        logger.info("Remove local token file & json file!")
+class BaseHDF5Dataset(Dataset):
+    """HDF5 document dataset
 
-    def __getitem__(self, index):
-        with h5py.File(self.input_file, 'r') as all_documents:
-            document_index = str(self.sent_to_doc[random.randint(0, self.total_len - 1)])
-            instance = create_instances_from_document(
-                self.sent_to_doc, self.args, document_index, all_documents, self.vocab_words, random, self.tokenizer)
-            feature = convert_instance_to_feature(self.args, instance, self.tokenizer)
-        return feature
-
-class PalmHDF5Dataset(Dataset):
-    """HDF5 dataset"""
+    The HDF5 file is opened lazily once per DataLoader worker and the handle
+    is reused for every sample. With `args.hdf5_prefetch_size` > 0, documents
+    are sampled in runs of that many consecutive documents which are read in
+    one go and served from an in-worker buffer.
+    """
     def __init__(self, args, input_file, tokenizer, vocab_words, iter_per_epoch, is_training=True):
         self.oss_file = input_file #[dist.get_rank()]
         self.input_file = self.oss_file.split('/')[-1]+str(dist.get_rank()) if args.environ == 'jiuding' else self.oss_file
@@ -613,21 +604,73 @@ class PalmHDF5Dataset(Dataset):
         self.vocab_words = vocab_words
         self.tokenizer = tokenizer
         self.iter_per_epoch = iter_per_epoch
+        self.prefetch_size = getattr(args, 'hdf5_prefetch_size', 0)
+        self._all_documents = None
+        self._pid = None
+        self._buffer = {}
+        self._buffer_order = []
 
     def __len__(self):
         return self.iter_per_epoch
 
     def remove_local_file(self):
+        if self._all_documents is not None:
+            self._all_documents.close()
+            self._all_documents = None
         os.remove(self.input_file)
         os.remove(self.input_json_file)
         logger.info("Remove local token file & json file!")
 
+    def __getstate__(self):
+        # h5py handles can not be pickled into DataLoader workers.
+        state = self.__dict__.copy()
+        state.update(_all_documents=None, _pid=None, _buffer={}, _buffer_order=[])
+        return state
+
+    @property
+    def all_documents(self):
+        if self._all_documents is None or self._pid != os.getpid():
+            self._all_documents = h5py.File(self.input_file, 'r')
+            self._pid = os.getpid()
+        return self._all_documents
+
+    def next_document(self):
+        """Sample a document, returning its index and the documents to read it from."""
+        if self.prefetch_size <= 0:
+            return str(self.sent_to_doc[random.randint(0, self.total_len - 1)]), self.all_documents
+        if not self._buffer_order:
+            self._prefetch()
+        document_index = self._buffer_order.pop()
+        return document_index, PrefetchedDocuments(self.all_documents, {document_index: self._buffer.pop(document_index)})
+
+    def _prefetch(self):
+        # sentences of a document are contiguous in sent_to_doc, so walking it from
+        # a random sentence yields consecutive documents in sentence-weighted order
+        sent_index = random.randint(0, self.total_len - 1)
+        while len(self._buffer_order) < self.prefetch_size and sent_index < self.total_len:
+            document_index = str(self.sent_to_doc[sent_index])
+            if document_index not in self._buffer:
+                self._buffer[document_index] = self.all_documents[document_index][()]
+                self._buffer_order.append(document_index)
+            sent_index += 1
+        random.shuffle(self._buffer_order)
+
+class HDF5Dataset(BaseHDF5Dataset):
+    """HDF5 dataset"""
+    def __getitem__(self, index):
+        document_index, all_documents = self.next_document()
+        instance = create_instances_from_document(
+            self.sent_to_doc, self.args, document_index, all_documents, self.vocab_words, random, self.tokenizer)
+        feature = convert_instance_to_feature(self.args, instance, self.tokenizer)
+        return feature
+
+class PalmHDF5Dataset(BaseHDF5Dataset):
+    """HDF5 dataset"""
     def __getitem__(self, index):
-        with h5py.File(self.input_file, 'r') as all_documents:
-            document_index = str(self.sent_to_doc[random.randint(0, self.total_len - 1)])
-            instance, lenth = create_instances_from_document(
-                self.args, document_index, all_documents, self.vocab_words, random, self.tokenizer, index)
-            feature = convert_instance_to_feature(self.args, instance, self.tokenizer, lenth)
+        document_index, all_documents = self.next_document()
+        instance, lenth = create_instances_from_document(
+            self.args, document_index, all_documents, self.vocab_words, random, self.tokenizer, index)
+        feature = convert_instance_to_feature(self.args, instance, self.tokenizer, lenth)
         return feature
 
 class TrainingInstance(object):
@@ -939,7 +982,7 @@ def truncate_seq_pair(tokens_a, tokens_b, max_num_tokens, rng):
         else:
             trunc_tokens.pop()
 
-def make_data_loader(dataset, batch_size, args):
+def make_data_loader(dataset, batch_size, args, max_tokens=0):
     
     shuffle = args.shuffle
     if shuffle:
@@ -956,7 +999,20 @@ def make_data_loader(dataset, batch_size, args):
     distributed = world_size > 1
     drop_last = distributed
 
-    if not args.struct_bert_dataset and not args.palm_dataset and not args.image_dataset:
+    if max_tokens > 0:
+        batch_sampler = data_utils.samplers.TokenBudgetBatchSampler(dataset.lengths(),
+                                                                    max_tokens,
+                                                                    shuffle,
+                                                                    args.seed,
+                                                                    rank,
+                                                                    world_size)
+        pad_label = args.task_type in (TaskTypeName.SEQUENCE_LABELING, TaskTypeName.SEQUENCE_LABELING_CRF)
+        data_loader = torch.utils.data.DataLoader(dataset,
+                                                  batch_sampler=batch_sampler,
+                                                  num_workers=args.num_workers,
+                                                  pin_memory=True,
+                                                  collate_fn=partial(FeatureBatchify, pad_label=pad_label))
+    elif not args.struct_bert_dataset and not args.palm_dataset and not args.image_dataset:
         if distributed:
             batch_sampler = data_utils.samplers.DistributedBatchSampler(sampler,
                                                                         batch_size,
@@ -1028,7 +1084,7 @@ def make_downstream_loaders(args, tokenizer, train, valid, test):
     args.do_train = True
     args.do_valid = True
     args.do_test = True
-    train = make_data_loader(train, batch_size, args)
+    train = make_data_loader(train, batch_size, args, max_tokens=args.max_tokens)
     valid = make_data_loader(valid, eval_batch_size, args)
     shuffle = args.shuffle
     args.shuffle = False
@@ -1261,6 +1317,21 @@ def make_palm_loaders(args, tokenizer):
     valid = make_data_loader(valid, eval_batch_size, args)
     return (train, valid, None), tokenizer 
 
+def FeatureBatchify(batch, pad_label=False):
+    """Pads the `FeatureDataset` items of a batch to its longest sequence."""
+    seq_len = max(len(feature['input_ids']) for feature in batch)
+    input_ids, input_mask, segment_ids = torch.zeros(3, len(batch), seq_len, dtype=torch.long).unbind(0)
+    label_id = torch.zeros(len(batch), seq_len if pad_label else len(batch[0]['label_id']), dtype=torch.long)
+    for i, feature in enumerate(batch):
+        length = len(feature['input_ids'])
+        input_ids[i, :length] = torch.tensor(feature['input_ids'], dtype=torch.long)
+        input_mask[i, :length] = torch.tensor(feature['input_mask'], dtype=torch.long)
+        segment_ids[i, :length] = torch.tensor(feature['segment_ids'], dtype=torch.long)
+        label_id[i, :len(feature['label_id'])] = torch.tensor(feature['label_id'], dtype=torch.long)
+    index = torch.tensor([feature['index'] for feature in batch], dtype=torch.long)
+    return {'input_ids': input_ids, 'input_mask': input_mask, 'segment_ids': segment_ids,
+            'label_id': label_id, 'index': index}
+
 def PalmBatchify(batch):
     input_ids, input_mask, segment_ids, target_ids, masked_lm_positions, masked_lm_ids, masked_lm_weights = \
         list(), list(), list(), list(), list(), list(), list()
@@ -1714,7 +1785,10 @@ def data_preparation_nlu(tokenizer, processor, args):
             print_rank_0('Randomly sample a subset of train examples to train in few-shot learning setting')
             print_rank_0('few_shot_train_size: {}'.format(args.few_shot_train_size_per_class))
             train_examples = get_few_shot_train_data(args, train_examples, label_list)
+        # token-budget batches are padded by FeatureBatchify instead of to seq_length
+        args.fast_train = args.max_tokens > 0
         train_features = convert_examples_to_features(args, train_examples, [label_list], args.seq_length, tokenizer, 0, 1, True)
+        args.fast_train = False
         dev_features = convert_examples_to_features(args, dev_examples, [label_list], args.seq_length, tokenizer, 0, 1, True)
         test_features = convert_examples_to_features(args, test_examples, [label_list], args.seq_length, tokenizer, 0, 1, False)
         train_dataset = FeatureDataset(train_features)
@@ -1742,8 +1816,17 @@ def data_preparation_nlu(tokenizer, processor, args):
         for key, value in label_map_list[0].items():
             label_list[key] = value
     args.data_size = data_size
-    train_data, val_data, test_data = get_train_val_test_data_clean(args, train_dataset, dev_dataset, test_dataset)
+    train_data, val_data, test_data = get_train_val_test_data_clean(args, tokenizer, train_dataset, dev_dataset, test_dataset)
     world_size = torch.distributed.get_world_size(
         group=mpu.get_data_parallel_group())
-    args.train_iters = args.data_size[0].item() // (world_size * args.batch_size) * args.num_epochs
+    if args.max_tokens > 0:
+        # the number of token-budget batches is only known where the data was loaded
+        epoch_iters = torch.cuda.LongTensor([len(train_data) if train_data is not None else 0])
+        torch.distributed.broadcast(epoch_iters,
+                                    mpu.get_model_parallel_src_rank(),
+                                    group=mpu.get_model_parallel_group())
+        args.epoch_iters = epoch_iters.item()
+    else:
+        args.epoch_iters = args.data_size[0].item() // (world_size * args.batch_size)
+    args.train_iters = args.epoch_iters * args.num_epochs
     return  train_data, val_data, test_data, label_list, args
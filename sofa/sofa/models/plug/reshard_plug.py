@@ -0,0 +1,148 @@
+"""Streaming model-parallel resharding of PLUG checkpoints.
+
+Converts the `mp_rank_XX_model_states.pt` files of a checkpoint saved with
+`mp_in` model parallel ranks into `mp_out` ranks, for any `mp_in` and
+`mp_out` dividing the partitioned dimensions. The partitioning of every
+parameter follows the key rules of `ModelPreparationWrapper`: split in the
+first or the last dimension, query/key/value and key/value weights split per
+projection and interleaved, everything else replicated.
+
+The input shards are memory-mapped (torch >= 2.1, zipfile checkpoints), so
+only the slices a parameter needs are read, and the output shards are built
+one parameter at a time and written one after another, entirely on CPU. The
+peak memory is about one output shard.
+
+    python -m sofa.models.plug.reshard_plug --model_dir ckpt/ --target_dir ckpt_mp2/ --mp_in 8 --mp_out 2
+"""
+import argparse
+import inspect
+import logging
+import os
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+SHARD_NAME = 'mp_rank_{:02d}_model_states.pt'
+
+# partitioned in the first dimension besides the ColumnParallelLinear ('intermediate', query...) weights
+FIRST_DIM_KEYS = ['bert.embeddings.word_embeddings.weight', 'cls.predictions.decoder_weight', 'cls.predictions.bias']
+
+
+def partition_rule(key):
+    """(dim, num_parts) of the partitioning of `key`, or None if it is replicated.
+
+    A shard holds `num_parts` consecutive blocks along `dim` (q, k, v for
+    query_key_value, k, v for key_value) and every block is split evenly
+    across the model parallel ranks.
+    """
+    ## split in first dim
+    if key in FIRST_DIM_KEYS or 'intermediate' in key:
+        return 0, 1
+    ## split in last dim
+    if 'output.dense.weight' in key or 'output.weight' in key or 'attention.dense.weight' in key:
+        return -1, 1
+    ## split self attention
+    if 'query_key_value' in key:
+        return 0, 3
+    if '.key_value.' in key:
+        return 0, 2
+    # encoder query/key/value after _encoder_qkv_split, cross attention query
+    if '.query.' in key or '.key.' in key or '.value.' in key:
+        return 0, 1
+    return None
+
+
+def load_shard(path):
+    """Checkpoint at `path` on CPU, memory-mapped when torch supports it."""
+    kwargs = {'map_location': 'cpu'}
+    parameters = inspect.signature(torch.load).parameters
+    if 'weights_only' in parameters:
+        kwargs['weights_only'] = False
+    if 'mmap' in parameters:
+        try:
+            return torch.load(path, mmap=True, **kwargs)
+        except RuntimeError as e:
+            # legacy (non zipfile) checkpoints cannot be memory-mapped
+            logger.warning("loading {} without mmap: {}".format(path, e))
+    return torch.load(path, **kwargs)
+
+
+def _narrow_concat(tensors, dim, start, length):
+    """torch.cat(tensors, dim).narrow(dim, start, length), touching only the overlapping tensors."""
+    pieces = []
+    offset = 0
+    for tensor in tensors:
+        size = tensor.size(dim)
+        begin, end = max(start, offset), min(start + length, offset + size)
+        if begin < end:
+            pieces.append(tensor.narrow(dim, begin - offset, end - begin))
+        offset += size
+    return torch.cat(pieces, dim=dim)
+
+
+def reshard_param(key, shards, mp_out, rank):
+    """Partition `rank` of `mp_out` of the parameter `key`, given its partitions on all input ranks."""
+    rule = partition_rule(key)
+    if rule is None:
+        return shards[0].clone()
+    dim, num_parts = rule
+    # block `part` of every input partition, in rank order they make up the full block
+    blocks = [shard.split(shard.size(dim) // num_parts, dim=dim) for shard in shards]
+    new_param = []
+    for part in range(num_parts):
+        parts = [block[part] for block in blocks]
+        size = sum(p.size(dim) for p in parts)
+        if size % mp_out != 0:
+            raise ValueError("{} of size {} in dim {} can not be split into {} partitions".format(
+                key, size, dim, mp_out))
+        new_param.append(_narrow_concat(parts, dim, rank * size // mp_out, size // mp_out))
+    return torch.cat(new_param, dim=dim)
+
+
+def reshard_checkpoint(model_dir, target_dir, mp_in, mp_out):
+    """Writes the `mp_in` shards of `model_dir` as `mp_out` shards to `target_dir`.
+
+    Besides 'module', the entries of a new shard are copied from the input
+    shard holding its first partition. The optimizer states are dropped, they
+    are partitioned like the parameters and are not resharded.
+    """
+    if os.path.abspath(model_dir) == os.path.abspath(target_dir):
+        raise ValueError("target_dir must differ from model_dir, the input shards are read while writing")
+    os.makedirs(target_dir, exist_ok=True)
+    checkpoints = [load_shard(os.path.join(model_dir, SHARD_NAME.format(i))) for i in range(mp_in)]
+    modules = [checkpoint['module'] for checkpoint in checkpoints]
+
+    for rank in range(mp_out):
+        new_params = type(modules[0])()
+        resharded = {}
+        for key in modules[0]:
+            shards = [module[key] for module in modules]
+            # tied parameters (cls.predictions.decoder_weight) stay tied
+            tie = tuple((shard.data_ptr(), shard.shape) for shard in shards) + (partition_rule(key),)
+            if tie not in resharded:
+                resharded[tie] = reshard_param(key, shards, mp_out, rank)
+            new_params[key] = resharded[tie]
+
+        checkpoint = {key: value for key, value in checkpoints[rank * mp_in // mp_out].items()
+                      if key not in ('module', 'optimizer')}
+        checkpoint['module'] = new_params
+        if 'mp_world_size' in checkpoint:
+            checkpoint['mp_world_size'] = mp_out
+        path = os.path.join(target_dir, SHARD_NAME.format(rank))
+        torch.save(checkpoint, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        del checkpoint, new_params, resharded
+        logger.info("saved {} ({} of {})".format(path, rank + 1, mp_out))
+    return [os.path.join(target_dir, SHARD_NAME.format(rank)) for rank in range(mp_out)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', required=True, help='directory of the mp_rank_XX_model_states.pt files')
+    parser.add_argument('--target_dir', required=True)
+    parser.add_argument('--mp_in', type=int, required=True, help='model parallel size of the checkpoint')
+    parser.add_argument('--mp_out', type=int, required=True, help='model parallel size to reshard to')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    reshard_checkpoint(args.model_dir, args.target_dir, args.mp_in, args.mp_out)
@@ -0,0 +1,154 @@
+# coding=utf-8
+# Copyright 2021-2022 The Alibaba DAMO NLP Team Authors.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import torch
+
+from reshard_plug import SHARD_NAME, load_shard, reshard_checkpoint
+
+# tiny PLUG NLG
+vocab_size = 24
+hidden_size = 12
+intermediate_size = 48
+max_position_embeddings = 16
+
+
+def random_plug_state_dict(seed=1234):
+    """Random full (model parallel size 1) state dict with the parameter names of PalmForPreTraining."""
+    torch.manual_seed(seed)
+    h, i = hidden_size, intermediate_size
+    shapes = OrderedDict([
+        ('bert.embeddings.word_embeddings.weight', (vocab_size, h)),
+        ('bert.embeddings.position_embeddings.weight', (max_position_embeddings, h)),
+        ('bert.embeddings.token_type_embeddings.weight', (2, h)),
+        ('bert.embeddings.LayerNorm.weight', (h,)),
+        ('bert.embeddings.LayerNorm.bias', (h,)),
+    ])
+    # layer 0 with the query/key/value of a fine-tuned model, layer 1 with the fused query_key_value
+    for name in ('query', 'key', 'value'):
+        shapes['bert.encoder.layer.0.attention.self.{}.weight'.format(name)] = (h, h)
+        shapes['bert.encoder.layer.0.attention.self.{}.bias'.format(name)] = (h,)
+    shapes['bert.encoder.layer.1.attention.self.query_key_value.weight'] = (3 * h, h)
+    shapes['bert.encoder.layer.1.attention.self.query_key_value.bias'] = (3 * h,)
+    for layer in range(2):
+        prefix = 'bert.encoder.layer.{}.'.format(layer)
+        shapes[prefix + 'attention.output.dense.weight'] = (h, h)
+        shapes[prefix + 'attention.output.dense.bias'] = (h,)
+        shapes[prefix + 'attention.output.LayerNorm.weight'] = (h,)
+        shapes[prefix + 'intermediate.dense.weight'] = (i, h)
+        shapes[prefix + 'intermediate.dense.bias'] = (i,)
+        shapes[prefix + 'output.dense.weight'] = (h, i)
+        shapes[prefix + 'output.dense.bias'] = (h,)
+        shapes[prefix + 'output.LayerNorm.weight'] = (h,)
+    prefix = 'decoder.decoder.layer.0.'
+    shapes[prefix + 'attention.query_key_value.weight'] = (3 * h, h)
+    shapes[prefix + 'attention.query_key_value.bias'] = (3 * h,)
+    shapes[prefix + 'attention.dense.weight'] = (h, h)
+    shapes[prefix + 'attention.dense.bias'] = (h,)
+    shapes[prefix + 'cross_attention.query.weight'] = (h, h)
+    shapes[prefix + 'cross_attention.query.bias'] = (h,)
+    shapes[prefix + 'cross_attention.key_value.weight'] = (2 * h, h)
+    shapes[prefix + 'cross_attention.key_value.bias'] = (2 * h,)
+    shapes[prefix + 'cross_attention.dense.weight'] = (h, h)
+    shapes[prefix + 'input_layernorm.weight'] = (h,)
+    shapes[prefix + 'intermediate.weight'] = (i, h)
+    shapes[prefix + 'intermediate.bias'] = (i,)
+    shapes[prefix + 'output.weight'] = (h, i)
+    shapes[prefix + 'output.bias'] = (h,)
+    shapes['decoder.decoder.final_layernorm.weight'] = (h,)
+    shapes['cls.predictions.transform.dense.weight'] = (h, h)
+    shapes['cls.predictions.bias'] = (vocab_size,)
+    shapes['cls.seq_relationship.weight'] = (3, h)
+    state_dict = OrderedDict((key, torch.randn(shape)) for key, shape in shapes.items())
+    state_dict['cls.predictions.decoder_weight'] = state_dict['bert.embeddings.word_embeddings.weight']
+    return state_dict
+
+
+def save_shards(model_dir, modules):
+    os.makedirs(model_dir, exist_ok=True)
+    for rank, module in enumerate(modules):
+        torch.save({'module': module, 'mp_world_size': len(modules), 'iteration': 10},
+                   os.path.join(model_dir, SHARD_NAME.format(rank)))
+
+
+def load_modules(model_dir, mp):
+    return [load_shard(os.path.join(model_dir, SHARD_NAME.format(rank)))['module'] for rank in range(mp)]
+
+
+def test_reshard_round_trip():
+    full = random_plug_state_dict()
+    with tempfile.TemporaryDirectory() as root:
+        sizes = [1, 4, 6, 2, 3, 1]
+        model_dirs = [os.path.join(root, 'step{}'.format(step)) for step in range(len(sizes))]
+        save_shards(model_dirs[0], [full])
+        for step in range(1, len(sizes)):
+            reshard_checkpoint(model_dirs[step - 1], model_dirs[step], sizes[step - 1], sizes[step])
+        result = load_modules(model_dirs[-1], 1)[0]
+        checkpoint = load_shard(os.path.join(model_dirs[-1], SHARD_NAME.format(0)))
+
+    assert list(result.keys()) == list(full.keys())
+    for key in full:
+        assert torch.equal(result[key], full[key]), key
+    assert checkpoint['mp_world_size'] == 1 and checkpoint['iteration'] == 10
+    # tied to the word embeddings like in the model
+    assert result['cls.predictions.decoder_weight'].data_ptr() == \
+        result['bert.embeddings.word_embeddings.weight'].data_ptr()
+
+
+def test_reshard_layout():
+    full = random_plug_state_dict()
+    mp = 3
+    with tempfile.TemporaryDirectory() as root:
+        save_shards(os.path.join(root, 'mp1'), [full])
+        reshard_checkpoint(os.path.join(root, 'mp1'), os.path.join(root, 'mp3'), 1, mp)
+        modules = load_modules(os.path.join(root, 'mp3'), mp)
+
+    h, i = hidden_size, intermediate_size
+    for rank, module in enumerate(modules):
+        # split in first dim
+        rows = slice(rank * vocab_size // mp, (rank + 1) * vocab_size // mp)
+        assert torch.equal(module['bert.embeddings.word_embeddings.weight'],
+                           full['bert.embeddings.word_embeddings.weight'][rows])
+        rows = slice(rank * i // mp, (rank + 1) * i // mp)
+        assert torch.equal(module['decoder.decoder.layer.0.intermediate.bias'],
+                           full['decoder.decoder.layer.0.intermediate.bias'][rows])
+        rows = slice(rank * h // mp, (rank + 1) * h // mp)
+        assert torch.equal(module['bert.encoder.layer.0.attention.self.key.weight'],
+                           full['bert.encoder.layer.0.attention.self.key.weight'][rows])
+        # split in last dim
+        assert torch.equal(module['bert.encoder.layer.0.output.dense.weight'],
+                           full['bert.encoder.layer.0.output.dense.weight'][:, rank * i // mp:(rank + 1) * i // mp])
+        # q, k, v of this rank interleaved
+        q, k, v = full['decoder.decoder.layer.0.attention.query_key_value.weight'].split(h, dim=0)
+        assert torch.equal(module['decoder.decoder.layer.0.attention.query_key_value.weight'],
+                           torch.cat([q[rows], k[rows], v[rows]], dim=0))
+        k, v = full['decoder.decoder.layer.0.cross_attention.key_value.bias'].split(h, dim=0)
+        assert torch.equal(module['decoder.decoder.layer.0.cross_attention.key_value.bias'],
+                           torch.cat([k[rows], v[rows]], dim=0))
+        # replicated
+        assert torch.equal(module['bert.encoder.layer.0.output.dense.bias'],
+                           full['bert.encoder.layer.0.output.dense.bias'])
+
+
+if __name__ == '__main__':
+    test_reshard_round_trip()
+    test_reshard_layout()
+    print('passed')
@@ -211,10 +211,7 @@ class TrainerPlug(object):
         skipped_iters = 0
 
         report_memory_flag = True
-        world_size = torch.distributed.get_world_size(
-            group=mpu.get_data_parallel_group())
-        epoch_iters = args.data_size[0].item() // (world_size * args.batch_size) 
-        while cur_iteration < epoch_iters:
+        while cur_iteration < args.epoch_iters:
             cls_loss, skipped_iter = self.train_step(iteration,
                                                         train_data_iterator,
                                                         model,
@@ -358,6 +355,8 @@ class TrainerPlug(object):
             print_rank_0('Training on epoch {}'.format(epoch_id))
             args.epoch_id = epoch_id
             if self.train_dataset is not None:
+                if hasattr(self.train_dataset.batch_sampler, 'set_epoch'):
+                    self.train_dataset.batch_sampler.set_epoch(epoch_id)
                 train_data_iterator = iter(self.train_dataset)
             else:
                 train_data_iterator = None
@@ -16,9 +16,9 @@
 import os
 import math
 
-from .samplers import DistributedBatchSampler
+from .samplers import DistributedBatchSampler, TokenBudgetBatchSampler
 from .datasets import json_dataset, csv_dataset, split_ds, ConcatDataset, SplitDataset, bert_sentencepair_dataset, GPT2Dataset
-from .lazy_loader import exists_lazy, make_lazy, lazy_array_loader
+from .lazy_loader import exists_lazy, make_lazy, convert_lazy, lazy_array_loader
 from .tokenization import Tokenization, CommandToken, Tokenizer, CharacterLevelTokenizer, BertWordPieceTokenizer, GPT2BPETokenizer, make_tokenizer
 from . import corpora
 from . import tf_dl
@@ -72,6 +72,57 @@ class RandomSampler(data.sampler.Sampler):
     def set_epoch(self, epoch):
         self.epoch = epoch
 
+class TokenBudgetBatchSampler(data.sampler.Sampler):
+    """Batches of similar-length examples with at most `max_tokens` padded tokens.
+
+    Examples are sorted by decreasing length (ties broken at random) and cut
+    into batches whose size times longest length fits the budget, an example
+    longer than `max_tokens` gets a batch of its own. Consecutive groups of
+    `world_size` batches form one step, so the batches of the ranks in a step
+    have about the same number of padded tokens, and the steps are shuffled.
+    Both only depend on `seed` and the epoch given to `set_epoch`, so every
+    rank builds the same steps. The last step is completed with batches from
+    the start of the epoch.
+    """
+
+    def __init__(self, lengths, max_tokens, shuffle=True, seed=0, rank=0, world_size=1):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        # batch boundaries only depend on the sorted lengths, not on the tie breaking
+        self.num_batches = len(self._batch_bounds(np.sort(self.lengths)[::-1]))
+
+    def _batch_bounds(self, sorted_lengths):
+        bounds, start = [], 0
+        while start < len(sorted_lengths):
+            end = min(start + max(1, self.max_tokens // max(1, int(sorted_lengths[start]))), len(sorted_lengths))
+            bounds.append((start, end))
+            start = end
+        return bounds
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        tie_break = rng.random_sample(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        order = np.lexsort((tie_break, -self.lengths))
+        batches = [order[start:end] for start, end in self._batch_bounds(self.lengths[order])]
+        num_steps = len(self)
+        batches += [batches[i % len(batches)] for i in range(num_steps * self.world_size - len(batches))]
+        steps = np.arange(num_steps)
+        if self.shuffle:
+            rng.shuffle(steps)
+        for step in steps:
+            yield batches[step * self.world_size + self.rank].tolist()
+
+    def __len__(self):
+        return (self.num_batches + self.world_size - 1) // self.world_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
 class DistributedBatchSampler(data.sampler.BatchSampler):
     """
     similar to normal implementation of distributed sampler, except implementation is at the